@@ -4,6 +4,7 @@ from fbgp.policy import Policy
 
 import logging
 import json
+import socket
 import ipaddress
 import operator
 import collections
@@ -13,6 +14,96 @@ ORIGIN_IGP = 0
 ORIGIN_EGP = 1
 ORIGIN_INCOMPLETE = 2
 
+MAX_FRAGMENTS = 1 << 17 # attribute sets whose rendered fragments are cached
+MAX_GATEWAYS = 1024 # rendered nexthops cached, they are the routerid and the vips
+MAX_INTERNED = 1 << 17
+
+# the attributes of a route sent to a peer, interned: the Adj-RIBs-Out of all the
+# peers share one record per attribute set
+Attributes = collections.namedtuple('Attributes', 'as_path origin med local_pref community')
+
+_fragments = {}
+_gateways = {}
+_interned = {}
+_prepended = {} # (Attributes, AS path prepended) -> Attributes sent to eBGP peers
+
+
+def _freeze(value):
+    """Return a hashable form of a list of values, or of nested lists."""
+    if isinstance(value, list):
+        value = tuple(value)
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return tuple(_freeze(item) for item in value)
+
+
+def prefix_key(prefix):
+    """Return the (version, int, prefixlen) form of a prefix used by fbgp.exabgp_parser."""
+    return (prefix.version, int(prefix.network_address), prefix.prefixlen)
+
+
+def intern_attributes(attributes):
+    """Return the shared copy of an Attributes record."""
+    if len(_interned) >= MAX_INTERNED:
+        _interned.clear()
+    return _interned.setdefault(attributes, attributes)
+
+
+def _prepend(attributes, as_prepend):
+    """Return the interned attributes sent to an eBGP peer: the AS path prepended
+    and no local preference."""
+    key = (attributes, as_prepend)
+    out = _prepended.get(key)
+    if out is None:
+        out = intern_attributes(Attributes(as_prepend + attributes.as_path, attributes.origin,
+                                           attributes.med, None, attributes.community))
+        if len(_prepended) >= MAX_INTERNED:
+            _prepended.clear()
+        _prepended[key] = out
+    return out
+
+
+def _render(attributes):
+    """Return the attributes rendered for an announce and for a withdraw, they are
+    rendered once per attribute set."""
+    fragments = _fragments.get(attributes)
+    if fragments is None:
+        attrs = ''
+        for attr, value in [('origin', attributes.origin), ('med', attributes.med),
+                            ('local-preference', attributes.local_pref),
+                            ('community', attributes.community)]:
+            if value is not None:
+                if attr == 'community':
+                    value = '[%s]' % ' '.join('%s:%s' % tuple(community) for community in value)
+                attrs += ' %s %s' % (attr, value)
+        fragments = (' as-path %s%s' % (list(attributes.as_path), attrs), attrs)
+        if len(_fragments) >= MAX_FRAGMENTS:
+            _fragments.clear()
+        _fragments[attributes] = fragments
+    return fragments
+
+
+def _neighbors(peers):
+    """The ExaBGP selector of a message sent to several neighbors."""
+    return ', '.join(peer.neighbor for peer in peers)
+
+
+_FAMILIES = {4: socket.AF_INET, 6: socket.AF_INET6}
+
+
+def _format(value):
+    """Format an address or network with inet_ntop rather than the much slower
+    str() of ipaddress."""
+    family = _FAMILIES.get(getattr(value, 'version', None))
+    if family is None:
+        return value
+    if isinstance(value, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+        return '%s/%d' % (socket.inet_ntop(family, value.network_address.packed), value.prefixlen)
+    return socket.inet_ntop(family, value.packed)
+
+
 class Route:
     """Represent a BGP route to a prefix."""
 
@@ -30,35 +121,57 @@ class Route:
         self.from_as = others.get('from_as')
         self.from_peer = others.get('from_peer')
         self.from_ibgp = others.get('from_ibgp', False)
-
-
-    def to_exabgp(self, peer=None, is_withdraw=False, gw=None):
-        line = ''
-        if peer:
-            line = 'neighbor %s' % peer.peer_ip
+        self._prefix_text = None # the rendered prefix, shared with the copies of the route
+        self._attributes = None
+
+    def attributes(self):
+        """Return the interned Attributes record of the route, the route must not be
+        modified once it is exported."""
+        if self._attributes is None:
+            self._attributes = intern_attributes(Attributes(
+                _freeze(self.as_path), self.origin, self.med, self.local_pref, _freeze(self.community)))
+        return self._attributes
+
+    def fragments(self):
+        """Return the attributes of the route rendered for an announce and for a withdraw.
+        They are rendered once per attribute set, routes mostly share a few of them."""
+        return _render(self.attributes())
+
+    def prefix_text(self):
+        if self._prefix_text is None:
+            self._prefix_text = _format(self.prefix)
+        return self._prefix_text
+
+    def to_exabgp(self, peer=None, is_withdraw=False, gw=None, path_id=None):
+        announce, withdraw = self.fragments()
+        neighbor = peer.neighbor if peer else ''
+        path = '' if path_id is None else ' path-information %s' % path_id
         if is_withdraw:
-            line += ' withdraw route %s' % self.prefix
-        else:
-            gateway = gw or peer.faucet_vip.ip
-            line += ' announce route %s next-hop %s as-path %s' % (
-                self.prefix, gateway, self.as_path)
-        for name, attr in [
-                ('origin', 'origin'), ('med', 'med'), ('local_pref', 'local-preference'),
-                ('community', 'community')]:
-            if getattr(self, name) is not None:
-                line += ' %s %s' % (attr, getattr(self, name))
-        return line
+            return '%s withdraw route %s%s%s' % (neighbor, self.prefix_text(), path, withdraw)
+        gateway = gw or peer.gateway
+        gateway_text = _gateways.get(gateway)
+        if gateway_text is None:
+            if len(_gateways) >= MAX_GATEWAYS:
+                _gateways.clear()
+            gateway_text = _gateways[gateway] = _format(gateway)
+        return '%s announce route %s next-hop %s%s%s' % (
+            neighbor, self.prefix_text(), gateway_text, path, announce)
 
     def copy(self):
         """return a copy of this route."""
-        return self.__class__(self.prefix, self.nexthop, self.as_path, self.origin,
-                              local_pref=self.local_pref, med=self.med,
-                              community=self.community, local=self.local,
-                              from_as=self.from_as, from_peer=self.from_peer,
-                              from_ibgp=self.from_ibgp)
+        route = self.__class__(self.prefix, self.nexthop, self.as_path, self.origin,
+                               local_pref=self.local_pref, med=self.med,
+                               community=self.community, local=self.local,
+                               from_as=self.from_as, from_peer=self.from_peer,
+                               from_ibgp=self.from_ibgp)
+        route._prefix_text = self.prefix_text()
+        return route
 
     def __hash__(self):
-        return hash(frozenset([str(v) for v in self.__dict__.values()]))
+        # hash the values rather than their strings, formatting IPv6 addresses is slow
+        return hash((self.prefix, self.nexthop, _freeze(self.as_path), self.origin,
+                     self.local_pref, self.med, _freeze(self.community), self.local,
+                     self.from_as, self.from_peer, self.from_ibgp))
 
     def __eq__(self, other):
         return hash(self) == hash(other)
@@ -76,6 +189,61 @@ class Route:
     __repr__ = __str__
 
 
+class RouteView:
+    """A route as exported to a peer: the route, shared by all the peers, seen with
+    the attributes sent to the peer."""
+
+    __slots__ = ('route', 'attributes')
+
+    def __init__(self, route, attributes):
+        self.route = route
+        self.attributes = attributes
+
+    def __getattr__(self, name):
+        if name == 'route':
+            raise AttributeError(name)
+        return getattr(self.route, name)
+
+    @property
+    def as_path(self):
+        return list(self.attributes.as_path)
+
+    @property
+    def origin(self):
+        return self.attributes.origin
+
+    @property
+    def med(self):
+        return self.attributes.med
+
+    @property
+    def local_pref(self):
+        return self.attributes.local_pref
+
+    @property
+    def community(self):
+        return self.attributes.community
+
+    def fragments(self):
+        return _render(self.attributes)
+
+    to_exabgp = Route.to_exabgp
+
+    def __eq__(self, other):
+        return (isinstance(other, RouteView) and self.attributes == other.attributes and
+                self.route.prefix == other.route.prefix)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.route.prefix, self.attributes))
+
+    def __str__(self):
+        return '<RouteView %s %s>' % (self.route, self.attributes)
+    __repr__ = __str__
+
+
 class Border:
     """Represent other border routers."""
 
@@ -102,11 +270,23 @@ class Border:
             self.routerid, self.nexthop, self.dp_id, self.vlan_vid, self.port_no)
 
 
+class RibBudget:
+    """Count the routes held in the Adj-RIBs-In of all peers against a global limit."""
+
+    def __init__(self, limit=0):
+        self.limit = limit # max routes, 0 is unlimited
+        self.used = 0
+
+    def exhausted(self):
+        return bool(self.limit) and self.used >= self.limit
+
+
 class BgpPeer:
     """Representation of a BGP peer. It also keeps info about the attachment point."""
 
     def __init__(self, peer_as, peer_ip, local_as=None, local_ip=None, peer_port=179,
-                 dp_id=None, vlan_vid=None, port_no=None, vlan=None):
+                 dp_id=None, vlan_vid=None, port_no=None, vlan=None, mrai=0, add_path=0,
+                 max_prefix=0, max_prefix_action='teardown', budget=None, max_update_rate=0):
         self.import_policy = Policy.default() # default accept everything
         self.export_policy = Policy.default() # default accept everything
 
@@ -121,28 +301,78 @@ class BgpPeer:
         self.port_no = port_no
         self.vlan = vlan
         self.faucet_vip = None
-
-        self._rib_in = {} #route received from peer
-        self._rib_out = {} #route announced to peer
+        self.mrai = mrai # min route advertisement interval, 0 sends updates immediately
+        self.pending_handler = None # called when the first update is queued during the MRAI
+        self.add_path = add_path # max paths per prefix sent with ADD-PATH, 0 sends the best path only
+        self.max_prefix = max_prefix # max routes received from the peer, 0 is unlimited
+        self.max_prefix_action = max_prefix_action # warn, drop or teardown when max_prefix is reached
+        self.budget = budget # RibBudget shared by all the peers
+        self.max_update_rate = max_update_rate # max messages per second handled from the peer, 0 is unlimited
+
+        self._rib_in = {} #route received from peer, before the import policy
+        self._rib_in_post = {} #routes accepted by the import policy, as modified by it
+        self._received = {} #prefix_key -> (nexthop, attributes) as parsed, or None, for each prefix of _rib_in
+        self._rib_out = {} #prefix -> Attributes announced to peer
+        self._rib_out_paths = {} #prefix -> {path_id: (route, gateway)} announced to an ADD-PATH peer
         self._candidate_routes = {} #possible routes for the peer
+        self._stale = set() #prefixes restored from a snapshot, not yet refreshed by the peer
+        self._pending = {} #prefix -> (route, gateway, withdraw) to send when the MRAI expires
         self.state = 'down'
         self.is_connected = False
         self.ibgp = self.local_as == self.peer_as
+        self.set_export_context()
+
+    def set_export_context(self, nexthop_self=None):
+        """Precompute what exporting a route to this peer depends on besides the route:
+        the neighbor selector of its messages, the nexthop of the best routes sent to
+        it (nexthop_self, or the faucet vip) and the AS path prepended to them."""
+        self.version = self.peer_ip.version
+        self.neighbor = 'neighbor %s' % _format(self.peer_ip)
+        self.nexthop_self = nexthop_self
+        self.gateway = nexthop_self or (self.faucet_vip.ip if self.faucet_vip else None)
+        self.as_prepend = (self.local_as,) if self.local_as != self.peer_as else ()
 
     def is_ibgp(self):
         return self.ibgp
 
     def bgp_session_up(self):
-        """BGP session with the peer is up."""
-        self._rib_in = {}
+        """BGP session with the peer is up. Stale routes are kept until refreshed or swept."""
+        num_routes = len(self._rib_in)
+        self._rib_in = {prefix: self._rib_in[prefix] for prefix in self._stale}
+        self._account(len(self._rib_in) - num_routes)
+        self._rib_in_post = {prefix: self._rib_in_post[prefix]
+                             for prefix in self._stale if prefix in self._rib_in_post}
+        self._received = dict.fromkeys(prefix_key(prefix) for prefix in self._rib_in)
         self._rib_out = {}
+        self._rib_out_paths = {}
+        self._pending = {}
         self.state = 'up'
 
     def bgp_session_down(self):
         """BGP session with the peer is down."""
         self.state = 'down'
+        self._account(-len(self._rib_in))
         self._rib_in = {}
+        self._rib_in_post = {}
+        self._received = {}
         self._rib_out = {}
+        self._rib_out_paths = {}
+        self._pending = {}
+        self._stale = set()
+
+    def mark_stale(self):
+        """Mark all routes received from this peer as stale (graceful restart)."""
+        self._stale = set(self._rib_in)
+
+    def sweep_stale(self):
+        """Remove stale routes that were not refreshed, return the removed routes."""
+        routes = [self._rib_in.pop(prefix) for prefix in self._stale if prefix in self._rib_in]
+        self._account(-len(routes))
+        for prefix in self._stale:
+            self._rib_in_post.pop(prefix, None)
+            self._received.pop(prefix_key(prefix), None)
+        self._stale = set()
+        return routes
 
     def connected(self, dp_id, vlan_vid, port_no):
         """The peer is connected to our dataplane."""
@@ -157,12 +387,49 @@ class BgpPeer:
 
     def rcv_withdraw(self, prefix):
         """Withdraw a route from this peer."""
+        self._stale.discard(prefix)
+        self._rib_in_post.pop(prefix, None)
+        self._received.pop(prefix_key(prefix), None)
         if prefix in self._rib_in:
+            self._account(-1)
             return self._rib_in.pop(prefix)
         return
 
-    def rcv_announce(self, prefix, nexthop, as_path, origin, **others):
-        """Process a route announced by this peer."""
+    def _account(self, delta):
+        if self.budget is not None:
+            self.budget.used += delta
+
+    def load_route(self, route):
+        """Put back a route received before a restart, as restored from a snapshot."""
+        if route.prefix not in self._rib_in:
+            self._account(1)
+        self._rib_in[route.prefix] = route
+
+    def limit_action(self):
+        """Return what to do with a route for a new prefix: None to accept it, or the
+        max_prefix_action if the peer is at its max-prefix limit. The route is dropped
+        if the global RIB budget is exhausted, whatever the max_prefix_action: a warn
+        peer does not go over the budget."""
+        if self.budget is not None and self.budget.exhausted():
+            return 'drop'
+        if self.max_prefix and len(self._rib_in) >= self.max_prefix:
+            return self.max_prefix_action
+        return None
+
+    def is_duplicate(self, prefix, nexthop, attributes):
+        """Return True if a parsed announce is the one already received, the check is
+        done on the parsed forms, the interned attributes are compared by identity."""
+        received = self._received.get(prefix)
+        return received is not None and received[1] is attributes and received[0] == nexthop
+
+    def has_prefix(self, prefix):
+        """Return True if a route was received for a parsed prefix."""
+        return prefix in self._received
+
+    def rcv_announce(self, prefix, nexthop, as_path, origin, received=None, **others):
+        """Process a route announced by this peer. received is the (nexthop, attributes)
+        of the announce as parsed by fbgp.exabgp_parser, to catch later duplicates."""
+        self._received[prefix_key(prefix)] = received
         attributes = dict(
             from_as=self.peer_as,
             from_peer=self.peer_ip,
@@ -170,36 +437,108 @@ class BgpPeer:
         )
         attributes.update(others)
         route = Route(prefix, nexthop, as_path, origin, **attributes)
-        if prefix in self._rib_in and self._rib_in[prefix] == route:
-            return
+        self._stale.discard(prefix)
+        if prefix in self._rib_in:
+            if self._rib_in[prefix] == route:
+                return
+        else:
+            self._account(1)
         self._rib_in[prefix] = route
-        return self.import_policy.evaluate(route)
+        route = self.import_policy.evaluate(route)
+        if route:
+            self._rib_in_post[prefix] = route
+        else:
+            self._rib_in_post.pop(prefix, None)
+        return route
+
+    def accepted(self, prefix):
+        """Return the route of a prefix accepted by the import policy."""
+        return self._rib_in_post.get(prefix)
+
+    def reevaluate_import(self, prefix):
+        """Run the route received for a prefix through the import policy again.
+        Returns the previous and the new post-policy routes, the previous one is
+        returned as the new one if the policy result has not changed."""
+        old = self._rib_in_post.get(prefix)
+        route = self._rib_in.get(prefix)
+        new = self.import_policy.evaluate(route) if route else None
+        if new is None:
+            self._rib_in_post.pop(prefix, None)
+        elif old is not None and new == old:
+            new = old
+        else:
+            self._rib_in_post[prefix] = new
+        return old, new
 
     def withdraw(self, route):
-        """Withdraw a route previously announced to this peer."""
+        """Withdraw a route previously announced to this peer, return it as it was announced."""
         if route is None:
             return
         if route.prefix in self._rib_out:
-            return self._rib_out.pop(route.prefix)
+            return RouteView(route, self._rib_out.pop(route.prefix))
 
-    def announce(self, route):
-        """Announce a route to this peer."""
+    def export_route(self, route):
+        """Return the route as it would be announced to this peer, None if it is not."""
         # if the peer is internal, announce all external routes but no internal ones
         # if the peer is external, announce all routes if the peer not in the as path
-        if route is None:
+        # routes are only announced to the sessions of their address family
+        if route is None or route.prefix.version != self.version:
             return
-        if ((self.ibgp and not route.from_ibgp) or
-                (not self.ibgp and self.peer_as not in route.as_path[:1])):
-            out = self.export_policy.evaluate(route.copy())
-        else:
-            out = None
+        if self.ibgp:
+            if route.from_ibgp:
+                return
+        elif route.as_path and route.as_path[0] == self.peer_as:
+            return
+        out = self.export_policy.evaluate(route)
+        if out is None:
+            return
+        attributes = out.attributes()
+        if self.as_prepend:
+            attributes = _prepend(attributes, self.as_prepend)
+        return RouteView(out, attributes)
+
+    def announce(self, route):
+        """Announce a route to this peer."""
+        out = self.export_route(route)
         if out:
-            if self.local_as != self.peer_as:
-                out.as_path = [self.local_as] + out.as_path
-                out.local_pref = None
-            self._rib_out[out.prefix] = out
+            self._rib_out[out.prefix] = out.attributes
         return out
 
+    def announce_paths(self, prefix, paths):
+        """Make [(path_id, route, gateway)], ranked best first, the paths of a prefix
+        announced to this ADD-PATH peer. Returns the (path_id, route, gateway) to announce
+        and the (path_id, route) to withdraw."""
+        current = self._rib_out_paths.pop(prefix, {})
+        new = {}
+        announce = []
+        for path_id, route, gateway in paths[:self.add_path]:
+            out = self.export_route(route)
+            if out is None or path_id in new:
+                continue
+            new[path_id] = (out, gateway)
+            if current.get(path_id) != (out, gateway):
+                announce.append((path_id, out, gateway))
+        withdraw = [(path_id, out) for path_id, (out, _) in current.items() if path_id not in new]
+        if new:
+            self._rib_out_paths[prefix] = new
+            self._rib_out[prefix] = next(iter(new.values()))[0].attributes
+        else:
+            self._rib_out.pop(prefix, None)
+        return announce, withdraw
+
+    def queue_update(self, route, gateway=None, withdraw=False):
+        """Queue an update until the MRAI expires, it replaces any queued update of the prefix."""
+        first = not self._pending
+        self._pending[route.prefix] = (route, gateway, withdraw)
+        if first and self.pending_handler:
+            self.pending_handler(self)
+
+    def pop_pending(self):
+        """Return and clear the queued updates."""
+        pending = self._pending
+        self._pending = {}
+        return pending.values()
+
     def routes(self):
         return self._rib_in.values()
 
@@ -259,11 +598,6 @@ class BgpRouter():
                     return route1
                 if op(val2, val1):
                     return route2
-
-            if not route1.internal:
-                return route1
-            if not route2.internal:
-                return route2
             return route1
 
         best_route = None
@@ -282,19 +616,32 @@ class BgpRouter():
         if new_best:
             self.best_routes[prefix] = new_best
         else:
-            del self.best_routes[prefix]
+            self.best_routes.pop(prefix, None)
 
         if len(self.loc_rib[prefix]) == 0:
             del self.loc_rib[prefix]
 
         return new_best, best_route
 
+    def _insert_route(self, route):
+        """Add a route to loc_rib. Return the routes it replaces: a new route
+        from a peer implicitly withdraws the previous one."""
+        routes = self.loc_rib[route.prefix]
+        replaced = [r for r in routes if r.from_peer is not None and r.from_peer == route.from_peer]
+        for r in replaced:
+            routes.discard(r)
+        routes.add(route)
+        return replaced
+
     def add_route(self, route):
         prefix = route.prefix
-        self.loc_rib[prefix].add(route)
-
         best_route = self.best_routes.get(prefix)
-        new_best = self._select_best_route([best_route, route])
+        replaced = self._insert_route(route)
+
+        if any(r is best_route for r in replaced):
+            new_best = self._select_best_route(self.loc_rib[prefix])
+        else:
+            new_best = self._select_best_route([best_route, route])
 
         if new_best and new_best != best_route:
             self.best_routes[prefix] = new_best
@@ -303,8 +650,49 @@ class BgpRouter():
 
         return new_best, best_route
 
+    def apply_changes(self, changes):
+        """Apply a batch of (route, withdraw) changes in order.
+        Returns a list of (new_best, cur_best), one for each change."""
+        results = []
+        for route, withdraw in changes:
+            if withdraw:
+                results.append(self.del_route(route))
+            else:
+                results.append(self.add_route(route))
+        return results
+
+    def select_paths(self, prefix, max_paths, exclude_peer=None):
+        """Return up to max_paths routes of a prefix, ranked by the selection: the
+        best route first, then the best of the remaining routes, and so on. Routes
+        from exclude_peer are left out."""
+        best = self.best_routes.get(prefix)
+        routes = [route for route in self.loc_rib.get(prefix, ())
+                  if route is not best and (exclude_peer is None or route.from_peer != exclude_peer)]
+        paths = []
+        if best is not None and (exclude_peer is None or best.from_peer != exclude_peer):
+            paths.append(best)
+        while routes and len(paths) < max_paths:
+            route = self._select_best_route(routes)
+            paths.append(route)
+            routes = [other for other in routes if other is not route]
+        return paths
+
+    def set_best_route(self, route):
+        """Use route as the best route of its prefix (e.g. as instructed by the route server)."""
+        self.best_routes[route.prefix] = route
+
+    def load_routes(self, routes):
+        """Put back (route, best) restored from a snapshot, without running the selection."""
+        for route, best in routes:
+            self.loc_rib[route.prefix].add(route)
+            if best:
+                self.best_routes[route.prefix] = route
+
+    def stop(self):
+        pass
+
     @staticmethod
-    def announce(peer, route, gateway=None):
+    def _announce(peer, route, gateway=None):
         msgs = []
         route = peer.announce(route)
         if route:
@@ -312,9 +700,74 @@ class BgpRouter():
         return msgs
 
     @staticmethod
-    def withdraw(peer, route):
+    def _withdraw(peer, route):
         msgs = []
         route = peer.withdraw(route)
         if route:
             msgs.append(route.to_exabgp(peer, is_withdraw=True))
         return msgs
+
+    @classmethod
+    def announce(cls, peer, route, gateway=None):
+        if peer.mrai and route is not None:
+            peer.queue_update(route, gateway)
+            return []
+        return cls._announce(peer, route, gateway)
+
+    @classmethod
+    def withdraw(cls, peer, route):
+        if peer.mrai and route is not None:
+            peer.queue_update(route, withdraw=True)
+            return []
+        return cls._withdraw(peer, route)
+
+    @staticmethod
+    def announce_paths(peer, prefix, paths):
+        """Send the (path_id, route, gateway) paths of a prefix to an ADD-PATH peer,
+        only the paths that changed are announced or withdrawn."""
+        return BgpRouter.path_updates(peer, *peer.announce_paths(prefix, paths))
+
+    @staticmethod
+    def path_updates(peer, announce, withdraw):
+        """Return the messages of the paths BgpPeer.announce_paths returned."""
+        msgs = []
+        for path_id, route, gateway in announce:
+            msgs.append(route.to_exabgp(peer, gw=gateway, path_id=path_id))
+        for path_id, route in withdraw:
+            msgs.append(route.to_exabgp(peer, is_withdraw=True, path_id=path_id))
+        return msgs
+
+    @staticmethod
+    def announce_group(peers, route, gateway):
+        """Announce a route to the peers of an update group: they export it the same
+        way, so it is exported once and sent to all of them in one message. The prefix
+        is withdrawn from them if they do not export the route."""
+        out = peers[0].export_route(route)
+        if out is None:
+            return BgpRouter.withdraw_group(peers, route)
+        for peer in peers:
+            peer._rib_out[route.prefix] = out.attributes
+        return [_neighbors(peers) + out.to_exabgp(gw=gateway)]
+
+    @staticmethod
+    def withdraw_group(peers, route):
+        """Withdraw the prefix of a route from the peers of an update group it was
+        announced to, in one message."""
+        withdrawn = [peer for peer in peers if route.prefix in peer._rib_out]
+        if not withdrawn:
+            return []
+        out = RouteView(route, withdrawn[0]._rib_out[route.prefix])
+        for peer in withdrawn:
+            del peer._rib_out[route.prefix]
+        return [_neighbors(withdrawn) + out.to_exabgp(is_withdraw=True)]
+
+    @classmethod
+    def flush_updates(cls, peer):
+        """Return the messages of the net updates queued for a peer during the MRAI."""
+        msgs = []
+        for route, gateway, withdraw in peer.pop_pending():
+            if withdraw:
+                msgs.extend(cls._withdraw(peer, route))
+            else:
+                msgs.extend(cls._announce(peer, route, gateway))
+        return msgs
@@ -0,0 +1,147 @@
+"""Route flap damping (RFC 2439) per (peer, prefix).
+
+Each flap adds a penalty to the (peer, prefix) entry, the penalty decays
+exponentially with the configured half-life and is only recomputed when the
+entry is accessed. An entry whose penalty goes over the suppress limit is
+suppressed: the route is kept in the peer's Adj-RIB-In but not used. A
+suppressed entry gets a timer for the time its penalty falls under the reuse
+limit, the timer wheel plays the role of the RFC's reuse lists.
+"""
+import math
+import logging
+
+
+class FlapState:
+    """Damping state of a (peer, prefix)."""
+
+    __slots__ = ('penalty', 'updated', 'suppressed')
+
+    def __init__(self, now):
+        self.penalty = 0.0
+        self.updated = now
+        self.suppressed = False
+
+
+class Damping:
+    """Flap damping of the routes received from all peers."""
+
+    def __init__(self, reuse_handler, timers, half_life=900, reuse=750, suppress=2000,
+                 max_suppress_time=3600, withdraw_penalty=1000, change_penalty=500):
+        """
+        Args:
+            reuse_handler: called with (peer_ip, prefix) when a suppressed route can be used again
+            timers: the TimerWheel running the reuse timers
+            half_life: seconds for the penalty to decay by half
+            reuse: penalty under which a suppressed route is used again
+            suppress: penalty over which a route is suppressed
+            max_suppress_time: max seconds a route stays suppressed, it caps the penalty
+            withdraw_penalty: penalty added when a route is withdrawn
+            change_penalty: penalty added when a route is re-announced with different attributes
+        """
+        self.logger = logging.getLogger('fbgp.damping')
+        self.reuse_handler = reuse_handler
+        self.half_life = half_life
+        self.reuse = reuse
+        self.suppress = suppress
+        self.ceiling = reuse * 2 ** (max_suppress_time / half_life)
+        self.withdraw_penalty = withdraw_penalty
+        self.change_penalty = change_penalty
+        self.timers = timers
+        self.clock = timers.clock
+        self._decay_rate = math.log(2) / half_life
+        self._states = {} # (peer_ip, prefix) -> FlapState
+        self._reuse_timers = {} # (peer_ip, prefix) -> reuse timer of a suppressed entry
+        self._gc_timer = timers.every(half_life, self._gc)
+        self.suppressed_count = 0
+        self.suppressed_total = 0
+        self.reused_total = 0
+
+    def _penalty(self, state, now):
+        """Decay the penalty of state up to now."""
+        if now > state.updated:
+            state.penalty *= math.exp(-self._decay_rate * (now - state.updated))
+            state.updated = now
+        return state.penalty
+
+    def _add_penalty(self, key, penalty):
+        now = self.clock()
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = FlapState(now)
+        state.penalty = min(self._penalty(state, now) + penalty, self.ceiling)
+        if not state.suppressed and state.penalty > self.suppress:
+            state.suppressed = True
+            self.suppressed_count += 1
+            self.suppressed_total += 1
+            self._schedule_reuse(key, state)
+            self.logger.info('suppressed route to %s from %s (penalty %d)' % (
+                key[1], key[0], state.penalty))
+        return state.suppressed
+
+    def _schedule_reuse(self, key, state):
+        """Start the timer of a suppressed entry for the time it becomes reusable."""
+        delay = math.log(state.penalty / self.reuse) / self._decay_rate
+        self._reuse_timers[key] = self.timers.schedule(delay, self._reuse, key)
+
+    def _reuse(self, key):
+        self._reuse_timers.pop(key, None)
+        state = self._states.get(key)
+        if state is None or not state.suppressed:
+            return
+        if self._penalty(state, self.clock()) < self.reuse:
+            state.suppressed = False
+            self.suppressed_count -= 1
+            self.reused_total += 1
+            self.reuse_handler(*key)
+        else:
+            self._schedule_reuse(key, state)
+
+    def withdraw(self, peer_ip, prefix):
+        """Account a withdraw. Returns True if the route is suppressed."""
+        return self._add_penalty((peer_ip, prefix), self.withdraw_penalty)
+
+    def announce(self, peer_ip, prefix, changed=False):
+        """Account an announcement, changed is True if it replaces a route of the peer.
+        Returns True if the route can be used, False if it is suppressed."""
+        key = (peer_ip, prefix)
+        if changed:
+            return not self._add_penalty(key, self.change_penalty)
+        state = self._states.get(key)
+        return state is None or not state.suppressed
+
+    def is_suppressed(self, peer_ip, prefix):
+        state = self._states.get((peer_ip, prefix))
+        return state is not None and state.suppressed
+
+    def suppressed_routes(self):
+        """Return the (peer_ip, prefix) of the suppressed entries."""
+        return [key for key, state in self._states.items() if state.suppressed]
+
+    def peer_down(self, peer_ip):
+        """Forget the entries of a peer whose session went down, and stop their reuse
+        timers: the routes are gone with the session."""
+        for key in [key for key in self._states if key[0] == peer_ip]:
+            timer = self._reuse_timers.pop(key, None)
+            if timer:
+                timer.cancel()
+            if self._states.pop(key).suppressed:
+                self.suppressed_count -= 1
+
+    def _gc(self):
+        """Forget the entries whose penalty has decayed enough."""
+        now = self.clock()
+        for key, state in list(self._states.items()):
+            if not state.suppressed and self._penalty(state, now) < self.reuse / 2:
+                del self._states[key]
+
+    def stats(self):
+        return {'damping_entries': len(self._states),
+                'damping_suppressed': self.suppressed_count,
+                'damping_suppressed_total': self.suppressed_total,
+                'damping_reused_total': self.reused_total}
+
+    def stop(self):
+        self._gc_timer.cancel()
+        for timer in self._reuse_timers.values():
+            timer.cancel()
+        self._reuse_timers = {}
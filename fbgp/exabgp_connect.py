@@ -1,8 +1,8 @@
 """Start ExaBGP as subprocess, communicate with it via netcat to send route update
 """
 import eventlet
-eventlet.monkey_patch()
 
+import re
 import subprocess
 import shutil
 import time
@@ -16,10 +16,21 @@ import logging
 from threading import Lock
 from multiprocessing.connection import Listener
 
-from fbgp.cfg import CONF
+from eventlet import tpool
+from eventlet import event
+
+from fbgp.exabgp_parser import ParserPool
+from fbgp.fair_queue import FairQueue
+
+_PEER_RE = re.compile(r'"peer"\s*:\s*"([^"]+)"')
 
 
 class ExaBgpConnect():
+    PARSE_BATCH = 1024 # max messages handed to the parser pool at once
+    SEND_BATCH = 1024 # max messages joined in one write to the hook
+    START_TIMEOUT = 30 # max seconds for ExaBGP to start its api process
+    RECV_QUANTUM = 16384 # bytes of messages served from a peer's queue per round
+    RECV_MAX_QUEUED = 65536 # max messages queued over all the peers before reading blocks
     config = """
 process send_receive {
     run %s %s;
@@ -35,7 +46,10 @@ neighbor %s {
     local-as %s;
     hold-time 180;
     router-id %s;
-    api {
+    family {
+        %s;
+    }
+%s    api {
         processes [send_receive];
         neighbor-changes;
         receive {
@@ -45,6 +59,10 @@ neighbor %s {
     }
 }
     """
+    add_path_config = """    capability {
+        add-path send;
+    }
+"""
 
     def __init__(self, handler, peers, routerid):
         self.logger = logging.getLogger('fbgp.exabgp_connect')
@@ -52,10 +70,16 @@ neighbor %s {
         self.peers = peers
         self.routerid = routerid
         self.conn = None
+        self.listening = event.Event() # sent when the listener is bound
+        self.connected = event.Event() # sent when exabgp_hook connects
+        self.started = event.Event() # sent True when ExaBGP is running, False if it exited
+        self.startup_phases = [] # (phase, seconds) of the last start
         self.exabgp = None
         self.running = False
-        self.recv_queue = eventlet.Queue(256)
+        self.recv_queue = FairQueue(self.RECV_QUANTUM, self.RECV_MAX_QUEUED)
         self.send_queue = eventlet.Queue(256)
+        self.num_parsers = int(os.environ.get('FBGP_PARSERS', 0))
+        self.parser_pool = None
 
     def _clean(self):
         pass
@@ -67,83 +91,156 @@ neighbor %s {
             pass
         self.logger.info('starting ExaBGP listener...')
         with Listener(self.sock_path, 'AF_UNIX') as listener:
+            self.listening.send()
             self.conn = listener.accept()
+            self.connected.send()
+            # the hook is started by ExaBGP once its configuration is loaded
+            self._phase('hook connected')
+            if not self.started.ready():
+                self.started.send(True)
             self.logger.info('exabgp_hook connected')
+            first = True
             while self.running:
                 try:
                     data = self.conn.recv()
                     if data:
-                        self.recv_queue.put(data)
+                        if first:
+                            first = False
+                            self._phase('first message')
+                            self.logger.info('first message from ExaBGP %.3fs after start' % (
+                                time.time() - self._start_time))
+                        # queued per peer, messages that are not about a peer share one queue
+                        match = _PEER_RE.search(data)
+                        self.recv_queue.put(match.group(1) if match else None, data, len(data))
                 except:
                     break
 
+    def _phase(self, name):
+        """Record the time spent in a startup phase, since the previous one."""
+        now = time.time()
+        self.startup_phases.append((name, now - self._phase_time))
+        self._phase_time = now
+
+    def _wait_exabgp(self):
+        returncode = tpool.execute(self.exabgp.wait)
+        if not self.started.ready():
+            self.started.send(False)
+        if self.running:
+            self.logger.error('ExaBGP exited, return code: %s' % returncode)
+
     def _process_msg(self):
         while self.running:
-            msg = self.recv_queue.get()
-            try:
-                self.handler(msg)
-            except Exception as e:
-                self.logger.error('Error %s when handling %s' % (e, msg))
-                pass
+            if self.parser_pool:
+                # parse what can be served in the pool, the handler gets messages in the same order
+                msgs = self.recv_queue.get_batch(self.PARSE_BATCH)
+                msgs = tpool.execute(self.parser_pool.parse_batch, msgs)
+            else:
+                msgs = [self.recv_queue.get()]
+            for msg in msgs:
+                try:
+                    self.handler(msg)
+                except Exception as e:
+                    self.logger.error('Error %s when handling %s' % (e, msg))
 
     def _send(self):
+        self.connected.wait()
         while self.running:
             try:
-                if self.conn:
-                    msg = self.send_queue.get()
-                    self.conn.send(msg)
-                    self.logger.debug('sent msg <%s> to ExaBGP' % msg)
-                else:
-                    time.sleep(1)
+                # what is queued goes out as one buffer, the hook writes it as lines
+                msgs = [self.send_queue.get()]
+                while len(msgs) < self.SEND_BATCH and not self.send_queue.empty():
+                    msgs.append(self.send_queue.get_nowait())
+                self.conn.send('\n'.join(msgs))
+                self.logger.debug('sent %s msgs to ExaBGP' % len(msgs))
             except Exception as e:
                 self.logger.error('error %s when sending msg to ExaBGP hook' % e)
 
     def start(self):
         self.logger.info('starting ExaBGP...')
         self.running = True
+        self._start_time = self._phase_time = time.time()
+        self.startup_phases = []
         self.exabgp_cfg_file = os.environ.get('FBGP_EXABGP_CONFIG', '/etc/fbgp/exabgp.conf')
         self.sock_path = os.environ.get('FBGP_EXABGP_SOCK', '/var/log/fbgp/exabgp_hook.sock')
         self.exabgp_hook_log = os.environ.get('FBGP_EXABGP_HOOK_LOG', '/var/log/fbgp/exabgp_hook.log')
         log_level = os.environ.get('FBGP_LOG_LEVEL', 'INFO').upper()
+        if self.num_parsers:
+            self.parser_pool = ParserPool(self.num_parsers)
         eventlet.spawn(self._process_msg)
         eventlet.spawn(self._send)
         eventlet.spawn(self._run)
-        time.sleep(5) # wait for the listener to start
+        with eventlet.Timeout(self.START_TIMEOUT, False):
+            self.listening.wait()
+        if not self.listening.ready():
+            self.logger.error('ExaBGP listener failed to start on %s' % self.sock_path)
+            return None
+        self._phase('listener')
         self.logger.info('ExaBGP listener started')
-        # locate exabgp_hook
-        hook = subprocess.run(['which', 'fbgp_exabgp_hook'], stdout=subprocess.PIPE)
-        hook_loc = hook.stdout.decode('utf-8').strip()
-        with open(self.exabgp_cfg_file, 'w') as f:
-            f.write(self.config % (hook_loc, self.sock_path))
-            for peer in self.peers.values():
-                peer_config = self.peer_config % (
-                    peer.peer_ip, peer.peer_port, peer.peer_as,
-                    peer.local_ip, peer.local_as, self.routerid)
-                f.write(peer_config + '\n')
+        hook_loc = shutil.which('fbgp_exabgp_hook')
+        if hook_loc is None:
+            self.logger.error('fbgp_exabgp_hook not found in PATH')
+            return None
+        self.hook_loc = hook_loc
+        self._write_config()
+        self.update_rates()
+        self._phase('config')
         self.exabgp = subprocess.Popen(
             ['env', 'exabgp.tcp.bind=' + '0.0.0.0', 'exabgp.tcp.port=' + '9179',
              'exabgp.daemon.daemonize=false', 'exabgp.daemon.user=root',
              'exabgp.log.level=' + log_level, 'exabgp.log.all=true',
              'exabgp.log.destination=' + self.exabgp_hook_log,
              'exabgp', self.exabgp_cfg_file],
-             stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._phase('spawn')
         self.logger.info('started ExaBGP subprocess')
-        try:
-            (dout, derr) = self.exabgp.communicate(timeout=30)
-            self.logger.info(derr)
-        except subprocess.TimeoutExpired as e:
-            self.logger.info('ExaBGP is running')
-        except Exception as e:
-            returncode = self.exabgp.poll()
-            self.logger.error('ExaBGP failed to start, return code: %s, exec: %s' % (returncode, type(e)))
+        eventlet.spawn(self._wait_exabgp)
+        started = None
+        with eventlet.Timeout(self.START_TIMEOUT, False):
+            started = self.started.wait()
+        if not started:
+            self.logger.error('ExaBGP failed to start, return code: %s' % self.exabgp.poll())
+            return None
+        self.logger.info('ExaBGP is running, ready in %.3fs (%s)' % (
+            time.time() - self._start_time,
+            ', '.join('%s %.3fs' % phase for phase in self.startup_phases)))
         return self.exabgp
 
+    def _write_config(self):
+        with open(self.exabgp_cfg_file, 'w') as f:
+            f.write(self.config % (self.hook_loc, self.sock_path))
+            for peer in self.peers.values():
+                peer_config = self.peer_config % (
+                    peer.peer_ip, peer.peer_port, peer.peer_as,
+                    peer.local_ip, peer.local_as, self.routerid,
+                    'ipv%s unicast' % peer.peer_ip.version,
+                    self.add_path_config if peer.add_path else '')
+                f.write(peer_config + '\n')
+
+    def update_rates(self):
+        """Apply the max update rates of the peers to their input queues."""
+        for peer in self.peers.values():
+            self.recv_queue.set_rate(str(peer.peer_ip), peer.max_update_rate)
+
+    def reload(self):
+        """Write the config of the current peers and make ExaBGP reload it,
+        sessions of unchanged neighbors are kept."""
+        self._write_config()
+        self.update_rates()
+        self.send('reload')
+        self.logger.info('ExaBGP config reloaded')
+
     def stop(self):
         """stop Exabgp running in the subprocess."""
         self.running = False
         if self.exabgp:
             os.kill(self.exabgp.pid, signal.SIGTERM)
+        if self.parser_pool:
+            self.parser_pool.stop()
         self._clean()
 
+    def queue_stats(self):
+        """Depth and wait time of the input queue of each peer."""
+        return self.recv_queue.stats()
+
     def send(self, msg):
         self.send_queue.put(msg)
@@ -0,0 +1,135 @@
+"""Parse ExaBGP JSON messages into compact tuples.
+
+Parsing is stateless, so it can run in a pool of worker processes in front of
+the fbgp handler (see ParserPool). A parsed message is one of:
+
+    (MSG_UPDATE, peer, attributes, announce, withdraw)
+    (MSG_STATE, peer, state)
+    (MSG_EOR, peer)
+    (MSG_ERROR, line, error)
+    None, for messages fbgp ignores
+
+peer and nexthops are (version, int) addresses, prefixes (version, int, prefixlen).
+attributes is an interned (origin, as_path, med, local_pref, community) tuple,
+announce a tuple of (nexthop, prefixes) and withdraw a tuple of prefixes.
+"""
+import json
+import socket
+import logging
+import ipaddress
+import multiprocessing
+
+MSG_UPDATE = 0
+MSG_STATE = 1
+MSG_EOR = 2
+MSG_ERROR = 3
+
+FAMILIES = ('ipv4 unicast', 'ipv6 unicast')
+MAX_INTERNED = 65536
+
+_ADDR_CLS = {4: ipaddress.IPv4Address, 6: ipaddress.IPv6Address}
+_NETWORK_CLS = {4: ipaddress.IPv4Network, 6: ipaddress.IPv6Network}
+_interned = {}
+
+
+def intern_attributes(attributes):
+    """Return the shared copy of an attributes tuple."""
+    if len(_interned) >= MAX_INTERNED:
+        _interned.clear()
+    return _interned.setdefault(attributes, attributes)
+
+
+def _freeze(value):
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _addr(addr):
+    # inet_pton is much faster than ipaddress for IPv6
+    if ':' in addr:
+        return (6, int.from_bytes(socket.inet_pton(socket.AF_INET6, addr), 'big'))
+    return (4, int.from_bytes(socket.inet_pton(socket.AF_INET, addr), 'big'))
+
+
+def _prefix(nlri):
+    addr, prefixlen = nlri.split('/')
+    version, addr = _addr(addr)
+    prefixlen = int(prefixlen)
+    host_bits = (32 if version == 4 else 128) - prefixlen
+    if prefixlen < 0 or host_bits < 0 or addr & ((1 << host_bits) - 1):
+        raise ValueError('%s is not a valid prefix' % nlri)
+    return (version, addr, prefixlen)
+
+
+def to_address(addr):
+    """Return the ipaddress object of a parsed (version, int) address."""
+    return _ADDR_CLS[addr[0]](addr[1])
+
+
+def to_network(prefix):
+    """Return the ipaddress network of a parsed (version, int, prefixlen) prefix."""
+    return _NETWORK_CLS[prefix[0]]((prefix[1], prefix[2]))
+
+
+def _parse_update(peer, update):
+    attributes = update.get('attribute', {})
+    as_path = attributes.get('as-path')
+    attributes = intern_attributes((
+        attributes.get('origin'), None if as_path is None else tuple(as_path),
+        attributes.get('med'), attributes.get('local-preference'),
+        _freeze(attributes.get('communities'))))
+    announce = []
+    withdraw = []
+    for family in FAMILIES:
+        for nexthop, nlris in update.get('announce', {}).get(family, {}).items():
+            announce.append((_addr(nexthop), tuple(_prefix(nlri['nlri']) for nlri in nlris)))
+        withdraw.extend(_prefix(nlri['nlri']) for nlri in update.get('withdraw', {}).get(family, []))
+    return (MSG_UPDATE, peer, attributes, tuple(announce), tuple(withdraw))
+
+
+def parse(line):
+    """Parse a raw ExaBGP JSON line. Never raises, errors are returned as MSG_ERROR."""
+    if line in ['done', 'error'] or not line:
+        return None
+    try:
+        msg = json.loads(line)
+        if msg.get('type') == 'notification':
+            #TODO: handle notification
+            return None
+        neighbor = msg.get('neighbor', {})
+        if not neighbor or neighbor.get('direction') == 'send':
+            return None
+        peer = _addr(neighbor['address']['peer'])
+        if msg.get('type') == 'update':
+            message = neighbor['message']
+            if 'update' in message:
+                return _parse_update(peer, message['update'])
+            if 'eor' in message:
+                return (MSG_EOR, peer)
+        elif msg.get('type') == 'state':
+            return (MSG_STATE, peer, 'up' if neighbor['state'] == 'up' else 'down')
+    except Exception as e:
+        return (MSG_ERROR, line, str(e))
+    return None
+
+
+class ParserPool:
+    """Parse ExaBGP lines in a pool of worker processes, results keep the order of the lines."""
+
+    def __init__(self, num_workers, chunksize=64):
+        self.logger = logging.getLogger('fbgp.exabgp_parser')
+        self.chunksize = chunksize
+        self.pool = multiprocessing.get_context('spawn').Pool(num_workers)
+        self.logger.info('started %s ExaBGP parser workers' % num_workers)
+
+    def parse_batch(self, lines):
+        # tuples shared inside a chunk stay shared once unpickled, intern them across chunks
+        msgs = self.pool.map(parse, lines, self.chunksize)
+        for idx, msg in enumerate(msgs):
+            if msg and msg[0] == MSG_UPDATE:
+                msgs[idx] = msg[:2] + (intern_attributes(msg[2]),) + msg[3:]
+        return msgs
+
+    def stop(self):
+        self.pool.terminate()
@@ -0,0 +1,160 @@
+"""Per-peer input queues drained by deficit round robin.
+
+Messages from ExaBGP are queued per key (the peer they come from), the queues
+with messages are served in turn: each visit adds quantum to the deficit of the
+queue, and messages are served while their cost (the length of the line) fits
+in the deficit. A peer dumping a full table gets its share of the handler and
+the updates of the other peers wait at most one round.
+
+A key can have a rate cap in messages per second, enforced by a token bucket
+with a burst of one second. A capped queue is skipped while it has no token,
+its messages are delayed, never dropped.
+"""
+import time
+import collections
+
+
+class FairQueue:
+    """Queues of messages per key, drained fairly by get()/get_batch()."""
+
+    def __init__(self, quantum=16384, maxsize=0, clock=time.monotonic):
+        self.quantum = quantum
+        self.maxsize = maxsize # max messages queued in total, 0 is unlimited
+        self.clock = clock
+        self.size = 0
+        self._queues = {} # key -> deque of (item, cost, enqueue time)
+        self._active = collections.deque() # keys with queued messages, in serving order
+        self._granted = False # the quantum was given to the key at the front for this visit
+        self._deficit = {}
+        self._rates = {} # key -> max messages per second
+        self._buckets = {} # key -> [tokens, last refill]
+        self._stats = {} # key -> [served, wait total, wait max]
+        self._ready = None # event the getter waits on
+        self._space = None # event the putter waits on when maxsize is reached
+
+    def __len__(self):
+        return self.size
+
+    def set_rate(self, key, rate):
+        """Cap the messages served from key per second, 0 removes the cap."""
+        if rate:
+            self._rates[key] = rate
+            self._buckets.setdefault(key, [rate, self.clock()])
+        else:
+            self._rates.pop(key, None)
+            self._buckets.pop(key, None)
+
+    def put(self, key, item, cost=1):
+        """Queue an item, waits for room if maxsize messages are queued."""
+        while self.maxsize and self.size >= self.maxsize:
+            self._wait('_space')
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = collections.deque()
+            self._deficit[key] = 0
+        if not queue:
+            self._active.append(key)
+        queue.append((item, cost, self.clock()))
+        self.size += 1
+        self._wake('_ready')
+
+    def pop(self):
+        """Return the next item, None if nothing can be served now."""
+        now = self.clock()
+        throttled = 0
+        while self._active and throttled < len(self._active):
+            key = self._active[0]
+            if not self._granted:
+                if not self._has_token(key, now):
+                    self._active.rotate(-1)
+                    throttled += 1
+                    continue
+                throttled = 0
+                self._deficit[key] += self.quantum
+                self._granted = True
+            queue = self._queues[key]
+            item, cost, enqueued = queue[0]
+            if cost > self._deficit[key] or not self._has_token(key, now):
+                self._active.rotate(-1)
+                self._granted = False
+                continue
+            queue.popleft()
+            self.size -= 1
+            self._deficit[key] -= cost
+            if key in self._buckets:
+                self._buckets[key][0] -= 1
+            if not queue:
+                self._active.popleft()
+                self._deficit[key] = 0
+                self._granted = False
+            stats = self._stats.setdefault(key, [0, 0.0, 0.0])
+            wait = now - enqueued
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+            self._wake('_space')
+            return item
+        return None
+
+    def _has_token(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return True
+        rate = self._rates[key]
+        bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        return bucket[0] >= 1
+
+    def next_ready(self):
+        """Return the seconds until an item can be served, None if the queues are empty."""
+        if not self._active:
+            return None
+        now = self.clock()
+        delays = []
+        for key in self._active:
+            if self._has_token(key, now):
+                return 0
+            delays.append((1 - self._buckets[key][0]) / self._rates[key])
+        return min(delays)
+
+    def get_batch(self, max_items):
+        """Return up to max_items items in serving order, waits for the first one."""
+        items = []
+        while not items:
+            while len(items) < max_items:
+                item = self.pop()
+                if item is None:
+                    break
+                items.append(item)
+            if not items:
+                # woken up by put, or when a capped queue gets a token
+                self._wait('_ready', self.next_ready())
+        return items
+
+    def get(self):
+        return self.get_batch(1)[0]
+
+    def _wait(self, name, timeout=None):
+        import eventlet
+        from eventlet import event
+        waiter = event.Event()
+        setattr(self, name, waiter)
+        with eventlet.Timeout(timeout, False):
+            waiter.wait()
+        setattr(self, name, None)
+
+    def _wake(self, name):
+        waiter = getattr(self, name)
+        if waiter is not None and not waiter.ready():
+            waiter.send()
+
+    def stats(self):
+        """Depth and wait time of the queue of each key."""
+        stats = {}
+        for key, queue in self._queues.items():
+            served, wait_total, wait_max = self._stats.get(key, (0, 0.0, 0.0))
+            stats[str(key)] = {
+                'depth': len(queue), 'served_total': served,
+                'wait_avg': round(wait_total / served, 6) if served else 0.0,
+                'wait_max': round(wait_max, 6)}
+        return stats
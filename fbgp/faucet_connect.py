@@ -1,7 +1,5 @@
-import eventlet
-eventlet.monkey_patch()
-
 import os
+import re
 import socket
 import json
 import logging
@@ -9,23 +7,33 @@ import traceback
 
 class FaucetConnect():
 
+    READ_SIZE = 65536 # bytes read from the event socket at a time
+    # event types we care about, everything else is dropped before decoding
+    EVENT_TYPES = (b'"L2_LEARN"', b'"L2_EXPIRE"')
+    # fields of the raw L2 events, read without decoding them
+    ETH_SRC_RE = re.compile(rb'"eth_src":\s*"([^"]*)"')
+    VID_RE = re.compile(rb'"vid":\s*(\d+)')
+    L3_SRC_IP_RE = re.compile(rb'"l3_src_ip":\s*"([^"]*)"')
+    PORT_NO_RE = re.compile(rb'"port_no":\s*(\d+)')
+
     def __init__(self, handler, faucet_sock_path=None):
         self.logger = logging.getLogger('fbgp.faucet_connect')
         self.handler = handler
         self.socket = None
-        self.sock_file = None
         self.running = False
+        self._buf = bytearray()
+        self._learned = {} # (eth_src, vid) -> (l3_src_ip, port_no) of the learns passed on
         sock_path = faucet_sock_path or os.environ.get('FAUCET_EVENT_SOCK')
         if sock_path:
             try:
                 self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
                 self.socket.connect(sock_path)
-                self.sock_file = self.socket.makefile('rb')
                 self.logger.info('connected to Faucet event')
             except Exception as e:
                 self.logger.error("Cannot connect to Faucet event: %s" % e)
 
     def start(self):
+        import eventlet
         self.logger.info('start faucet event listener')
         self.running = True
         return eventlet.spawn(self._faucet_event_loop)
@@ -37,24 +45,66 @@ class FaucetConnect():
         if self.socket:
             while self.running:
                 try:
-                    data = self.sock_file.readline()
-                    if data:
-                        data = data.decode('utf-8')
-                        self._process_faucet_event(data.strip())
+                    data = self.socket.recv(self.READ_SIZE)
                 except Exception as e:
                     self.logger.error('Lost connection to Faucet event: %s' % e)
                     break
+                if not data:
+                    self.logger.error('Lost connection to Faucet event: socket closed')
+                    break
+                self._feed(data)
             self.socket.close()
 
+    def _feed(self, data):
+        """Split a chunk read from the socket into events and process the relevant ones."""
+        buf = self._buf
+        buf += data
+        start = 0
+        end = buf.find(b'\n')
+        with memoryview(buf) as view:
+            while end >= 0:
+                if self._is_relevant(buf, start, end) and not self._is_repeat(buf, start, end):
+                    self._process_faucet_event(str(view[start:end], 'utf-8'))
+                start = end + 1
+                end = buf.find(b'\n', start)
+        del buf[:start]
+
+    def _is_relevant(self, buf, start, end):
+        """Check the raw bytes of an event for a type we handle, without decoding it."""
+        for event_type in self.EVENT_TYPES:
+            if buf.find(event_type, start, end) >= 0:
+                return True
+        return False
+
+    def _is_repeat(self, buf, start, end):
+        """Return True if the raw event is a L2_LEARN of a host already learned on the
+        same port, its (eth_src, vid) is forgotten when it expires."""
+        eth_src = self.ETH_SRC_RE.search(buf, start, end)
+        vid = self.VID_RE.search(buf, start, end)
+        if eth_src is None or vid is None:
+            return False
+        key = (eth_src.group(1), vid.group(1))
+        if buf.find(b'"L2_LEARN"', start, end) < 0:
+            self._learned.pop(key, None)
+            return False
+        l3_src_ip = self.L3_SRC_IP_RE.search(buf, start, end)
+        port_no = self.PORT_NO_RE.search(buf, start, end)
+        learned = (l3_src_ip and l3_src_ip.group(1), port_no and port_no.group(1))
+        if self._learned.get(key) == learned:
+            return True
+        self._learned[key] = learned
+        return False
+
+    def reset(self):
+        """Pass on the next L2_LEARN of every host, when the peers or borders changed."""
+        self._learned.clear()
+
     def _process_faucet_event(self, event):
         self.logger.debug('received faucet event: %s' % event)
         try:
             event = json.loads(event)
             if event['version'] != 1:
                 return
-            if 'L2_LEARN' in event or 'L2_EXPIRE' in event:
-                self.handler(event)
+            self.handler(event)
         except Exception as e:
             self.logger.error('Error when handling %s: %s' % (event, e))
-
-
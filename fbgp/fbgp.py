@@ -1,4 +1,8 @@
-"""
+"""The fBGP Ryu application.
+
+This is the entry point of the fbgp process, the only fbgp module that monkey
+patches. The connectors and the optional subsystems (snapshot, RIB export,
+sharding, flap damping) are imported when they are started or configured.
 """
 import eventlet
 eventlet.monkey_patch()
@@ -9,25 +13,44 @@ import time
 import traceback
 import json
 import ipaddress
-import yaml
-import socket
+import importlib
+import signal
 import collections
 
 from ryu.base import app_manager
 from ryu.controller.handler import set_ev_cls
-from ryu.lib import hub
 
-from fbgp.cfg import CONF
 from fbgp.utils import get_logger
-from fbgp.bgp import BgpPeer, BgpRouter, Border
-from fbgp.policy import Policy
-from fbgp.faucet_connect import FaucetConnect
-from fbgp.exabgp_connect import ExaBgpConnect
-from fbgp.server_connect import ServerConnect
+from fbgp.bgp import BgpPeer, BgpRouter, Border, RibBudget
+# not lazy: every peer gets the default (accept everything) policy in fbgp.bgp, and
+# the parser only costs its own module, re is already loaded by logging
+from fbgp.policy import Policy, PrefixRange, PrefixSet
+from fbgp import exabgp_parser
+from fbgp.timer import TimerWheel
 
 from faucet import faucet_experimental_api
 from faucet import faucet
 
+_CONNECTORS = {
+    'FaucetConnect': 'fbgp.faucet_connect',
+    'ExaBgpConnect': 'fbgp.exabgp_connect',
+    'ServerConnect': 'fbgp.server_connect',
+    }
+# the connector classes, imported by _load_connector when the app is initialized
+FaucetConnect = None
+ExaBgpConnect = None
+ServerConnect = None
+
+
+def _load_connector(name):
+    """Return a connector class, its module is imported on first use."""
+    value = globals()[name]
+    if value is None:
+        value = getattr(importlib.import_module(_CONNECTORS[name]), name)
+        globals()[name] = value
+    return value
+
+
 class FlowBasedBGP(app_manager.RyuApp):
     """An application runs on ExaBGP to process BGP routes received from peers."""
 
@@ -38,11 +61,23 @@ class FlowBasedBGP(app_manager.RyuApp):
     peers = None
     borders = None
     routerid = None
+    bgp = None
     faucet_connect = None # interface to Faucet
     exabgp_connect = None # interface to exabgp
     server_connect = None # interface to the route controller
+    rib_exporter = None # read-only RIB export for local consumers
+    damping = None # route flap damping, if configured
+    fib = None # FIB compression, if enabled
     current_pathid = 0
+    fib_generation = 0 # bumped on every FIB or vip mapping change pushed to the dataplane
+    duplicate_updates = 0 # announces dropped as identical to the route already received
+    noop_withdraws = 0 # withdraws dropped as no route was received for the prefix
+    routes_dropped = 0 # routes dropped over a max-prefix limit or the RIB budget
+    max_prefix_teardowns = 0 # sessions torn down over a max-prefix limit
     path_mapping = None # mapping between a peer and path, managed by the route server
+    PEER_SESSION_KEYS = ('peer_as', 'local_as', 'local_ip', 'peer_port', 'add_path') # a change resets the session
+    POLICY_BATCH = 2000 # routes re-evaluated per timer tick after a policy change
+    PEER_DOWN_BATCH = 2000 # routes of a peer gone down withdrawn per timer tick
 
     def __init__(self, *args, **kwargs):
         super(FlowBasedBGP, self).__init__(*args, **kwargs)
@@ -53,47 +88,298 @@ class FlowBasedBGP(app_manager.RyuApp):
         self.nexthop_to_pathid = {}
         self.path_mapping = collections.defaultdict(set)
         self.vip_assignment = {}
-        self.rcv_msg_q = eventlet.Queue(256)
+        self.timers = TimerWheel()
+        self._paced_runs = {} # key -> timer of the next batch of a paced run
+        self.start_time = time.time()
+        self.snapshot_file = os.environ.get('FBGP_SNAPSHOT')
+        self.snapshot_interval = int(os.environ.get('FBGP_SNAPSHOT_INTERVAL', 300))
+        self.stale_time = int(os.environ.get('FBGP_STALE_TIME', 120))
+        self.rib_export_file = os.environ.get('FBGP_RIB_EXPORT')
+        self.rib_export_interval = float(os.environ.get('FBGP_RIB_EXPORT_INTERVAL', 1))
+        self.num_workers = int(os.environ.get('FBGP_WORKERS', 0))
+        self.fib_compress = bool(int(os.environ.get('FBGP_FIB_COMPRESS', 0)))
 
     def stop(self):
         self.logger.info('%s is stopping...' % self.__class__.__name__)
+        if self.snapshot_file and self.bgp:
+            self._save_snapshot()
+        if self.rib_exporter:
+            self.rib_exporter.close()
+        if self.bgp:
+            self.bgp.stop()
+        self.timers.stop()
         super(FlowBasedBGP, self).stop()
         sys.exit()
 
-    def _load_config(self):
+    def _read_config(self):
         config_file = os.environ.get('FBGP_CONFIG', '/etc/fbgp/fbgp.yaml')
+        import yaml
+        with open(config_file, 'r') as f:
+            return yaml.safe_load(f.read())
+
+    def _new_peer(self, peer_conf):
+        """Create a peer from its config."""
+        peer_ip = ipaddress.ip_address(peer_conf['peer_ip'])
+        local_ip = peer_conf.get('local_ip')
+        local_ip = ipaddress.ip_address(local_ip) if local_ip else None
+        peer = BgpPeer(peer_ip=peer_ip,
+                       peer_as=peer_conf['peer_as'],
+                       local_ip=local_ip,
+                       local_as=peer_conf['local_as'],
+                       peer_port=peer_conf.get('peer_port', 179),
+                       mrai=peer_conf.get('mrai', 0),
+                       add_path=peer_conf.get('add_path', 0),
+                       max_prefix=peer_conf.get('max_prefix', 0),
+                       max_prefix_action=peer_conf.get('max_prefix_action', 'teardown'),
+                       budget=self.rib_budget,
+                       max_update_rate=peer_conf.get('max_update_rate', 0))
+        peer.import_policy = Policy.parse(peer_conf.get('import_policy'))
+        peer.export_policy = Policy.parse(peer_conf.get('export_policy'))
+        peer.pending_handler = self._updates_pending
+        for vlan in self.vlans.values():
+            if vlan.ip_in_vip_subnet(peer_ip):
+                peer.vlan = vlan
+                faucet_vips = vlan.faucet_vips_by_ipv(peer_ip.version)
+                if faucet_vips:
+                    peer.faucet_vip = list(faucet_vips)[0]
+        peer.set_export_context(self._nexthop_self(peer))
+        return peer
+
+    def _new_damping(self, damping_conf):
+        """Create the flap damping of its config, None if it is not configured."""
+        if damping_conf is None:
+            return None
+        from fbgp.damping import Damping
+        return Damping(self._route_reusable, self.timers, **damping_conf)
+
+    def _configure_damping(self, damping_conf, damping):
+        old_damping = self.damping
+        self.damping = damping
+        self.damping_conf = damping_conf
+        if old_damping:
+            old_damping.stop()
+            # the new damping starts without history, the suppressed routes are used again
+            for peer_ip, prefix in old_damping.suppressed_routes():
+                self._route_reusable(peer_ip, prefix)
+
+    def _load_config(self):
         self.vlans = {}
         for dp in [valve.dp for valve in self.valves.values()]:
             self.vlans.update(dp.vlans)
-        with open(config_file, 'r') as f:
-            config = yaml.safe_load(f.read())
-            self.import_policy = {}
-            self.export_policy = {}
-            self.routerid = ipaddress.ip_address(config['routerid'])
-            self.peers = {}
-            for peer_conf in config.pop('peers'):
-                peer_ip = ipaddress.ip_address(peer_conf['peer_ip'])
-                local_ip = peer_conf.get('local_ip')
-                local_ip = ipaddress.ip_address(local_ip) if local_ip else None
-                peer = BgpPeer(peer_ip=peer_ip,
-                               peer_as=peer_conf['peer_as'],
-                               local_ip=local_ip,
-                               local_as=peer_conf['local_as'],
-                               peer_port=peer_conf.get('peer_port', 179))
-                for vlan in self.vlans.values():
-                    if vlan.ip_in_vip_subnet(peer_ip):
-                        peer.vlan = vlan
-                        faucet_vips = vlan.faucet_vips_by_ipv(peer_ip.version)
-                        if faucet_vips:
-                            peer.faucet_vip = list(faucet_vips)[0]
-                self.peers[peer_ip] = peer
-            self.borders = {}
-            for border_conf in config.pop('borders'):
-                routerid = ipaddress.ip_address(border_conf['routerid'])
-                self.borders[routerid] = Border(
-                        routerid=routerid, nexthop=ipaddress.ip_address(border_conf['nexthop']))
+        config = self._read_config()
+        self.routerid = ipaddress.ip_address(config['routerid'])
+        self.rib_budget = RibBudget(config.get('rib_budget', 0))
+        self.peers = {}
+        self.peer_confs = {}
+        for peer_conf in config.pop('peers'):
+            peer = self._new_peer(peer_conf)
+            self.peers[peer.peer_ip] = peer
+            self.peer_confs[peer.peer_ip] = peer_conf
+        self.borders = {}
+        for border_conf in config.pop('borders'):
+            routerid = ipaddress.ip_address(border_conf['routerid'])
+            self.borders[routerid] = Border(
+                    routerid=routerid, nexthop=ipaddress.ip_address(border_conf['nexthop']))
+        if self.bgp:
+            self.bgp.stop()
+        if self.num_workers:
+            from fbgp.shard import ShardedBgpRouter
+            self.bgp = ShardedBgpRouter(
+                self.borders, self.peers, self.path_change_handler, self.num_workers)
+        else:
             self.bgp = BgpRouter(self.borders, self.peers, self.path_change_handler)
-            self.logger.info('config loaded')
+        self._configure_damping(config.get('damping'), self._new_damping(config.get('damping')))
+        self.logger.info('config loaded')
+
+    def reload_config(self):
+        """Apply the changes of the config file to the running state. Only the peers
+        and borders that changed are touched, sessions and RIBs of the others are kept,
+        and ExaBGP gets a new config only if a BGP session changed. The new peers and
+        policies are all parsed before anything is changed, a config that does not
+        parse is not applied."""
+        try:
+            config = self._read_config()
+            if ipaddress.ip_address(config['routerid']) != self.routerid:
+                self.logger.error('routerid changed, a restart is needed to apply it')
+            peer_confs = dict(
+                (ipaddress.ip_address(peer_conf['peer_ip']), peer_conf)
+                for peer_conf in config['peers'])
+            removed = [peer_ip for peer_ip, peer_conf in self.peer_confs.items()
+                       if peer_ip not in peer_confs or any(
+                           peer_confs[peer_ip].get(key) != peer_conf.get(key)
+                           for key in self.PEER_SESSION_KEYS)]
+            new_peers = {}
+            policies = {}
+            for peer_ip, peer_conf in peer_confs.items():
+                if peer_ip not in self.peers or peer_ip in removed:
+                    new_peers[peer_ip] = self._new_peer(peer_conf)
+                elif peer_conf != self.peer_confs[peer_ip]:
+                    policies[peer_ip] = (Policy.parse(peer_conf.get('import_policy')),
+                                         Policy.parse(peer_conf.get('export_policy')))
+            border_confs = dict(
+                (ipaddress.ip_address(border_conf['routerid']),
+                 ipaddress.ip_address(border_conf['nexthop']))
+                for border_conf in config['borders'])
+            damping_conf = config.get('damping')
+            damping = self.damping
+            if damping_conf != self.damping_conf:
+                damping = self._new_damping(damping_conf)
+        except Exception as e:
+            self.logger.error('Failed to read config for reload, the config is not changed: %s' % e)
+            return
+        try:
+            self._apply_config(config, peer_confs, removed, new_peers, policies,
+                               border_confs, damping_conf, damping)
+        except Exception as e:
+            self.logger.error('Failed to apply the reloaded config: %s\n%s' % (
+                e, traceback.format_exc()))
+            return
+        self.logger.info('config reloaded')
+
+    def _apply_config(self, config, peer_confs, removed, new_peers, policies,
+                      border_confs, damping_conf, damping):
+        """Apply a reloaded config parsed by reload_config."""
+        msgs = []
+        for peer_ip in removed:
+            msgs.extend(self._remove_peer(self.peers[peer_ip]))
+        for peer_ip, peer_conf in peer_confs.items():
+            if peer_ip in new_peers:
+                self.peers[peer_ip] = new_peers[peer_ip]
+                self.logger.info('Added peer %s' % peer_ip)
+            elif peer_ip in policies:
+                self._update_peer(self.peers[peer_ip], self.peer_confs[peer_ip], peer_conf,
+                                  *policies[peer_ip])
+            self.peer_confs[peer_ip] = peer_conf
+        for routerid in list(self.borders):
+            if routerid not in border_confs:
+                self._border_disconnected(self.borders.pop(routerid))
+        for routerid, nexthop in border_confs.items():
+            border = self.borders.get(routerid)
+            if border is None:
+                self.borders[routerid] = Border(routerid=routerid, nexthop=nexthop)
+            elif border.nexthop != nexthop:
+                border.nexthop = nexthop
+                border.disconnected()
+        self.rib_budget.limit = config.get('rib_budget', 0)
+        if damping is not self.damping:
+            self._configure_damping(damping_conf, damping)
+        for msg in msgs:
+            self._send_to_exabgp(msg)
+        if self.faucet_connect:
+            # the new peers and borders get connected by the next L2_LEARN of their host
+            self.faucet_connect.reset()
+        if (removed or new_peers) and self.exabgp_connect:
+            self.exabgp_connect.reload()
+        elif self.exabgp_connect:
+            self.exabgp_connect.update_rates()
+
+    def _remove_peer(self, peer):
+        """Remove a peer deleted from the config, or whose session parameters changed."""
+        msgs = self._peer_bgp_down(peer)
+        self._complete_paced(('down', peer.peer_ip))
+        # routes restored from a snapshot are kept while the session is down
+        msgs.extend(self._path_changes_handler(peer, [
+            (route, True) for route in peer._rib_in_post.values()
+            if any(candidate is route for candidate in self.bgp.loc_rib.get(route.prefix, ()))]))
+        # the restored routes of a peer that never came up are still in the RIB budget
+        peer.bgp_session_down()
+        if self.rib_exporter:
+            self.rib_exporter.peer_cleared(peer.peer_ip)
+        del self.peers[peer.peer_ip]
+        del self.peer_confs[peer.peer_ip]
+        for peers in self.path_mapping.values():
+            peers.discard(peer)
+        self.logger.info('Removed peer %s' % peer.peer_ip)
+        return msgs
+
+    def _update_peer(self, peer, old_conf, new_conf, import_policy, export_policy):
+        """Apply the policy and MRAI changes of a peer, re-evaluating the routes
+        of the policies that changed. The policies are parsed from new_conf."""
+        peer.mrai = new_conf.get('mrai', 0)
+        peer.max_prefix = new_conf.get('max_prefix', 0)
+        peer.max_prefix_action = new_conf.get('max_prefix_action', 'teardown')
+        peer.max_update_rate = new_conf.get('max_update_rate', 0)
+        if new_conf.get('import_policy') != old_conf.get('import_policy'):
+            peer.import_policy = import_policy
+            self._paced(('import', peer.peer_ip), list(peer._rib_in),
+                        self._reevaluate_import, peer)
+        if new_conf.get('export_policy') != old_conf.get('export_policy'):
+            peer.export_policy = export_policy
+            self._paced(('export', peer.peer_ip), list(self.bgp.best_routes),
+                        self._reevaluate_export, peer)
+        self.logger.info('Updated peer %s' % peer.peer_ip)
+
+    def _paced(self, key, items, batch_handler, *args, batch=None):
+        """Run batch_handler(batch, *args) over items, batch (POLICY_BATCH by default)
+        items per timer tick, and send the messages it returns. A new run of a key
+        replaces the running one."""
+        timer = self._paced_runs.pop(key, None)
+        if timer:
+            timer.cancel()
+        batch = batch or self.POLICY_BATCH
+
+        def run(start):
+            self._paced_runs.pop(key, None)
+            end = start + batch
+            for msg in batch_handler(items[start:end], *args):
+                self._send_to_exabgp(msg)
+            if end < len(items):
+                self._paced_runs[key] = self.timers.schedule(0, run, end)
+            else:
+                self.logger.info('%s run of %s done over %s routes' % (key[0], key[1], len(items)))
+
+        run(0)
+
+    def _complete_paced(self, key):
+        """Run the remaining batches of a paced run now."""
+        timer = self._paced_runs.get(key)
+        while timer:
+            timer.cancel()
+            timer.callback(*timer.args)
+            timer = self._paced_runs.get(key)
+
+    def _reevaluate_import(self, prefixes, peer):
+        """Run the routes received from a peer for prefixes through its import policy
+        again, only the routes whose policy result changed go through the selection."""
+        if self.peers.get(peer.peer_ip) is not peer:
+            return []
+        changes = []
+        for prefix in prefixes:
+            old, new = peer.reevaluate_import(prefix)
+            if new is old:
+                continue
+            if self.damping and self.damping.is_suppressed(peer.peer_ip, prefix):
+                continue
+            if new is None:
+                changes.append((old, True))
+            else:
+                # replaces the old one, if any, as an implicit withdraw
+                changes.append((new, False))
+        return self._path_changes_handler(peer, changes)
+
+    def _reevaluate_export(self, prefixes, peer):
+        """Run the best routes of prefixes through a peer's export policy again,
+        only announcing or withdrawing where the result differs from what was sent."""
+        if self.peers.get(peer.peer_ip) is not peer or peer.state != 'up':
+            return []
+        msgs = []
+        gateway = peer.nexthop_self
+        for prefix in prefixes:
+            if peer.add_path:
+                msgs.extend(self._export_paths(peer, prefix))
+                continue
+            route = self.bgp.best_routes.get(prefix)
+            if (route is None or route.from_peer == peer.peer_ip or
+                    peer in self.path_mapping.get((prefix, route.nexthop), ())):
+                continue
+            current = peer._rib_out.get(prefix)
+            out = peer.export_route(route)
+            if out is None:
+                if current is not None:
+                    msgs.extend(self.bgp.withdraw(peer, route))
+            elif out.attributes != current:
+                msgs.extend(self.bgp.announce(peer, route, gateway))
+        return msgs
 
     @set_ev_cls(faucet.EventFaucetExperimentalAPIRegistered)
     def initialize(self, ev=None):
@@ -102,13 +388,18 @@ class FlowBasedBGP(app_manager.RyuApp):
         if not self.valves:
             self.logger.error('Exitting...failed to get info from Faucet (Faucet probably has failed)')
             self.stop()
+        self.timers.start()
+        if self.fib_compress:
+            from fbgp.fib import FibCompressor
+            self.fib = FibCompressor(self._fib_changed)
         self._load_config()
+        self._restore_snapshot()
         for name, connector_cls, kwargs in [
-                ('faucet_connect', FaucetConnect, {'handler': self._process_faucet_msg}),
-                ('exabgp_connect', ExaBgpConnect, {'handler': self._process_exabgp_msg,
-                                                   'peers': self.peers, 'routerid': self.routerid}),
-                ('server_connect', ServerConnect, {'handler': self._process_server_msg})]:
-            connector = connector_cls(**kwargs)
+                ('faucet_connect', 'FaucetConnect', {'handler': self._process_faucet_msg}),
+                ('exabgp_connect', 'ExaBgpConnect', {'handler': self._process_exabgp_msg,
+                                                     'peers': self.peers, 'routerid': self.routerid}),
+                ('server_connect', 'ServerConnect', {'handler': self._process_server_msg})]:
+            connector = _load_connector(connector_cls)(**kwargs)
             setattr(self, name, connector)
             self.logger.info('Created connector: %s' % name)
         for name in ['faucet_connect', 'exabgp_connect', 'server_connect']:
@@ -119,6 +410,135 @@ class FlowBasedBGP(app_manager.RyuApp):
             else:
                 self.logger.info('Connector %s failed to start' % name)
                 self.stop()
+        if self.snapshot_file:
+            self.timers.every(self.snapshot_interval, self._save_snapshot)
+        signal.signal(signal.SIGHUP, lambda signum, frame: eventlet.spawn_n(self.reload_config))
+        if self.rib_export_file:
+            from fbgp.rib_export import RibExporter
+            self.rib_exporter = RibExporter(self.rib_export_file, self.bgp, self.peers)
+            self.timers.every(self.rib_export_interval, self.rib_exporter.flush)
+
+    def _save_snapshot(self):
+        """Write the RIBs and the pathid/vip allocations to the snapshot file."""
+        from fbgp.snapshot import RibSnapshot
+        start = time.time()
+        snapshot = RibSnapshot()
+        snapshot.created = start
+        snapshot.current_pathid = self.current_pathid
+        snapshot.nexthop_to_pathid = dict(self.nexthop_to_pathid)
+        for peer in self.peers.values():
+            snapshot.add_peer(peer, self.bgp.best_routes, self.bgp.loc_rib)
+        for (nexthop, vlan), vip in self.vip_assignment.items():
+            snapshot.vip_assignment[(nexthop, vlan.vid)] = vip
+        for key, peers in self.path_mapping.items():
+            if peers:
+                snapshot.path_mapping[key] = set(peer.peer_ip for peer in peers)
+        try:
+            snapshot.save(self.snapshot_file)
+            self.logger.info('Saved RIB snapshot with %s routes in %.3fs' % (
+                snapshot.num_routes(), time.time() - start))
+        except Exception as e:
+            self.logger.error('Failed to save RIB snapshot %s: %s' % (self.snapshot_file, e))
+
+    def _updates_pending(self, peer):
+        """Updates are queued for a peer, send them when its MRAI expires."""
+        self.timers.schedule(peer.mrai, self._flush_updates, peer)
+
+    def _flush_updates(self, peer):
+        for msg in self.bgp.flush_updates(peer):
+            self._send_to_exabgp(msg)
+
+    def _route_reusable(self, peer_ip, prefix):
+        """A route suppressed by flap damping can be used again."""
+        peer = self.peers.get(peer_ip)
+        route = peer.accepted(prefix) if peer else None
+        if not route:
+            return
+        for msg in self.path_change_handler(peer, route):
+            self._send_to_exabgp(msg)
+
+    def _export_change(self, prefix, peer=None):
+        """Mark a prefix as changed in the best routes, or in the peer's Adj-RIB-In, for export."""
+        if not self.rib_exporter:
+            return
+        if peer:
+            self.rib_exporter.rib_in_changed(peer.peer_ip, prefix)
+        else:
+            self.rib_exporter.best_changed(prefix)
+
+    def _restore_snapshot(self):
+        """Reload the RIBs from the last snapshot and reprogram the FIB from it (warm restart).
+        Restored routes are stale until the peers refresh them, the ones not refreshed
+        are withdrawn on End-of-RIB or when the stale timer expires."""
+        if not self.snapshot_file or not os.path.exists(self.snapshot_file):
+            return
+        from fbgp.snapshot import RibSnapshot, ROUTE_ACCEPTED, ROUTE_BEST
+        try:
+            snapshot = RibSnapshot.load(self.snapshot_file, self.peers)
+        except Exception as e:
+            self.logger.error('Failed to load RIB snapshot %s: %s' % (self.snapshot_file, e))
+            return
+        accepted = []
+        for peer_ip, routes in snapshot.routes.items():
+            peer = self.peers[peer_ip]
+            peer.dp_id, peer.vlan_vid, peer.port_no = snapshot.peers[peer_ip]
+            for route, flags in routes:
+                peer.load_route(route)
+                if flags & ROUTE_ACCEPTED:
+                    _, route = peer.reevaluate_import(route.prefix)
+                    if route:
+                        accepted.append((route, bool(flags & ROUTE_BEST)))
+            peer.mark_stale()
+        self.bgp.load_routes(accepted)
+        self.current_pathid = max(self.current_pathid, snapshot.current_pathid)
+        self.nexthop_to_pathid.update(snapshot.nexthop_to_pathid)
+        for (nexthop, vid), vip in snapshot.vip_assignment.items():
+            vlan = self.vlans.get(vid)
+            for ext_vip in (vlan.faucet_ext_vips if vlan else []):
+                if str(ext_vip) == vip:
+                    self.vip_assignment[(nexthop, vlan)] = ext_vip
+        for key, peer_ips in snapshot.path_mapping.items():
+            self.path_mapping[key].update(self.peers[peer_ip] for peer_ip in peer_ips if peer_ip in self.peers)
+        for prefix, route in self.bgp.best_routes.items():
+            learned_peer = self.peers[route.from_peer]
+            nexthop = route.nexthop
+            if learned_peer.is_ibgp() and nexthop in self.borders:
+                nexthop = self.borders[nexthop].nexthop
+            self._update_fib(prefix, nexthop, learned_peer.dp_id, learned_peer.vlan_vid)
+        for (prefix, nexthop), peers in self.path_mapping.items():
+            route = self._route_by_nexthop(prefix, nexthop)
+            if not route:
+                continue
+            pathid = self._get_pathid(nexthop)
+            learned_peer = self.peers[route.from_peer]
+            for peer in peers:
+                vip = self._get_vip(nexthop, peer.vlan)
+                if vip:
+                    self._update_mapping(vip, pathid, peer.dp_id, peer.vlan_vid)
+                    self._update_fib(prefix, nexthop, learned_peer.dp_id, learned_peer.vlan_vid, pathid)
+        self.logger.info(
+            'Restored %s routes from snapshot taken at %s, %s FIB entries programmed %.3fs after start' % (
+                snapshot.num_routes(), time.ctime(snapshot.created), len(self.bgp.best_routes),
+                time.time() - self.start_time))
+        self.timers.schedule(self.stale_time, self._stale_timer_expired)
+
+    def _sweep_stale(self, peer):
+        """Withdraw routes restored from the snapshot that the peer has not refreshed."""
+        changes = []
+        accepted = dict((prefix, peer.accepted(prefix)) for prefix in peer._stale)
+        for route in peer.sweep_stale():
+            self._export_change(route.prefix, peer)
+            self._notify_route_change(peer.peer_ip, route, True)
+            route = accepted.get(route.prefix)
+            if route is not None and any(
+                    candidate is route for candidate in self.bgp.loc_rib.get(route.prefix, ())):
+                changes.append((route, True))
+        return self._path_changes_handler(peer, changes)
+
+    def _stale_timer_expired(self):
+        for peer in self.peers.values():
+            for msg in self._sweep_stale(peer):
+                self._send_to_exabgp(msg)
 
     def _get_pathid(self, nexthop):
         """Return a unique pathid for a nexthop."""
@@ -129,26 +549,57 @@ class FlowBasedBGP(app_manager.RyuApp):
             self.nexthop_to_pathid[nexthop] = self.current_pathid
             return self.current_pathid
 
+    def _nexthop_self(self, peer):
+        """Return the nexthop announced to an internal peer, the routerid unless the
+        session is of another address family (the faucet vip of the peer is used then)."""
+        if peer.is_ibgp() and peer.peer_ip.version == self.routerid.version:
+            return self.routerid
+        return None
+
     def _get_vip(self, nexthop, vlan):
-        """return vip (extra) if we still have one."""
+        """return vip (extra) of the nexthop's address family if we still have one."""
         if not (nexthop and vlan):
             return
         if (nexthop, vlan) in self.vip_assignment:
             return self.vip_assignment[(nexthop, vlan)]
         used_vips = set(self.vip_assignment.values())
         for vip in vlan.faucet_ext_vips:
-            if vip not in used_vips:
+            if vip.version == nexthop.version and vip not in used_vips:
                 self.vip_assignment[(nexthop, vlan)] = vip
                 return vip
         return None
 
+    def _fib_changed(self):
+        self.timers.schedule(0, self._flush_fib)
+
+    def _flush_fib(self):
+        """Program the changes of the compressed FIB, the new entries first so that
+        no traffic is dropped while entries are replaced by aggregates, or back."""
+        adds, dels = self.fib.flush()
+        for prefix, (nexthop, dpid, vid) in adds:
+            self.faucet_api.add_route(prefix, nexthop, dpid=dpid, vid=vid)
+        for prefix, (nexthop, dpid, vid) in dels:
+            self.faucet_api.del_route(prefix, nexthop, dpid=dpid, vid=vid)
+        self.fib_generation += len(adds) + len(dels)
+        self.logger.debug('Programmed compressed FIB: %s entries added, %s deleted' % (
+            len(adds), len(dels)))
+
     def _update_fib(self, prefix, nexthop, dpid=None, vid=None, pathid=None, add=True):
+        if self.fib and pathid is None:
+            self.fib.set(prefix, (nexthop, dpid, vid) if add else None)
+            return
         if add:
             self.faucet_api.add_route(prefix, nexthop, dpid=dpid, vid=vid, pathid=pathid)
+            self.fib_generation += 1
             self.logger.debug(
                 'Added extended FIB rule to datapath: prefix=%s, nexthop=%s, pathid=%s, dpid=%s, vid=%s' % (
                     str(prefix), str(nexthop), pathid, dpid, vid))
 
+        elif pathid is None: # no best route is left, as with the compressed FIB
+            self.faucet_api.del_route(prefix, nexthop, dpid=dpid, vid=vid)
+            self.fib_generation += 1
+            self.logger.debug('Deleted FIB rule from datapath: prefix=%s, nexthop=%s' % (
+                str(prefix), str(nexthop)))
         else: # consider if the route is still being used by some peers before deleteing
             #self.faucet_api.del_route(prefix, nexthop, dpid=dpid, vid=vid, pathid=pathid)
             pass
@@ -156,6 +607,7 @@ class FlowBasedBGP(app_manager.RyuApp):
     def _update_mapping(self, vip, pathid, dpid, vid, add=True):
         if add:
             self.faucet_api.add_ext_vip(vip, pathid=pathid, dpid=dpid, vid=vid)
+            self.fib_generation += 1
             self.logger.info(
                 'Added mapping rule to datapath: vip=%s, pathid=%s, dpid=%s, vid=%s' % (
                     str(vip), pathid, dpid, vid))
@@ -166,13 +618,23 @@ class FlowBasedBGP(app_manager.RyuApp):
 
     def path_change_handler(self, peer, route, withdraw=False):
         """handle route advertisement or withdrawal event."""
-        msgs = []
         if not route:
             return []
-        if withdraw:
-            new_best, cur_best = self.bgp.del_route(route)
-        else:
-            new_best, cur_best = self.bgp.add_route(route)
+        return self._path_changes_handler(peer, [(route, withdraw)])
+
+    def _path_changes_handler(self, peer, changes):
+        """handle a batch of (route, withdraw) changes from a peer, the best path
+        selection of the whole batch is done at once."""
+        msgs = []
+        results = self.bgp.apply_changes(changes)
+        for (route, withdraw), (new_best, cur_best) in zip(changes, results):
+            msgs.extend(self._path_changed(peer, route, withdraw, new_best, cur_best))
+        return msgs
+
+    def _path_changed(self, peer, route, withdraw, new_best, cur_best):
+        """update FIB and peers after the best path selection for a route change."""
+        msgs = []
+        self._export_change(route.prefix)
         if new_best:
             nexthop = new_best.nexthop
             if peer.is_ibgp() and nexthop in self.borders:
@@ -180,11 +642,17 @@ class FlowBasedBGP(app_manager.RyuApp):
             self.logger.info('new best path for %s via %s: %s' % (route.prefix, nexthop, new_best))
             self.logger.debug('previous best path for %s was %s' % (route.prefix, cur_best))
             self._update_fib(new_best.prefix, nexthop, peer.dp_id, peer.vlan_vid)
+        elif withdraw and route.prefix not in self.bgp.best_routes:
+            self._update_fib(route.prefix, route.nexthop, add=False)
 
+        paths_exported = False
         for other_peer in self._other_peers(peer):
             if other_peer.state == 'down':
                 continue
-            if other_peer in self.path_mapping[route.prefix, route.nexthop]:
+            if other_peer.add_path:
+                msgs.extend(self._export_paths(other_peer, route.prefix))
+                paths_exported = True
+            elif other_peer in self.path_mapping[route.prefix, route.nexthop]:
                 gateway = self._get_vip(route.nexthop, other_peer.vlan)
                 pathid = self._get_pathid(route.nexthop)
                 if withdraw:
@@ -223,11 +691,47 @@ class FlowBasedBGP(app_manager.RyuApp):
                     kwargs['gateway'] = None
 
                 if _route:
-                    if other_peer.is_ibgp() and 'gateway' in kwargs:
-                        kwargs['gateway'] = self.routerid
+                    if 'gateway' in kwargs:
+                        kwargs['gateway'] = other_peer.nexthop_self
                     msgs.extend(func(other_peer, _route, **kwargs))
+        if withdraw and paths_exported and not self._route_by_nexthop(route.prefix, route.nexthop):
+            # the path is gone, remove the FIB entry used by the ADD-PATH peers
+            self._update_fib(route.prefix, route.nexthop, peer.dp_id, peer.vlan_vid,
+                             self._get_pathid(route.nexthop), False)
         return msgs
 
+    def _export_paths(self, peer, prefix):
+        """Send the top paths of a prefix to an ADD-PATH peer, the path id of a path
+        is the pathid of its nexthop. The best path is sent as usual, the others
+        with the extra vip of their nexthop, mapped to the path in the dataplane. Only
+        the paths that are new or changed are programmed, the vip of a nexthop is
+        mapped for all the prefixes and is kept when a path is dropped."""
+        best_route = self.bgp.best_routes.get(prefix)
+        paths = []
+        vips = {} # pathid -> vip of the paths other than the best one
+        for route in self.bgp.select_paths(prefix, peer.add_path, peer.peer_ip):
+            pathid = self._get_pathid(route.nexthop)
+            if route is best_route:
+                paths.append((pathid, route, peer.nexthop_self))
+                continue
+            vip = self._get_vip(route.nexthop, peer.vlan)
+            if not vip:
+                continue
+            vips[pathid] = vip
+            paths.append((pathid, route, vip.ip))
+        announce, withdraw = peer.announce_paths(prefix, paths)
+        for pathid, out, _ in announce:
+            if pathid in vips and out.route is not best_route:
+                learned_peer = self.peers[out.from_peer]
+                self._update_mapping(vips[pathid], pathid, peer.dp_id, peer.vlan_vid)
+                self._update_fib(prefix, out.nexthop, learned_peer.dp_id, learned_peer.vlan_vid, pathid)
+        for pathid, out in withdraw:
+            learned_peer = self.peers.get(out.from_peer)
+            if learned_peer:
+                self._update_fib(prefix, out.nexthop, learned_peer.dp_id, learned_peer.vlan_vid,
+                                 pathid, False)
+        return self.bgp.path_updates(peer, announce, withdraw)
+
     def register(self):
         self._send_to_server({
             'msg_type': 'router_up', 'routerid': str(self.routerid), 'state': 'up'})
@@ -254,6 +758,27 @@ class FlowBasedBGP(app_manager.RyuApp):
     def deregister(self):
         pass
 
+    def stats(self):
+        """return counters of the optional subsystems."""
+        stats = {'updates_pending': sum(len(peer._pending) for peer in self.peers.values()),
+                 'fib_generation': self.fib_generation,
+                 'duplicate_updates_total': self.duplicate_updates,
+                 'noop_withdraws_total': self.noop_withdraws,
+                 'routes_dropped_total': self.routes_dropped,
+                 'max_prefix_teardowns_total': self.max_prefix_teardowns,
+                 'rib_routes': self.rib_budget.used,
+                 'rib_budget': self.rib_budget.limit,
+                 'rib_routes_by_peer': dict(
+                     (str(peer.peer_ip), len(peer._rib_in)) for peer in self.peers.values())}
+        stats.update(self.timers.stats())
+        if self.damping:
+            stats.update(self.damping.stats())
+        if self.fib:
+            stats.update(self.fib.stats())
+        if self.exabgp_connect:
+            stats['input_queues'] = self.exabgp_connect.queue_stats()
+        return stats
+
     def _route_by_nexthop(self, prefix, nexthop):
         """return a route for a prefix by its nexthop."""
         for route in self.bgp.loc_rib.get(prefix, []):
@@ -264,42 +789,164 @@ class FlowBasedBGP(app_manager.RyuApp):
     def _add_mapping(self, peer_ip, prefix, nexthop, egress=None, pathid=None):
         """create a mapping between a peer and a route.
         egress is None assuming the nexthop is local"""
-        if pathid is None and egress is None or self.routerid == egress: # this is the local route
-            peer = self.peers[peer_ip]
-            self.path_mapping[prefix, nexthop].add(peer)
-            vip = self._get_vip(nexthop, peer.vlan)
+        return self._add_mappings(peer_ip, [prefix], nexthop, egress, pathid)
 
-            if not vip:
-                return []
-            mypathid = self._get_pathid(nexthop)
-            if mypathid != pathid:
-                self.logger.error('There must be something wrong, pathids differ')
-                return []
+    def _add_mappings(self, peer_ip, prefixes, nexthop, egress=None, pathid=None):
+        """create mappings between a peer and the routes of prefixes via a nexthop,
+        the vip of the nexthop is mapped to the path once for all the prefixes."""
+        if not (pathid is None and egress is None or self.routerid == egress): # not a local route
+            #TODO: handle the case when route is remote
+            return []
+        peer = self.peers[peer_ip]
+        for prefix in prefixes:
+            self.path_mapping[prefix, nexthop].add(peer)
+        vip = self._get_vip(nexthop, peer.vlan)
+        if not vip:
+            return []
+        mypathid = self._get_pathid(nexthop)
+        if mypathid != pathid:
+            self.logger.error('There must be something wrong, pathids differ')
+            return []
+        msgs = []
+        mapped = False
+        for prefix in prefixes:
             route = self._route_by_nexthop(prefix, nexthop)
             if route:
-                self._update_mapping(vip, pathid, peer.dp_id, peer.vlan_vid)
-                learned_peer = self.peers[route.learned_from_peer]
+                if not mapped:
+                    self._update_mapping(vip, pathid, peer.dp_id, peer.vlan_vid)
+                    mapped = True
+                learned_peer = self.peers[route.from_peer]
                 self._update_fib(prefix, nexthop, learned_peer.dp_id, learned_peer.vlan_vid, pathid)
-            return self.bgp.announce(peer, route, gateway=vip)
-        else:
-            #TODO: handle the case when route is remote
-            return []
+            msgs.extend(self.bgp.announce(peer, route, gateway=vip))
+        return msgs
 
     def _del_mapping(self, peer_ip, prefix, nexthop, egress=None, pathid=None):
+        return self._del_mappings(peer_ip, [prefix], nexthop, egress, pathid)
+
+    def _del_mappings(self, peer_ip, prefixes, nexthop, egress=None, pathid=None):
+        """remove the mappings between a peer and the routes of prefixes via a nexthop,
+        the peer gets the best routes back."""
         msgs = []
         if egress is None and pathid is None:
             peer = self.peers[peer_ip]
-            if peer not in self.path_mapping[prefix, nexthop]:
-                return []
+            for prefix in prefixes:
+                if peer not in self.path_mapping[prefix, nexthop]:
+                    continue
+                best_route = self.bgp.best_routes.get(prefix)
+                if best_route:
+                    # advertise best route instead
+                    msgs.extend(self.bgp.announce(peer, best_route))
+                else:
+                    route = self._route_by_nexthop(prefix, nexthop)
+                    msgs.extend(self.bgp.withdraw(peer, route))
+        return msgs
+
+    def _set_best_paths(self, prefixes, nexthop):
+        """use the routes via nexthop as the best routes of prefixes, as instructed
+        by the route server."""
+        msgs = []
+        for prefix in prefixes:
             best_route = self.bgp.best_routes.get(prefix)
-            if best_route:
-                # advertise best route instead
-                msgs = self.bgp.announce(peer, best_route)
-            else:
-                route = self._route_by_nexthop(prefix, nexthop)
-                msgs = self.bgp.withdraw(peer, route)
+            if best_route and best_route.nexthop == nexthop:
+                continue
+            route = self._route_by_nexthop(prefix, nexthop)
+            if not route:
+                continue
+            self.bgp.set_best_route(route)
+            self._export_change(prefix)
+            learned_peer = self.peers[route.from_peer]
+            self._update_fib(route.prefix, route.nexthop, learned_peer.dp_id, learned_peer.vlan_vid)
+            for peer in self.peers.values():
+                if peer.add_path:
+                    msgs.extend(self._export_paths(peer, prefix))
+                    continue
+                if peer.peer_ip == route.from_peer:
+                    continue
+                msgs.extend(self.bgp.announce(peer, route))
         return msgs
 
+    def _parse_mapping(self, mapping):
+        """Return (command, peer_ip, prefixes, nexthop, egress, pathid, for_peer) of a
+        mapping of a bulk_mapping command. The prefixes are the listed ones and the
+        prefixes of loc_rib in the prefix ranges."""
+        command = mapping['command']
+        if command not in ['add_mapping', 'del_mapping']:
+            raise ValueError('unknown mapping command %s' % command)
+        for_peer = mapping.get('for_peer', True)
+        routerid = ipaddress.ip_address(mapping['routerid']) if for_peer else None
+        if for_peer and routerid not in self.peers:
+            raise ValueError('unknown peer %s' % routerid)
+        nexthop = ipaddress.ip_address(mapping['nexthop'])
+        egress = mapping.get('egress')
+        egress = ipaddress.ip_address(egress) if egress else None
+        pathid = mapping.get('pathid')
+        pathid = int(pathid) if pathid is not None else None
+        prefixes = dict.fromkeys(ipaddress.ip_network(prefix) for prefix in mapping.get('prefixes', []))
+        if mapping.get('prefix_ranges'):
+            prefix_set = PrefixSet([PrefixRange.parse(line) for line in mapping['prefix_ranges']])
+            prefixes.update(dict.fromkeys(
+                prefix for prefix in self.bgp.loc_rib if prefix_set.contains(prefix)))
+        return command, routerid, list(prefixes), nexthop, egress, pathid, for_peer
+
+    def _check_mapping(self, vips, pathids, command, peer_ip, prefixes, nexthop, egress,
+                       pathid, for_peer):
+        """Raise ValueError if a parsed mapping cannot be applied in full. vips and
+        pathids hold what the mappings before it in the transaction take."""
+        if command != 'add_mapping':
+            return
+        for prefix in prefixes:
+            route = self._route_by_nexthop(prefix, nexthop)
+            if route and route.from_peer not in self.peers:
+                raise ValueError('unknown peer %s of the route of %s' % (route.from_peer, prefix))
+        if not for_peer or not (pathid is None and egress is None or self.routerid == egress):
+            return
+        vlan = self.peers[peer_ip].vlan
+        if (nexthop, vlan) not in self.vip_assignment and (nexthop, vlan) not in vips:
+            used_vips = set(self.vip_assignment.values()) | set(vips.values())
+            free_vips = [vip for vip in (vlan.faucet_ext_vips if vlan else [])
+                         if vip.version == nexthop.version and vip not in used_vips]
+            if not free_vips:
+                raise ValueError('no vip left for nexthop %s' % nexthop)
+            vips[nexthop, vlan] = free_vips[0]
+        mypathid = self.nexthop_to_pathid.get(nexthop, pathids.get(nexthop))
+        if mypathid is None:
+            mypathid = pathids[nexthop] = self.current_pathid + 1 + len(pathids)
+        if mypathid != pathid:
+            raise ValueError('pathid %s is not the pathid %s of nexthop %s' % (
+                pathid, mypathid, nexthop))
+
+    def _bulk_mapping(self, mappings):
+        """Apply the mappings of a bulk_mapping command as one transaction: none is
+        applied if any of them is invalid, the error lists the invalid ones. Returns
+        the ExaBGP messages and the result."""
+        parsed = []
+        failed = []
+        vips = {} # (nexthop, vlan) -> vip the mappings take
+        pathids = {} # nexthop -> pathid the mappings take
+        for index, mapping in enumerate(mappings):
+            try:
+                parsed.append(self._parse_mapping(mapping))
+                self._check_mapping(vips, pathids, *parsed[-1])
+            except Exception as e:
+                failed.append({'index': index, 'error': str(e)})
+        if failed:
+            return [], {'status': 'error', 'error': '%s invalid mappings' % len(failed),
+                        'failed': failed}
+        mappings = parsed
+        msgs = []
+        num_prefixes = 0
+        for command, peer_ip, prefixes, nexthop, egress, pathid, for_peer in mappings:
+            num_prefixes += len(prefixes)
+            if not for_peer:
+                if command == 'add_mapping':
+                    msgs.extend(self._set_best_paths(prefixes, nexthop))
+            elif command == 'add_mapping':
+                msgs.extend(self._add_mappings(peer_ip, prefixes, nexthop, egress, pathid))
+            else:
+                msgs.extend(self._del_mappings(peer_ip, prefixes, nexthop, egress, pathid))
+        return msgs, {'status': 'ok', 'mappings': len(mappings), 'prefixes': num_prefixes,
+                      'updates': len(msgs)}
+
     def _notify_route_change(self, peer_ip, route, withdraw=False):
         """notify the route server about a route."""
         if not route:
@@ -337,6 +984,8 @@ class FlowBasedBGP(app_manager.RyuApp):
 
         if peer.state == 'up':
             return []
+        # the routes of the previous session must be gone before the new ones come in
+        self._complete_paced(('down', peer.peer_ip))
         self._send_to_server({
             'msg_type': 'peer_up', 'peer_ip': str(peer.peer_ip), 'peer_as': peer.peer_as,
             'local_ip': str(self.routerid), 'local_as': peer.local_as, 'state': 'up'})
@@ -348,6 +997,9 @@ class FlowBasedBGP(app_manager.RyuApp):
         #    msgs.extend(self.bgp.announce_prefix(peer, prefix))
         # for each prefix, advertise non-best path if it is configured, otherwise advertise best path
         for prefix, routes in self.bgp.loc_rib.items():
+            if peer.add_path:
+                msgs.extend(self._export_paths(peer, prefix))
+                continue
             gateway = None
             pathid = None
             route = non_best_route(peer, routes)
@@ -355,7 +1007,7 @@ class FlowBasedBGP(app_manager.RyuApp):
                 gateway = self._get_vip(route.nexthop, peer.vlan)
                 pathid = self._get_pathid(route.nexthop)
                 self._update_mapping(gateway, pathid, peer.dp_id, peer.vlan_vid)
-                learned_peer = self.peers[route.learned_from_peer]
+                learned_peer = self.peers[route.from_peer]
                 self._update_fib(prefix, route.nexthop, learned_peer.dp_id, learned_peer.vlan_vid, pathid)
             else:
                 route = best_route(prefix)
@@ -382,10 +1034,105 @@ class FlowBasedBGP(app_manager.RyuApp):
         if peer.state == 'down':
             return []
         self._send_to_server({'msg_type': 'peer_down', 'peer_ip': str(peer.peer_ip)})
-        msgs = []
-        for route in peer._rib_in.values():
-            msgs.extend(self.path_change_handler(peer, route, True))
+        routes = [route for prefix, route in peer._rib_in_post.items()
+                  if not (self.damping and self.damping.is_suppressed(peer.peer_ip, prefix))]
+        if self.damping:
+            self.damping.peer_down(peer.peer_ip)
         peer.bgp_session_down()
+        if self.rib_exporter:
+            self.rib_exporter.peer_cleared(peer.peer_ip)
+        # the routes leave the selection at once, no route of the dead peer stays best;
+        # the other peers and the FIB are updated a batch per timer tick, a full table
+        # does not block the hub
+        results = self.bgp.apply_changes([(route, True) for route in routes])
+        withdrawn = [(route, cur_best) for route, (_, cur_best) in zip(routes, results)]
+        self._paced(('down', peer.peer_ip), withdrawn, self._withdraw_peer_routes, peer,
+                    batch=self.PEER_DOWN_BATCH)
+        return []
+
+    def _update_groups(self, peer):
+        """Return the (gateway, peers) update groups of the peers other than peer with
+        a session up: the peers of a group export a route the same way and with the
+        same nexthop. ADD-PATH peers are left out, peers with an MRAI or no gateway
+        are alone in their group."""
+        groups = {}
+        for other_peer in self._other_peers(peer):
+            if other_peer.state == 'down' or other_peer.add_path:
+                continue
+            gateway = other_peer.gateway
+            if other_peer.mrai or gateway is None:
+                key = other_peer
+            else:
+                # a policy with actions is a dict in the config, keyed by its JSON text
+                export_policy = json.dumps(
+                    self.peer_confs[other_peer.peer_ip].get('export_policy'), sort_keys=True)
+                key = (other_peer.peer_ip.version, other_peer.is_ibgp(), other_peer.peer_as,
+                       other_peer.local_as, export_policy, gateway)
+            groups.setdefault(key, (gateway, []))[1].append(other_peer)
+        return list(groups.values())
+
+    def _withdraw_peer_routes(self, withdrawn, peer):
+        """Export a batch of the (route, best path before) of a peer whose session went
+        down, the routes are already out of the selection. Only the prefixes whose best
+        path was the route are sent, once per update group, with the best path selected
+        now: an update received since may have replaced it."""
+        msgs = []
+        groups = self._update_groups(peer)
+        add_path_peers = [other_peer for other_peer in self._other_peers(peer)
+                          if other_peer.add_path and other_peer.state != 'down']
+        for route, cur_best in withdrawn:
+            prefix = route.prefix
+            new_best = self.bgp.best_routes.get(prefix)
+            self._export_change(prefix)
+            mapped = self.path_mapping.get((prefix, route.nexthop), ())
+            for other_peer in mapped:
+                if other_peer is peer or other_peer.state == 'down' or other_peer.add_path:
+                    continue
+                if new_best:
+                    msgs.extend(self.bgp.announce(other_peer, new_best))
+                    continue
+                gateway = self._get_vip(route.nexthop, other_peer.vlan)
+                pathid = self._get_pathid(route.nexthop)
+                msgs.extend(self.bgp.withdraw(other_peer, route))
+                self._update_mapping(gateway, pathid, other_peer.dp_id, other_peer.vlan_vid, False)
+                self._update_fib(prefix, route.nexthop, peer.dp_id, peer.vlan_vid, pathid, False)
+            for other_peer in add_path_peers:
+                msgs.extend(self._export_paths(other_peer, prefix))
+            if add_path_peers and not self._route_by_nexthop(prefix, route.nexthop):
+                self._update_fib(prefix, route.nexthop, peer.dp_id, peer.vlan_vid,
+                                 self._get_pathid(route.nexthop), False)
+            if cur_best != route:
+                continue # not the best path, the other peers are not told
+            if new_best:
+                learned_peer = self.peers.get(new_best.from_peer, peer)
+                nexthop = new_best.nexthop
+                if learned_peer.is_ibgp() and nexthop in self.borders:
+                    nexthop = self.borders[nexthop].nexthop
+                self.logger.debug('new best path for %s via %s: %s' % (prefix, nexthop, new_best))
+                self._update_fib(prefix, nexthop, learned_peer.dp_id, learned_peer.vlan_vid)
+            else:
+                self._update_fib(prefix, route.nexthop, add=False)
+            for gateway, members in groups:
+                if mapped:
+                    members = [member for member in members if member not in mapped]
+                if new_best:
+                    # the peer the new best path is learned from gets the prefix withdrawn
+                    source = [member for member in members if member.peer_ip == new_best.from_peer]
+                    members = [member for member in members if member.peer_ip != new_best.from_peer]
+                    if source:
+                        msgs.extend(self.bgp.withdraw(source[0], cur_best))
+                if not members:
+                    continue
+                if gateway is None or members[0].mrai:
+                    # alone in its group
+                    if new_best:
+                        msgs.extend(self.bgp.announce(members[0], new_best, members[0].nexthop_self))
+                    else:
+                        msgs.extend(self.bgp.withdraw(members[0], cur_best))
+                elif new_best:
+                    msgs.extend(self.bgp.announce_group(members, new_best, gateway))
+                else:
+                    msgs.extend(self.bgp.withdraw_group(members, cur_best))
         return msgs
 
     def _peer_connected(self, peer, dp_id, vlan_vid, port_no):
@@ -424,29 +1171,26 @@ class FlowBasedBGP(app_manager.RyuApp):
         return []
 
     def _process_exabgp_msg(self, msg):
-        """Process message received from ExaBGP."""
-        if msg in ['done', 'error'] or not msg:
+        """Process message received from ExaBGP, either a raw JSON line or a message
+        already parsed by fbgp.exabgp_parser."""
+        if isinstance(msg, str):
+            self.logger.debug('processing msg from exabgp: %r' % msg)
+            msg = exabgp_parser.parse(msg)
+        if not msg:
             return []
-        self.logger.debug('processing msg from exabgp: %r' % msg)
         try:
-            msg = json.loads(msg)
-            if msg.get('type') == 'notification':
-                #TODO: handle notification
-                return []
-            neighbor = msg.get('neighbor', {})
-            if not neighbor or neighbor.get('direction') == 'send':
+            if msg[0] == exabgp_parser.MSG_ERROR:
+                self.logger.error('Error when processing msg %s: %s' % msg[1:])
                 return []
-            local_ip = ipaddress.ip_address(neighbor['address']['local'])
-            peer_ip = ipaddress.ip_address(neighbor['address']['peer'])
-            local_as = neighbor['asn']['local']
-            peer_as = neighbor['asn']['peer']
+            peer_ip = exabgp_parser.to_address(msg[1])
             msgs = []
-            if msg.get('type') == 'update' and 'update' in neighbor['message']:
-                update = neighbor['message']['update']
-                msgs = self._process_bgp_update(peer_ip, update)
-            elif msg.get('type') == 'state':
-                state = 'up' if neighbor['state'] == 'up' else 'down'
-                msgs = self._peer_state_change(peer_ip, state)
+            if msg[0] == exabgp_parser.MSG_UPDATE:
+                msgs = self._process_bgp_update(peer_ip, *msg[2:])
+            elif msg[0] == exabgp_parser.MSG_EOR:
+                if peer_ip in self.peers:
+                    msgs = self._sweep_stale(self.peers[peer_ip])
+            elif msg[0] == exabgp_parser.MSG_STATE:
+                msgs = self._peer_state_change(peer_ip, msg[2])
             for msg in msgs:
                 self._send_to_exabgp(msg)
         except Exception as e:
@@ -456,51 +1200,96 @@ class FlowBasedBGP(app_manager.RyuApp):
     def _other_peers(self, peer):
         return [other_peer for other_peer in self.peers.values() if other_peer != peer]
 
-    def _process_bgp_update(self, peer_ip, update):
-        """Process a BGP update received from ExaBGP."""
-        self.logger.debug('processing update from %s: %s' % (peer_ip, update))
+    def _process_bgp_update(self, peer_ip, attributes, announce, withdraw):
+        """Process a BGP update received from ExaBGP (parsed by fbgp.exabgp_parser)."""
+        self.logger.debug('processing update from %s: %s %s %s' % (
+            peer_ip, attributes, announce, withdraw))
         try:
-            msgs = []
+            changes = []
             if peer_ip not in self.peers:
                 return []
             peer = self.peers[peer_ip]
-            if 'announce' in update and 'ipv4 unicast' in update['announce']:
-                attributes = update['attribute']
-                if 'as-path' not in attributes:
+            if announce:
+                origin, as_path, med, local_pref, community = attributes
+                if as_path is None:
                     if peer.local_as != peer.peer_as:
                         self.logger.error('received malformed update')
                         return []
-                    attributes['as-path'] = [peer.peer_as]
-                elif peer.local_as in attributes['as-path']: # loop avoidance
+                    as_path = (peer.peer_as,)
+                elif peer.local_as in as_path: # loop avoidance
                     return []
-                for name, attr in [
-                        ('origin', 'origin'), ('igp', 'igp'), ('as_path', 'as-path'),
-                        ('med', 'med'), ('community', 'communities'),
-                        ('local_pref', 'local-preference')]:
-                    attributes[name] = update['attribute'].get(attr)
-
-                for nexthop, nlris in update['announce']['ipv4 unicast'].items():
-                    nexthop = ipaddress.ip_address(nexthop)
+                for received_nexthop, prefixes in announce:
+                    nexthop = exabgp_parser.to_address(received_nexthop)
                     if nexthop == peer.local_ip:
                         continue
-                    for prefix in nlris:
-                        prefix = ipaddress.ip_network(prefix['nlri'])
-                        route = peer.rcv_announce(prefix, nexthop, **attributes)
+                    received = (received_nexthop, attributes)
+                    for prefix in prefixes:
+                        if peer.is_duplicate(prefix, received_nexthop, attributes):
+                            self.duplicate_updates += 1
+                            continue
+                        prefix = exabgp_parser.to_network(prefix)
+                        replaces = prefix in peer._rib_in
+                        if not replaces:
+                            action = peer.limit_action()
+                            if action == 'teardown':
+                                return self._max_prefix_teardown(peer, changes)
+                            if action == 'drop':
+                                self.routes_dropped += 1
+                                continue
+                            if action == 'warn' and len(peer._rib_in) == peer.max_prefix:
+                                self.logger.warning('peer %s reached its max-prefix limit %s' % (
+                                    peer_ip, peer.max_prefix))
+                        prev_route = peer.accepted(prefix)
+                        route = peer.rcv_announce(
+                            prefix, nexthop, list(as_path), origin, received,
+                            med=med, community=community, local_pref=local_pref)
+                        self._export_change(prefix, peer)
                         self._notify_route_change(peer_ip, route)
-                        msgs.extend(self.path_change_handler(peer, route))
-            if 'withdraw' in update and 'ipv4 unicast' in update['withdraw']:
-                for prefix in update['withdraw']['ipv4 unicast']:
-                    prefix = ipaddress.ip_network(prefix['nlri'])
-                    route = peer.rcv_withdraw(prefix)
-                    if route:
-                        self._notify_route_change(peer_ip, route, True)
-                        msgs.extend(self.path_change_handler(peer, route, True))
-            return msgs
+                        was_suppressed = self.damping and self.damping.is_suppressed(peer_ip, prefix)
+                        if not route:
+                            # rejected by the import policy, withdraw the route it replaces
+                            if prev_route and not peer.accepted(prefix) and not was_suppressed:
+                                changes.append((prev_route, True))
+                            continue
+                        if self.damping and not self.damping.announce(peer_ip, prefix, replaces):
+                            if prev_route and not was_suppressed:
+                                changes.append((prev_route, True))
+                            continue
+                        changes.append((route, False))
+            for prefix in withdraw:
+                if not peer.has_prefix(prefix):
+                    self.noop_withdraws += 1
+                    continue
+                prefix = exabgp_parser.to_network(prefix)
+                accepted = peer.accepted(prefix)
+                route = peer.rcv_withdraw(prefix)
+                if route:
+                    self._export_change(prefix, peer)
+                    self._notify_route_change(peer_ip, route, True)
+                    if self.damping:
+                        was_suppressed = self.damping.is_suppressed(peer_ip, prefix)
+                        self.damping.withdraw(peer_ip, prefix)
+                        if was_suppressed:
+                            continue
+                    if accepted:
+                        changes.append((accepted, True))
+            return self._path_changes_handler(peer, changes)
         except Exception as e:
-            self.logger.error('Error when processing update %s: %s' % (update, e))
+            self.logger.error('Error when processing update from %s: %s' % (peer_ip, e))
             traceback.print_exc()
         return []
 
+    def _max_prefix_teardown(self, peer, changes):
+        """Tear the session of a peer down as it went over its max-prefix limit, after
+        applying the changes of its update received so far."""
+        self.max_prefix_teardowns += 1
+        self.logger.error('peer %s went over its max-prefix limit %s, tearing the session down' % (
+            peer.peer_ip, peer.max_prefix))
+        msgs = self._path_changes_handler(peer, changes)
+        msgs.append('%s teardown 1' % peer.neighbor) # cease, max number of prefixes reached
+        msgs.extend(self._peer_bgp_down(peer))
+        return msgs
+
     def _process_faucet_msg(self, msg):
         """Process message received from Faucet Controller."""
         dpid = msg['dp_id']
@@ -541,39 +1330,68 @@ class FlowBasedBGP(app_manager.RyuApp):
                 self.logger.info('Disconnected from server: %s' % msg)
                 self.deregister()
             elif msg_type == 'server_command':
-                #TODO: process server commands
                 self.logger.info('Receive msg from server: %s' % msg)
-                command = msg.get('command')
-                if command in ['add_mapping', 'del_mapping']:
-                    routerid = ipaddress.ip_address(msg['routerid'])
-                    prefix = ipaddress.ip_network(msg['prefix'])
-                    nexthop = ipaddress.ip_address(msg['nexthop'])
-                    egress = ipaddress.ip_address(msg['egress'])
-                    pathid = int(msg['pathid'])
-                    for_peer = msg['for_peer']
-                    if for_peer:
-                        peer = self.peers[routerid]
-                        if command == 'add_mapping':
-                            msgs = self._add_mapping(routerid, prefix, nexthop, egress, pathid)
-                        elif command == 'del_mapping':
-                            msgs = self._del_mapping(routerid, prefix, nexthop, egress, pathid)
-                    else:
-                        best_route = self.bgp.best_routes.get(prefix)
-                        if best_route and best_route.nexthop == nexthop:
-                            return
-                        route = self._route_by_nexthop(prefix, nexthop)
-                        if not route:
-                            return
-                        self.bgp.best_routes[prefix] = route
-                        learned_peer = self.peers[route.learned_from_peer]
-                        self._update_fib(route.prefix, route.nexthop, learned_peer.dp_id, learned_peer.vlan_vid)
-                        for peer in self.peers.values():
-                            if peer.peer_ip == route.learned_from_peer:
-                                continue
-                            msgs.extend(self.bgp.announce(peer, route))
-                elif command == 'add_tunnel':
-                    pass
-            for msg in msgs:
-                self._send_to_exabgp(msg)
+                try:
+                    msgs, result = self._process_server_command(msg)
+                except Exception as e:
+                    self.logger.error('Error when handling %s: %s' % (msg, e))
+                    result = {'status': 'error', 'error': str(e)}
+                for exabgp_msg in msgs:
+                    self._send_to_exabgp(exabgp_msg)
+                # a bulk mapping is always acked, the server waits on its result
+                if msg.get('seq') is not None or msg.get('command') == 'bulk_mapping':
+                    self._ack_command(msg, result)
         except Exception as e:
             self.logger.error('Error when handling %s: %s' % (msg, e))
+
+    def _process_server_command(self, msg):
+        """Execute a command of the route server. Returns the ExaBGP messages and
+        the result of the command."""
+        msgs = []
+        result = {'status': 'ok'}
+        command = msg.get('command')
+        if command in ['add_mapping', 'del_mapping']:
+            routerid = ipaddress.ip_address(msg['routerid'])
+            prefix = ipaddress.ip_network(msg['prefix'])
+            nexthop = ipaddress.ip_address(msg['nexthop'])
+            egress = ipaddress.ip_address(msg['egress'])
+            pathid = int(msg['pathid'])
+            for_peer = msg['for_peer']
+            if for_peer:
+                if command == 'add_mapping':
+                    msgs = self._add_mapping(routerid, prefix, nexthop, egress, pathid)
+                elif command == 'del_mapping':
+                    msgs = self._del_mapping(routerid, prefix, nexthop, egress, pathid)
+            else:
+                msgs = self._set_best_paths([prefix], nexthop)
+        elif command == 'bulk_mapping':
+            msgs, result = self._bulk_mapping(msg['mappings'])
+            # one write to ExaBGP for the whole transaction
+            msgs = ['\n'.join(msgs)] if msgs else []
+        elif command == 'add_tunnel':
+            pass
+        elif command == 'reload_config':
+            self.reload_config()
+        elif command == 'get_stats':
+            self._send_to_server(dict(
+                msg_type='stats', routerid=str(self.routerid), **self.stats()))
+        else:
+            result = {'status': 'error', 'error': 'unknown command %s' % command}
+        return msgs, result
+
+    def _ack_command(self, msg, result):
+        """Ack a server command, or nack it if it failed, with the seq of the command if
+        it has one. The reply carries the FIB generation once the command is applied and
+        the number of ExaBGP messages waiting to be processed, so the server can size
+        its window."""
+        if self.fib:
+            # the FIB changes of the command are programmed before the ack, not on the
+            # timer flush, the fib_generation of the ack covers them
+            self._flush_fib()
+        ack = dict(
+            result, msg_type='nack' if result['status'] == 'error' else 'ack',
+            routerid=str(self.routerid), command=msg.get('command'),
+            fib_generation=self.fib_generation, queued=len(self.exabgp_connect.recv_queue))
+        if msg.get('seq') is not None:
+            ack['seq'] = msg['seq']
+        self._send_to_server(ack)
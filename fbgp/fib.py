@@ -0,0 +1,246 @@
+"""Compress the FIB before it is programmed into the dataplane.
+
+The FIB (prefix -> target, the target being what a route is programmed with,
+i.e. nexthop, dpid and vid) is split in blocks of BLOCK_LEN bits (/16 for
+IPv4, /32 for IPv6). Within a block, prefixes are aggregated the ORTC way
+restricted to exact aggregation:
+
+- a prefix whose whole range forwards to the same target, through its own
+  entry or fully covering more specific ones, is installed as one entry
+- an entry is not installed if the nearest installed entry covering it has
+  the same target
+- an aggregate that is installed stays installed while its range is fully
+  covered, the more specifics that forward elsewhere are installed under it
+
+Addresses not covered by the original FIB are never covered by an installed
+entry, so forwarding is the same as with the uncompressed FIB. Prefixes
+shorter than the block length are installed as they are.
+
+Changes are only recorded, flush() recomputes for each changed prefix the
+smallest subtree around it whose entries do not depend on the rest of the
+block, i.e. the changed prefix or the covering aggregate, and returns the
+entries to add and to delete in the dataplane. A new block, or a block with
+more than FULL_BLOCK changes, is recomputed as a whole.
+"""
+
+import ipaddress
+
+BLOCK_LEN = {4: 16, 6: 32}
+MAX_LEN = {4: 32, 6: 128}
+FULL_BLOCK = 32 # changes above which a block is recomputed as a whole
+
+_NETWORK_CLS = {4: ipaddress.IPv4Network, 6: ipaddress.IPv6Network}
+_MIXED = object() # the range of a node forwards to more than one target
+_PARTIAL = object() # the range of a node partly forwards nowhere
+
+
+class FibCompressor:
+    """Maintain a compressed copy of the FIB."""
+
+    def __init__(self, dirty_handler=None):
+        """dirty_handler is called on the first change after a flush."""
+        self.dirty_handler = dirty_handler
+        # (version, block) -> {(prefixlen, network): target}, block is None for the
+        # prefixes shorter than the blocks
+        self._blocks = {}
+        self._installed = {} # same, the entries installed in the dataplane
+        self._dirty = {} # (version, block) -> keys changed since the last flush
+        self.num_routes = 0
+        self.num_entries = 0
+        self.route_ops_total = 0 # add/del ops the route changes are without compression
+        self.ops_total = 0 # add/del ops returned by flush
+
+    def set(self, prefix, target):
+        """Set the target of a prefix, None removes the prefix. A change that leaves
+        the target of the prefix as it is does not make its block dirty."""
+        version = prefix.version
+        network = int(prefix.network_address)
+        if prefix.prefixlen < BLOCK_LEN[version]:
+            block = (version, None)
+        else:
+            block = (version, network >> (MAX_LEN[version] - BLOCK_LEN[version]))
+        key = (prefix.prefixlen, network)
+        entries = self._blocks.get(block)
+        old = entries.get(key) if entries else None
+        if old == target:
+            return
+        if entries is None:
+            entries = self._blocks[block] = {}
+        if target is None:
+            del entries[key]
+            self.num_routes -= 1
+        else:
+            if old is None:
+                self.num_routes += 1
+            entries[key] = target
+        self.route_ops_total += 1
+        if not self._dirty and self.dirty_handler:
+            self.dirty_handler()
+        self._dirty.setdefault(block, set()).add(key)
+
+    def remove(self, prefix):
+        self.set(prefix, None)
+
+    def flush(self):
+        """Recompute around the changed prefixes. Returns the (prefix, target) entries to
+        add and the (prefix, target) entries to delete, an add replaces the entry of its
+        prefix."""
+        adds = []
+        dels = []
+        for block, keys in self._dirty.items():
+            version, block_network = block
+            entries = self._blocks.get(block, {})
+            installed = self._installed.setdefault(block, {})
+            before = {} # key -> target installed before the flush, for the changed keys
+            if block_network is None:
+                for key in keys:
+                    before[key] = installed.get(key)
+                    self._install(installed, key, entries.get(key))
+            else:
+                max_len = MAX_LEN[version]
+                root = (BLOCK_LEN[version], block_network << (max_len - BLOCK_LEN[version]))
+                if not installed or len(keys) > FULL_BLOCK:
+                    keys = [root]
+                done = []
+                for key in sorted(keys):
+                    if any(self._contains(node, key, max_len) for node in done):
+                        continue
+                    node = self._recompute(key, root, entries, installed, before, max_len)
+                    done.append(node)
+            if not entries:
+                self._blocks.pop(block, None)
+            if not installed:
+                del self._installed[block]
+            for key, old in before.items():
+                new = installed.get(key)
+                if new == old:
+                    continue
+                if new is not None:
+                    adds.append((_NETWORK_CLS[version](key[::-1]), new))
+                elif old is not None:
+                    dels.append((_NETWORK_CLS[version](key[::-1]), old))
+                self.num_entries += (new is not None) - (old is not None)
+        self._dirty = {}
+        self.ops_total += len(adds) + len(dels)
+        return adds, dels
+
+    def _recompute(self, key, root, entries, installed, before, max_len):
+        """Recompute the entries of the smallest node containing key and the installed
+        entry covering it whose entries do not depend on the rest of the block, the node
+        has a route of its own, or its range is fully covered, or the entry covering it
+        from above is the one of the nearest route above it. Returns the node."""
+        node = key
+        while node != root and node not in installed:
+            node = self._parent(node, max_len)
+        if node not in installed:
+            node = key
+        while True:
+            items = [item + (target,) for item, target in entries.items()
+                     if self._contains(node, item, max_len)]
+            summaries = {}
+            summary = self._summarize(node, items, max_len, summaries) if items else None
+            covering = self._covering(installed, node, root, max_len)
+            if (node == root or node in entries or summary not in (None, _PARTIAL) or
+                    covering == self._covering(entries, node, root, max_len)):
+                break
+            node = self._parent(node, max_len)
+        new = {}
+        if summary is not None:
+            self._emit(node, covering, summaries, new, installed)
+        for item in [item for item in installed if self._contains(node, item, max_len)]:
+            if item not in new:
+                before.setdefault(item, installed[item])
+                self._install(installed, item, None)
+        for item, target in new.items():
+            before.setdefault(item, installed.get(item))
+            self._install(installed, item, target)
+        return node
+
+    @staticmethod
+    def _install(installed, key, target):
+        if target is None:
+            installed.pop(key, None)
+        else:
+            installed[key] = target
+
+    @staticmethod
+    def _contains(node, key, max_len):
+        return key[0] >= node[0] and (key[1] ^ node[1]) >> (max_len - node[0]) == 0
+
+    @staticmethod
+    def _parent(node, max_len):
+        prefixlen = node[0] - 1
+        return (prefixlen, node[1] & ~((1 << (max_len - prefixlen)) - 1))
+
+    def _covering(self, table, node, root, max_len):
+        """Return the target of the nearest entry of table above node in the block."""
+        while node != root:
+            node = self._parent(node, max_len)
+            if node in table:
+                return table[node]
+        return None
+
+    def _summarize(self, node, items, max_len, summaries):
+        """Return the target the whole range of node forwards to, None if no item covers
+        it, _PARTIAL if some of it is not covered, _MIXED otherwise. The summaries of the
+        nodes are kept for _emit."""
+        prefixlen, network = node
+        own = None
+        left = []
+        right = []
+        bit = 1 << (max_len - prefixlen - 1) if prefixlen < max_len else 0
+        for item in items:
+            if item[0] == prefixlen:
+                own = item[2]
+            elif item[1] & bit:
+                right.append(item)
+            else:
+                left.append(item)
+        children = []
+        halves = []
+        for child, child_items in [((prefixlen + 1, network), left), ((prefixlen + 1, network | bit), right)]:
+            if child_items:
+                children.append(child)
+                halves.append(self._summarize(child, child_items, max_len, summaries))
+            else:
+                halves.append(None)
+        if own is not None:
+            halves = [own if half is None else half for half in halves]
+        if prefixlen == max_len:
+            summary = own
+        elif halves[0] == halves[1] and halves[0] is not None:
+            summary = halves[0]
+        elif None in halves or _PARTIAL in halves:
+            summary = _PARTIAL
+        else:
+            summary = _MIXED
+        summaries[node] = (summary, own, children)
+        return summary
+
+    def _emit(self, node, covering, summaries, new, installed):
+        """Add the entries to install for node to new, covering is the target of the
+        nearest installed entry covering node. An aggregate in installed is kept when
+        the range of its node is still fully covered."""
+        summary, own, children = summaries[node]
+        if summary is not _MIXED and summary is not _PARTIAL:
+            if summary != covering:
+                new[node] = summary
+            return
+        if own is None and summary is _MIXED and node in installed and any(
+                summaries[child][0] == installed[node] for child in children):
+            own = installed[node]
+        if own is not None:
+            if own != covering:
+                new[node] = own
+            covering = own
+        for child in children:
+            self._emit(child, covering, summaries, new, installed)
+
+    def stats(self):
+        return {'fib_routes': self.num_routes,
+                'fib_entries': self.num_entries,
+                'fib_compression_ratio': round(self.num_entries / self.num_routes, 3) if self.num_routes else 1.0,
+                # a change can cost more ops than without compression when it splits
+                # an aggregate, the two counters tell what the compression saves overall
+                'fib_ops_total': self.ops_total,
+                'fib_route_ops_total': self.route_ops_total}
@@ -10,22 +10,31 @@ class Policy:
     def __init__(self, filter_, actions=None):
         self._filter = filter_
         self._actions = actions
+        self._apply = compile_actions(actions)
 
     def evaluate(self, route):
+        """Return the route as modified by the actions if it matches the filter, or None.
+        The route itself is never modified, a copy is returned if the actions change it."""
         if self._filter.match(route):
-            self._apply_actions(route)
-            return route
+            return self._apply(route) if self._apply else route
         return None
 
-    def _apply_actions(self, route):
-        """Not doing anything at the moment
-        """
-        return route
-
     @classmethod
     def default(cls):
         return cls(filter_=FilterANY())
 
+    @classmethod
+    def parse(cls, conf):
+        """Create a policy from a peer's config: None (accept everything),
+        a filter string, or a dict with a filter and actions."""
+        if conf is None:
+            return cls.default()
+        if isinstance(conf, str):
+            return cls(filter_=Filter.parse(conf))
+        actions = conf.get('actions')
+        return cls(filter_=Filter.parse(conf.get('filter', 'any')),
+                   actions=Action.parse(actions) if actions else None)
+
     def __str__(self):
         return "Policy(filter=%s, actions=%s)" % (self._filter, self._actions)
     __repr__ = __str__
@@ -201,6 +210,61 @@ class FilterPrefixRange(Filter):
         return "%s(%s)" % (self.__class__.__name__, self.prefix_range)
 
 
+# indexes of the attributes rewritten by actions
+AS_PATH, ORIGIN, LOCAL_PREF, MED, COMMUNITY, NEXTHOP = range(6)
+ATTRIBUTES = {'aspath': AS_PATH, 'origin': ORIGIN, 'pref': LOCAL_PREF, 'local_pref': LOCAL_PREF,
+              'med': MED, 'community': COMMUNITY, 'nexthop': NEXTHOP}
+MAX_INTERNED = 65536
+_UNCHANGED = object()
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def compile_actions(actions):
+    """Compile actions into a single function applying them to a route.
+
+    The function returns the route itself if the actions change nothing, and
+    otherwise a copy sharing the rewritten attributes with all the other
+    routes that had the same attributes: results are interned by input
+    attributes, so rewriting many routes with the same attributes computes
+    and stores one attribute record.
+    """
+    steps = [action.compile() for action in actions or [] if action.key]
+    if not steps:
+        return None
+    results = {}
+
+    def apply(route):
+        key = (_freeze(route.as_path), route.origin, route.local_pref, route.med,
+               _freeze(route.community), route.nexthop)
+        attrs = results.get(key)
+        if attrs is None:
+            attrs = list(key)
+            for step in steps:
+                step(attrs)
+            attrs = tuple(attrs)
+            if attrs == key:
+                attrs = _UNCHANGED
+            else:
+                # one as_path list shared by all the rewritten routes
+                attrs = (list(attrs[AS_PATH]),) + attrs[1:]
+            if len(results) >= MAX_INTERNED:
+                results.clear()
+            results[key] = attrs
+        if attrs is _UNCHANGED:
+            return route
+        route = route.copy()
+        (route.as_path, route.origin, route.local_pref, route.med,
+         route.community, route.nexthop) = attrs
+        return route
+
+    return apply
+
+
 class Action:
     """an action syntax:
     key = value or key.method(value). Ex:
@@ -211,9 +275,19 @@ class Action:
         self.key = key
         self.value = value
 
-    def apply(self, route):
-        if self.key and self.value and self.key in route:
-            route[self.key] = self.value
+    def apply(self, attrs):
+        """Set the attribute named by key in a list of attributes (see AS_PATH...) to value."""
+        index = ATTRIBUTES.get(self.key)
+        if index is not None and self.value is not None:
+            attrs[index] = self.value
+
+    def compile(self):
+        """Return a function applying the action to a list of attributes, the subclasses
+        return one with the action's values bound."""
+
+        def step(attrs):
+            self.apply(attrs)
+        return step
 
     @classmethod
     def parse(cls, line):
@@ -222,78 +296,125 @@ class Action:
         line = line.strip().replace(' ','')
         actions = []
         for action_str in line.split(';'):
-            action_cls = None
-            if 'community' in action_str:
+            if not action_str:
+                continue
+            if action_str.startswith('community'):
                 action_cls = ActionCommunity
-            elif 'aspath' in action_str:
+            elif action_str.startswith('aspath'):
                 action_cls = ActionASpathPrepend
-            if action_cls in [ActionCommunity, ActionASpathPrepend]:
-                actions.append(action_cls.parse(line))
-                continue
-
-            if 'pref' in action_str:
+            elif action_str.startswith('pref') or action_str.startswith('local_pref'):
                 action_cls = ActionSetPref
-            elif 'med' in action_str:
+            elif action_str.startswith('med'):
                 action_cls = ActionSetMed
-            elif 'origin' in action_str:
+            elif action_str.startswith('origin'):
                 action_cls = ActionSetOrigin
-            elif 'nexthop' in action_str:
+            elif action_str.startswith('nexthop'):
                 action_cls = ActionSetNexthop
-            action_key, action_value = action_str.split('=')
-            actions.append(action_cls(action_key, action_value))
+            else:
+                raise Exception('Unknown action %s' % action_str)
+            actions.append(action_cls.parse(action_str))
         return actions
 
     def __str__(self):
         return '<%s %s=%s>' % (self.__class__.__name__, self.key, self.value)
 
 
-class ActionSetPref(Action):
+class ActionSet(Action):
+    """Set an attribute to a value."""
+
+    INDEX = None
+
+    def compile(self):
+        index, value = self.INDEX, self.value
+
+        def step(attrs):
+            attrs[index] = value
+        return step
+
     @classmethod
     def parse(cls, line):
         key, value = line.split('=')
-        return cls(key, int(value))
+        return cls(key, cls.parse_value(value))
 
+    @staticmethod
+    def parse_value(value):
+        return int(value)
 
-class ActionSetMed(Action):
-    pass
 
+class ActionSetPref(ActionSet):
+    INDEX = LOCAL_PREF
 
-class ActionSetOrigin(Action):
-    pass
 
+class ActionSetMed(ActionSet):
+    INDEX = MED
 
-class ActionSetNexthop(Action):
-    pass
+
+class ActionSetOrigin(ActionSet):
+    INDEX = ORIGIN
+
+    @staticmethod
+    def parse_value(value):
+        value = value.lower()
+        if value not in ('igp', 'egp', 'incomplete'):
+            raise Exception('Unknown origin %s' % value)
+        return value
+
+
+class ActionSetNexthop(ActionSet):
+    INDEX = NEXTHOP
+
+    @staticmethod
+    def parse_value(value):
+        return ipaddress.ip_address(value)
 
 
 class ActionCommunity(Action):
+    """community = {1:2, 3:4} sets the communities, community .= {345:80} adds to them."""
+
+    def __init__(self, key, value, add=False):
+        super(ActionCommunity, self).__init__(key, value)
+        self.add = add
+
+    def compile(self):
+        value, add = self.value, self.add
+
+        def step(attrs):
+            if add:
+                current = attrs[COMMUNITY] or ()
+                attrs[COMMUNITY] = current + tuple(c for c in value if c not in current)
+            else:
+                attrs[COMMUNITY] = value
+        return step
+
     @classmethod
     def parse(cls, line):
-        raise Exception('Not supported')
+        key, value = line.split('=')
+        add = key.endswith('.')
+        communities = []
+        for community in value.replace('{', '').replace('}', '').split(','):
+            if community:
+                asn, tag = community.split(':')
+                communities.append((int(asn), int(tag)))
+        return cls(key.rstrip('.'), tuple(communities), add)
 
 
 class ActionASpathPrepend(Action):
-    def __init__(self, key, method, value):
-        self.action_key = key
-        self.action_value = value
-        self.method = method
+    """aspath.prepend(AS1, AS1) prepends the AS numbers to the AS path."""
+
+    def compile(self):
+        value = tuple(self.value)
+
+        def step(attrs):
+            attrs[AS_PATH] = value + tuple(attrs[AS_PATH] or ())
+        return step
 
     @classmethod
     def parse(cls, line):
-        key, method = line.split(';|.')
-        try:
-            method = int(method)
-        except:
-            pass
-        instance = None
-        if isinstance(method, int):
-            instance = cls(key, 'set', method)
-        elif 'prepend' in method:
-            _, method = method.split('prepend')
-            method = method.replace('(', '').replace(')', '')
-            method = list(map(int, method.split(',')))
-            instance = cls(key, 'prepend', method)
-        return instance
+        key, method = line.split('.', 1)
+        if not method.startswith('prepend(') or not method.endswith(')'):
+            raise Exception('Unknown as path action %s' % line)
+        asns = method[len('prepend('):-1].lower().replace('as', '')
+        return cls(key, [int(asn) for asn in asns.split(',') if asn])
 
 
 class ASPathRegex:
@@ -394,11 +515,12 @@ class ASSet(object):
 
 class PrefixRange(object):
     """A prefix range representation in policy config.
-    Ex. '{1.0.0.0/12^+}' means a range of prefixes from 1.0.0.0/12 to 1.0.0.0/32.
+    Ex. '{1.0.0.0/12^+}' means a range of prefixes from 1.0.0.0/12 to 1.0.0.0/32,
+    '{2001:db8::/32^48}' a range of IPv6 prefixes from 2001:db8::/48 to 2001:db8::/128.
     """
 
     def __init__(self, prefix, n, m):
-        self.prefix = IPv4Prefix(prefix)
+        self.prefix = ipaddress.ip_network(prefix)
         self.n = n # lower bound
         self.m = m # higher bound
 
@@ -412,22 +534,24 @@ class PrefixRange(object):
     def contains(self, prefix):
         """Test if a prefix belongs to this range
         Args:
-            prefix (str or ipaddress.IPv4Prefix): a prefix to be tested
+            prefix (ipaddress.IPv4Network or IPv6Network): a prefix to be tested
         Returns:
             True if the prefix is within the range
         """
-        return (prefix in self.prefix and
+        # no subnet_of, it is not in Python 3.6
+        return (prefix.version == self.prefix.version and
+                prefix.prefixlen >= self.prefix.prefixlen and
                 prefix.prefixlen <= self.m and
-                prefix.prefixlen >= self.n)
+                prefix.prefixlen >= self.n and
+                prefix.supernet(new_prefix=self.prefix.prefixlen) == self.prefix)
 
     @classmethod
     def parse(cls, line):
         """A valid prefix range should look like: '128.9.0.0/16', '128.6.0.0/16^-,
-        '128.6.0.0/16^+', '128.6.0.0/16^20-24' or '128.6.0.0/20'
+        '128.6.0.0/16^+', '128.6.0.0/16^20-24', '128.6.0.0/20' or '2001:db8::/32^+'
         """
         try:
-            prefix = re.findall(r'\d+.\d+.\d+.\d+/\d+', line)[0]
-            prefix = prefix.strip()
+            prefix = line.split('^')[0].strip()
             prefix = ipaddress.ip_network(prefix)
             ops = re.split(r'\^', line)
             n = m = 0
@@ -462,15 +586,41 @@ class PrefixRange(object):
 
 
 class PrefixSet:
+    """A set of prefix ranges, IPv4 and IPv6.
+
+    The ranges are indexed by IP version and prefix length, then by the integer
+    network address. A lookup checks one hash bucket per prefix length used in
+    the set instead of every range.
+    """
 
     def __init__(self, prefix_set):
-        """prefix_set (set) is a set of prefix, e.g. ['1.0.0.0/20', '2.0.0.0/16']"""
+        """prefix_set (set) is a set of PrefixRange"""
         self.prefix_set = prefix_set
+        self._index = {} # (version, prefixlen) -> {network address (int): [ranges]}
+        for prefix_range in prefix_set:
+            prefix = prefix_range.prefix
+            self._index.setdefault((prefix.version, prefix.prefixlen), {}).setdefault(
+                int(prefix.network_address), []).append(prefix_range)
+        self._lengths = {} # version -> sorted prefix lengths
+        for version, prefixlen in self._index:
+            self._lengths.setdefault(version, []).append(prefixlen)
+        for lengths in self._lengths.values():
+            lengths.sort()
 
     def contains(self, prefix):
-        for prefixrange in self.prefix_set:
-            if prefixrange.contains(prefix):
-                return True
+        version = prefix.version
+        prefixlen = prefix.prefixlen
+        bits = prefix.max_prefixlen
+        addr = int(prefix.network_address)
+        for length in self._lengths.get(version, ()):
+            if length > prefixlen:
+                break
+            shift = bits - length
+            ranges = self._index[(version, length)].get(addr >> shift << shift)
+            if ranges:
+                for prefix_range in ranges:
+                    if prefix_range.n <= prefixlen <= prefix_range.m:
+                        return True
         return False
 
     @classmethod
@@ -0,0 +1,279 @@
+"""Read-only export of the best routes and per-peer Adj-RIB-In through a memory-mapped file.
+
+fbgp appends changes to the file as a log of records, other local processes
+(monitoring, looking glass) map the file and replay the log without any locking
+or IPC with fbgp. Layout (network byte order):
+
+    header  magic, version, flags, seq, generation, data_end, capacity
+    log     records appended up to data_end, each is op (u8), length (u32), body
+
+The header is protected by a seqlock: the writer makes seq odd before appending
+records and moving data_end, and even again afterwards. A reader retries until
+it sees the same even seq before and after reading, seq / 2 is the RIB version.
+When the log is full the writer compacts the current state into a new file,
+renames it over the old one and flags the old one as superseded.
+"""
+import os
+import mmap
+import json
+import time
+import struct
+import collections
+
+from fbgp.snapshot import BufferReader, pack_addr, pack_prefix
+
+MAGIC = b'FBGPEXP\x00'
+VERSION = 2 # 1 had u16 lengths, a long AS path or community list overflowed them
+HEADER_SIZE = 64
+DEFAULT_CAPACITY = 64 * 1024 * 1024
+
+FLAG_SUPERSEDED = 0x01 # the file has been replaced by a compacted one, reopen the path
+
+OP_BEST_ADD = 1
+OP_BEST_DEL = 2
+OP_RIB_IN_ADD = 3
+OP_RIB_IN_DEL = 4
+OP_PEER_CLEAR = 5
+
+_HEADER = struct.Struct('!8sHH4xQQQQ')
+_SEQ = struct.Struct('!Q')
+_SEQ_OFFSET = 16
+_POSITION = struct.Struct('!HH4xQQQQ') # version ... capacity, read from offset 8
+_RECORD = struct.Struct('!BI')
+_U32 = struct.Struct('!I')
+
+ExportedRoute = collections.namedtuple(
+    'ExportedRoute',
+    ['prefix', 'nexthop', 'peer_ip', 'as_path', 'origin', 'local_pref', 'med', 'community'])
+
+
+class RibExporter:
+    """Publish best routes and Adj-RIB-In changes to a memory-mapped file.
+
+    Changes are only marked here, the records are built from the current state
+    of the RIBs when flush() is called, so repeated changes of a prefix between
+    two flushes are written once.
+    """
+
+    def __init__(self, path, bgp, peers, capacity=DEFAULT_CAPACITY):
+        self.path = path
+        self.bgp = bgp
+        self.peers = peers
+        self.capacity = capacity
+        self.generation = 0
+        self._file = None
+        self._buf = None
+        self._data_end = HEADER_SIZE
+        self._seq = 0
+        self._attrs = {}
+        self._dirty_best = set()
+        self._dirty_rib_in = set()
+        self._cleared_peers = []
+        self.compact()
+
+    def best_changed(self, prefix):
+        self._dirty_best.add(prefix)
+
+    def rib_in_changed(self, peer_ip, prefix):
+        self._dirty_rib_in.add((peer_ip, prefix))
+
+    def peer_cleared(self, peer_ip):
+        """All routes of a peer are gone (e.g. session down)."""
+        self._cleared_peers.append(peer_ip)
+        self._dirty_rib_in = set(key for key in self._dirty_rib_in if key[0] != peer_ip)
+
+    def _encode_attrs(self, route):
+        key = (tuple(route.as_path), route.origin, route.local_pref, route.med, repr(route.community))
+        attrs = self._attrs.get(key)
+        if attrs is None:
+            attrs = json.dumps(
+                [route.as_path, route.origin, route.local_pref, route.med, route.community],
+                separators=(',', ':')).encode('utf-8')
+            attrs = self._attrs[key] = _U32.pack(len(attrs)) + attrs
+        return attrs
+
+    def _encode_route(self, op, peer_ip, route):
+        body = b''.join((pack_prefix(route.prefix), pack_addr(peer_ip),
+                         pack_addr(route.nexthop), self._encode_attrs(route)))
+        return _RECORD.pack(op, len(body)) + body
+
+    @staticmethod
+    def _encode(op, body):
+        return _RECORD.pack(op, len(body)) + body
+
+    def _state_records(self):
+        records = []
+        for peer in self.peers.values():
+            for route in peer._rib_in.values():
+                records.append(self._encode_route(OP_RIB_IN_ADD, peer.peer_ip, route))
+        for route in self.bgp.best_routes.values():
+            records.append(self._encode_route(OP_BEST_ADD, route.from_peer, route))
+        return records
+
+    def _change_records(self):
+        records = []
+        for peer_ip in self._cleared_peers:
+            records.append(self._encode(OP_PEER_CLEAR, pack_addr(peer_ip)))
+        for peer_ip, prefix in self._dirty_rib_in:
+            peer = self.peers.get(peer_ip)
+            route = peer._rib_in.get(prefix) if peer else None
+            if route:
+                records.append(self._encode_route(OP_RIB_IN_ADD, peer_ip, route))
+            else:
+                records.append(self._encode(OP_RIB_IN_DEL, pack_prefix(prefix) + pack_addr(peer_ip)))
+        for prefix in self._dirty_best:
+            route = self.bgp.best_routes.get(prefix)
+            if route:
+                records.append(self._encode_route(OP_BEST_ADD, route.from_peer, route))
+            else:
+                records.append(self._encode(OP_BEST_DEL, pack_prefix(prefix)))
+        return records
+
+    def _clear_changes(self):
+        self._dirty_best = set()
+        self._dirty_rib_in = set()
+        self._cleared_peers = []
+
+    def _write_seq(self, buf, seq):
+        _SEQ.pack_into(buf, _SEQ_OFFSET, seq)
+
+    def flush(self):
+        """Append the pending changes to the file. Return the number of records written."""
+        if not (self._dirty_best or self._dirty_rib_in or self._cleared_peers):
+            return 0
+        data = b''.join(self._change_records())
+        if self._data_end + len(data) > self.capacity:
+            return self.compact()
+        count = len(self._dirty_best) + len(self._dirty_rib_in) + len(self._cleared_peers)
+        self._clear_changes()
+        buf = self._buf
+        self._seq += 1
+        self._write_seq(buf, self._seq)
+        buf[self._data_end:self._data_end + len(data)] = data
+        self._data_end += len(data)
+        _HEADER.pack_into(buf, 0, MAGIC, VERSION, 0, self._seq, self.generation,
+                          self._data_end, self.capacity)
+        self._seq += 1
+        self._write_seq(buf, self._seq)
+        return count
+
+    def compact(self):
+        """Write the whole current state into a new file and replace the current one."""
+        self._clear_changes()
+        self._attrs = {}
+        records = self._state_records()
+        data = b''.join(records)
+        while HEADER_SIZE + 2 * len(data) > self.capacity:
+            self.capacity *= 2
+        self.generation += 1
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, 0, self._seq, self.generation,
+                                 HEADER_SIZE + len(data), self.capacity))
+            f.write(b'\x00' * (HEADER_SIZE - _HEADER.size))
+            f.write(data)
+            f.truncate(self.capacity)
+        new_file = open(tmp_path, 'r+b')
+        new_buf = mmap.mmap(new_file.fileno(), self.capacity)
+        os.replace(tmp_path, self.path)
+        self._supersede()
+        self._file, self._buf = new_file, new_buf
+        self._data_end = HEADER_SIZE + len(data)
+        return len(records)
+
+    def _supersede(self):
+        """Flag the current file as replaced and unmap it."""
+        if self._buf is None:
+            return
+        buf = self._buf
+        self._seq += 1
+        self._write_seq(buf, self._seq)
+        _HEADER.pack_into(buf, 0, MAGIC, VERSION, FLAG_SUPERSEDED, self._seq,
+                          self.generation - 1, self._data_end, self.capacity)
+        self._seq += 1
+        self._write_seq(buf, self._seq)
+        buf.close()
+        self._file.close()
+
+    def close(self):
+        self.flush()
+        self._buf.close()
+        self._file.close()
+
+
+class RibExportReader:
+    """Replay a file published by RibExporter into best_routes and rib_in (per peer)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._buf = None
+        self._open()
+
+    def _open(self):
+        self.close()
+        self._file = open(self.path, 'rb')
+        self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offset = HEADER_SIZE
+        self.generation = None
+        self.version = 0
+        self.best_routes = {}
+        self.rib_in = collections.defaultdict(dict)
+
+    def _read_header(self):
+        """Return a consistent (seq, flags, generation, data_end) and the new log data."""
+        buf = self._buf
+        while True:
+            seq, = _SEQ.unpack_from(buf, _SEQ_OFFSET)
+            if seq % 2:
+                time.sleep(0)
+                continue
+            _, flags, _, generation, data_end, _ = _POSITION.unpack_from(buf, 8)
+            data = buf[self._offset:data_end] if data_end > self._offset else b''
+            if _SEQ.unpack_from(buf, _SEQ_OFFSET)[0] == seq:
+                return seq, flags, generation, data_end, data
+
+    def refresh(self):
+        """Apply the changes published since the last refresh. Return the RIB version."""
+        seq, flags, generation, data_end, data = self._read_header()
+        if flags & FLAG_SUPERSEDED:
+            self._open()
+            return self.refresh()
+        self.generation = generation
+        self._apply(data)
+        self._offset = max(self._offset, data_end)
+        self.version = seq // 2
+        return self.version
+
+    def _read_route(self, reader, prefix, peer_ip):
+        nexthop = reader.addr()
+        size, = reader.unpack(_U32)
+        attrs = json.loads(reader.raw(size).decode('utf-8'))
+        return ExportedRoute(prefix, nexthop, peer_ip, *attrs)
+
+    def _apply(self, data):
+        reader = BufferReader(data)
+        while reader.offset < len(data):
+            op, size = reader.unpack(_RECORD)
+            end = reader.offset + size
+            if op == OP_PEER_CLEAR:
+                self.rib_in.pop(reader.addr(), None)
+            elif op in (OP_BEST_ADD, OP_BEST_DEL, OP_RIB_IN_ADD, OP_RIB_IN_DEL):
+                prefix = reader.prefix()
+                if op == OP_BEST_DEL:
+                    self.best_routes.pop(prefix, None)
+                else:
+                    peer_ip = reader.addr()
+                    if op == OP_BEST_ADD:
+                        self.best_routes[prefix] = self._read_route(reader, prefix, peer_ip)
+                    elif op == OP_RIB_IN_ADD:
+                        self.rib_in[peer_ip][prefix] = self._read_route(reader, prefix, peer_ip)
+                    else:
+                        self.rib_in[peer_ip].pop(prefix, None)
+            reader.offset = end # skip unknown records
+
+    def close(self):
+        if self._buf is not None:
+            self._buf.close()
+            self._file.close()
+            self._buf = None
@@ -2,7 +2,6 @@
 network events to the route controller and to receive control commands.
 """
 import eventlet
-eventlet.monkey_patch()
 
 import logging
 import json
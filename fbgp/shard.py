@@ -0,0 +1,243 @@
+"""Run the BGP selection in worker processes, sharded by prefix.
+
+ShardedBgpRouter is a drop-in replacement for BgpRouter. Each worker process
+owns the candidate routes of the prefixes hashed to it and runs the same
+selection code as BgpRouter. The main process keeps session handling and FIB
+and route server I/O, and a mirror of loc_rib/best_routes updated from the
+workers' results, so the rest of fbgp reads them as usual.
+
+Routes are sent to the workers as compact tuples (integer addresses) in one
+batch per worker, and identified by the id() of the main process object, so
+the best routes returned are the very objects single-process mode would return.
+The ops that return nothing (set_best_route, load_routes) are queued and sent
+ahead of the next batch. While the workers select, the caller waits on the hub,
+the other greenthreads run.
+
+The main process still encodes the routes and mirrors loc_rib, only the
+selection runs in the workers: with one CPU bench_shard is about 3x slower than
+a single process. Sharding is off by default (FBGP_WORKERS=0), it pays off only
+with cores to spare and a selection heavy load.
+"""
+import logging
+import multiprocessing
+
+from fbgp.bgp import BgpRouter, Route
+
+OP_ADD = 0
+OP_DEL = 1
+OP_SET_BEST = 2
+OP_LOAD = 3
+OP_LOAD_BEST = 4
+
+
+def _addr_key(addr):
+    """Encode an address as an integer, IPv6 ones are kept apart from IPv4 ones."""
+    if addr is None:
+        return None
+    if addr.version == 4:
+        return int(addr)
+    return int(addr) | (1 << 128)
+
+
+def _encode(route):
+    prefix = route.prefix
+    return ((prefix.version, int(prefix.network_address), prefix.prefixlen),
+            _addr_key(route.nexthop), route.as_path, route.origin, route.local_pref,
+            route.med, route.community, route.local, route.from_as,
+            _addr_key(route.from_peer), route.from_ibgp)
+
+
+class _Shard:
+    """The part of the RIB owned by a worker process."""
+
+    def __init__(self):
+        self.bgp = BgpRouter({}, {}, None)
+        self.routes = {} # rid -> route
+        self.rids = {} # id(route) -> rid
+
+    def _route(self, rid, fields):
+        route = self.routes.get(rid)
+        if route is None:
+            (prefix, nexthop, as_path, origin, local_pref, med, community,
+             local, from_as, from_peer, from_ibgp) = fields
+            route = Route(prefix, nexthop, as_path, origin, local_pref=local_pref, med=med,
+                          community=community, local=local, from_as=from_as,
+                          from_peer=from_peer, from_ibgp=from_ibgp)
+            self.routes[rid] = route
+            self.rids[id(route)] = rid
+        return route
+
+    def _rid(self, route):
+        if route is None:
+            return None
+        return self.rids[id(route)]
+
+    def _is_used(self, route):
+        prefix = route.prefix
+        if self.bgp.best_routes.get(prefix) is route:
+            return True
+        return any(candidate is route for candidate in self.bgp.loc_rib.get(prefix, ()))
+
+    def handle(self, ops):
+        """Apply a batch of ops, return the (new_best, cur_best) rids and the rids released."""
+        results = []
+        released = []
+        for op, rid, fields in ops:
+            route = self._route(rid, fields)
+            released.append(route)
+            if op == OP_ADD:
+                released.extend(
+                    candidate for candidate in self.bgp.loc_rib.get(route.prefix, ())
+                    if candidate.from_peer == route.from_peer)
+                new_best, cur_best = self.bgp.add_route(route)
+            elif op == OP_DEL:
+                released.extend(
+                    candidate for candidate in self.bgp.loc_rib.get(route.prefix, ())
+                    if candidate == route)
+                new_best, cur_best = self.bgp.del_route(route)
+            else:
+                cur_best = self.bgp.best_routes.get(route.prefix)
+                new_best = None
+                if op == OP_SET_BEST:
+                    self.bgp.set_best_route(route)
+                else:
+                    self.bgp.load_routes([(route, op == OP_LOAD_BEST)])
+            released.append(cur_best)
+            results.append((self._rid(new_best), self._rid(cur_best)))
+        freed = []
+        for route in released:
+            if route is None or id(route) not in self.rids or self._is_used(route):
+                continue
+            rid = self.rids.pop(id(route))
+            del self.routes[rid]
+            freed.append(rid)
+        return results, freed
+
+
+def _worker_main(conn):
+    shard = _Shard()
+    while True:
+        ops = conn.recv()
+        if ops is None:
+            break
+        conn.send(shard.handle(ops))
+    conn.close()
+
+
+class ShardedBgpRouter(BgpRouter):
+    """BGP selection sharded by prefix hash across a pool of worker processes."""
+
+    def __init__(self, borders, peers, path_change_handler, num_workers):
+        super(ShardedBgpRouter, self).__init__(borders, peers, path_change_handler)
+        self.logger = logging.getLogger('fbgp.shard')
+        self._routes = {} # id(route) -> route, for the routes held by the workers
+        self._conns = []
+        self._workers = []
+        self._queued = [] # per worker, the ops without results sent with the next batch
+        context = multiprocessing.get_context('spawn')
+        for i in range(num_workers):
+            conn, child_conn = context.Pipe()
+            worker = context.Process(
+                target=_worker_main, args=(child_conn,), name='fbgp-shard-%s' % i, daemon=True)
+            worker.start()
+            child_conn.close()
+            self._conns.append(conn)
+            self._workers.append(worker)
+            self._queued.append([])
+        try:
+            from eventlet.hubs import trampoline
+            from eventlet.semaphore import Semaphore
+        except ImportError:
+            trampoline = None
+            from threading import Lock as Semaphore
+        self._trampoline = trampoline
+        self._lock = Semaphore() # one batch in flight, the replies come in order
+        self.logger.info('started %s shard workers' % num_workers)
+
+    def _shard_ops(self, ops, batches):
+        """Add the (op, route) to the batches of the workers owning their prefixes,
+        return the worker of each op."""
+        shards = []
+        for op, route in ops:
+            shard = hash(route.prefix) % len(self._conns)
+            self._routes[id(route)] = route
+            batches[shard].append((op, id(route), _encode(route)))
+            shards.append(shard)
+        return shards
+
+    def _queue(self, ops):
+        """Queue ops whose results are not needed, they go with the next batch."""
+        self._shard_ops(ops, self._queued)
+
+    def _call(self, ops):
+        """Send (op, route) to the workers owning the routes' prefixes, in one batch per
+        worker after the ops queued for it. Return the (new_best, cur_best) routes in
+        the order of ops."""
+        with self._lock:
+            batches = self._queued
+            self._queued = [[] for _ in self._conns]
+            skipped = [len(batch) for batch in batches]
+            shards = self._shard_ops(ops, batches)
+            for conn, batch in zip(self._conns, batches):
+                if batch:
+                    conn.send(batch)
+            shard_results = []
+            freed = []
+            for conn, batch, skip in zip(self._conns, batches, skipped):
+                if not batch:
+                    shard_results.append(None)
+                    continue
+                if self._trampoline:
+                    # the hub runs the other greenthreads until the reply is there
+                    self._trampoline(conn.fileno(), read=True)
+                results, shard_freed = conn.recv()
+                shard_results.append(iter(results[skip:]))
+                freed.extend(shard_freed)
+        results = []
+        for shard in shards:
+            new_rid, cur_rid = next(shard_results[shard])
+            results.append((self._routes.get(new_rid), self._routes.get(cur_rid)))
+        for rid in freed:
+            self._routes.pop(rid, None)
+        return results
+
+    def apply_changes(self, changes):
+        results = self._call([(OP_DEL if withdraw else OP_ADD, route) for route, withdraw in changes])
+        for (route, withdraw), (new_best, _) in zip(changes, results):
+            prefix = route.prefix
+            if withdraw:
+                routes = self.loc_rib[prefix]
+                routes.discard(route)
+                if new_best:
+                    self.best_routes[prefix] = new_best
+                else:
+                    self.best_routes.pop(prefix, None)
+                if not routes:
+                    del self.loc_rib[prefix]
+            else:
+                self._insert_route(route)
+                if new_best:
+                    self.best_routes[prefix] = new_best
+        return results
+
+    def add_route(self, route):
+        return self.apply_changes([(route, False)])[0]
+
+    def del_route(self, route):
+        return self.apply_changes([(route, True)])[0]
+
+    def set_best_route(self, route):
+        self._queue([(OP_SET_BEST, route)])
+        super(ShardedBgpRouter, self).set_best_route(route)
+
+    def load_routes(self, routes):
+        self._queue([(OP_LOAD_BEST if best else OP_LOAD, route) for route, best in routes])
+        super(ShardedBgpRouter, self).load_routes(routes)
+
+    def stop(self):
+        for conn in self._conns:
+            conn.send(None)
+        for worker in self._workers:
+            worker.join(timeout=1)
+        self._conns = []
+        self._workers = []
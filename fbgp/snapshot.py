@@ -0,0 +1,207 @@
+"""Persistent snapshot of the RIB and allocation state, used for warm restart.
+
+The snapshot is a flat binary file that is read back through mmap. Layout
+(network byte order):
+
+    header      magic, version, created, current_pathid and section counts
+    attributes  interned path attributes, each a length-prefixed JSON record
+                [as_path, origin, local_pref, med, community]
+    peers       peer address, attachment point and the peer's Adj-RIB-In.
+                Each route is prefix, nexthop, attribute index and flags
+    pathids     nexthop -> pathid
+    vips        (nexthop, vlan vid) -> extra vip
+    mappings    (prefix, nexthop) -> peers the path is mapped to
+"""
+import os
+import mmap
+import json
+import struct
+import ipaddress
+
+from fbgp.bgp import Route
+
+MAGIC = b'FBGPRIB\x00'
+VERSION = 1
+
+ROUTE_ACCEPTED = 0x01 # route passed the import policy and is in loc_rib
+ROUTE_BEST = 0x02 # route is the best route of its prefix
+ROUTE_LOCAL = 0x04 # route is locally originated
+
+_HEADER = struct.Struct('!8sHdIIIIII')
+_U16 = struct.Struct('!H')
+_U32 = struct.Struct('!I')
+_ATTACHMENT = struct.Struct('!QHI')
+_ROUTE = struct.Struct('!IB')
+
+_ADDR_LEN = {4: 4, 6: 16}
+_ADDR_CLS = {4: ipaddress.IPv4Address, 6: ipaddress.IPv6Address}
+_NETWORK_CLS = {4: ipaddress.IPv4Network, 6: ipaddress.IPv6Network}
+
+
+def pack_addr(addr):
+    return bytes((addr.version,)) + addr.packed
+
+
+def pack_prefix(prefix):
+    return bytes((prefix.version, prefix.prefixlen)) + prefix.network_address.packed
+
+
+class BufferReader:
+    """Walk a memory-mapped buffer, decoding addresses through a cache."""
+
+    def __init__(self, buf, offset=0):
+        self.buf = buf
+        self.offset = offset
+        self._cache = {}
+
+    def unpack(self, fmt):
+        values = fmt.unpack_from(self.buf, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def raw(self, size):
+        data = self.buf[self.offset:self.offset + size]
+        self.offset += size
+        return data
+
+    def addr(self):
+        version = self.buf[self.offset]
+        raw = self.raw(1 + _ADDR_LEN[version])
+        if raw not in self._cache:
+            self._cache[raw] = _ADDR_CLS[version](raw[1:])
+        return self._cache[raw]
+
+    def prefix(self):
+        version = self.buf[self.offset]
+        raw = self.raw(2 + _ADDR_LEN[version])
+        if raw not in self._cache:
+            self._cache[raw] = _NETWORK_CLS[version]((raw[2:], raw[1]))
+        return self._cache[raw]
+
+
+class RibSnapshot:
+    """RIB and allocation state of a fbgp instance at one point in time."""
+
+    def __init__(self):
+        self.created = 0
+        self.current_pathid = 0
+        self.peers = {} # peer_ip -> (dp_id, vlan_vid, port_no)
+        self.routes = {} # peer_ip -> [(route, flags)]
+        self.nexthop_to_pathid = {}
+        self.vip_assignment = {} # (nexthop, vid) -> vip (str)
+        self.path_mapping = {} # (prefix, nexthop) -> set of peer_ip
+
+    def add_peer(self, peer, best_routes, loc_rib):
+        """Record a peer's attachment point and its Adj-RIB-In."""
+        self.peers[peer.peer_ip] = (peer.dp_id, peer.vlan_vid, peer.port_no)
+        routes = self.routes.setdefault(peer.peer_ip, [])
+        for prefix, route in peer._rib_in.items():
+            flags = 0
+            accepted = peer.accepted(prefix)
+            if accepted is not None:
+                if any(candidate is accepted for candidate in loc_rib.get(prefix, ())):
+                    flags |= ROUTE_ACCEPTED
+                if best_routes.get(prefix) is accepted:
+                    flags |= ROUTE_BEST
+            if route.local:
+                flags |= ROUTE_LOCAL
+            routes.append((route, flags))
+
+    def num_routes(self):
+        return sum(len(routes) for routes in self.routes.values())
+
+    def save(self, path):
+        """Write the snapshot to path, atomically replacing any previous one."""
+        attrs = {}
+        attr_idx = {}
+        chunks = []
+        for peer_ip, routes in self.routes.items():
+            dp_id, vlan_vid, port_no = self.peers.get(peer_ip, (None, None, None))
+            chunks.append(pack_addr(peer_ip))
+            chunks.append(_ATTACHMENT.pack(dp_id or 0, vlan_vid or 0, port_no or 0))
+            chunks.append(_U32.pack(len(routes)))
+            for route, flags in routes:
+                attr_key = (tuple(route.as_path), route.origin, route.local_pref,
+                            route.med, repr(route.community))
+                idx = attr_idx.get(attr_key)
+                if idx is None:
+                    key = json.dumps(
+                        [route.as_path, route.origin, route.local_pref, route.med, route.community],
+                        separators=(',', ':')).encode('utf-8')
+                    idx = attr_idx[attr_key] = attrs.setdefault(key, len(attrs))
+                chunks.append(pack_prefix(route.prefix))
+                chunks.append(pack_addr(route.nexthop))
+                chunks.append(_ROUTE.pack(idx, flags))
+        for nexthop, pathid in self.nexthop_to_pathid.items():
+            chunks.append(pack_addr(nexthop) + _U32.pack(pathid))
+        for (nexthop, vid), vip in self.vip_assignment.items():
+            vip = str(vip).encode('utf-8')
+            chunks.append(pack_addr(nexthop) + _U16.pack(vid) + _U16.pack(len(vip)) + vip)
+        for (prefix, nexthop), peer_ips in self.path_mapping.items():
+            chunks.append(pack_prefix(prefix) + pack_addr(nexthop) + _U16.pack(len(peer_ips)))
+            chunks.extend(pack_addr(peer_ip) for peer_ip in peer_ips)
+        header = _HEADER.pack(
+            MAGIC, VERSION, self.created, self.current_pathid, len(attrs), len(self.routes),
+            len(self.nexthop_to_pathid), len(self.vip_assignment), len(self.path_mapping))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            for key in attrs:
+                f.write(_U32.pack(len(key)))
+                f.write(key)
+            f.write(b''.join(chunks))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, peers):
+        """Read a snapshot written by save().
+        Args:
+            path: the snapshot file
+            peers: configured peers (peer_ip -> BgpPeer), routes of unknown peers are skipped
+        """
+        snapshot = cls()
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            reader = BufferReader(buf)
+            (magic, version, snapshot.created, snapshot.current_pathid, num_attrs,
+             num_peers, num_pathids, num_vips, num_mappings) = reader.unpack(_HEADER)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('%s is not a RIB snapshot (version %s)' % (path, VERSION))
+            attrs = []
+            for _ in range(num_attrs):
+                size, = reader.unpack(_U32)
+                attrs.append(json.loads(reader.raw(size).decode('utf-8')))
+            for _ in range(num_peers):
+                peer_ip = reader.addr()
+                dp_id, vlan_vid, port_no = reader.unpack(_ATTACHMENT)
+                num_routes, = reader.unpack(_U32)
+                peer = peers.get(peer_ip)
+                routes = []
+                for _ in range(num_routes):
+                    prefix = reader.prefix()
+                    nexthop = reader.addr()
+                    idx, flags = reader.unpack(_ROUTE)
+                    if peer is None:
+                        continue
+                    as_path, origin, local_pref, med, community = attrs[idx]
+                    route = Route(prefix, nexthop, list(as_path), origin,
+                                  local_pref=local_pref, med=med, community=community,
+                                  local=bool(flags & ROUTE_LOCAL), from_as=peer.peer_as,
+                                  from_peer=peer.peer_ip, from_ibgp=peer.is_ibgp())
+                    routes.append((route, flags))
+                if peer is not None:
+                    snapshot.peers[peer_ip] = (dp_id or None, vlan_vid or None, port_no or None)
+                    snapshot.routes[peer_ip] = routes
+            for _ in range(num_pathids):
+                nexthop = reader.addr()
+                snapshot.nexthop_to_pathid[nexthop], = reader.unpack(_U32)
+            for _ in range(num_vips):
+                nexthop = reader.addr()
+                vid, size = reader.unpack(_U16)[0], reader.unpack(_U16)[0]
+                snapshot.vip_assignment[(nexthop, vid)] = reader.raw(size).decode('utf-8')
+            for _ in range(num_mappings):
+                prefix = reader.prefix()
+                nexthop = reader.addr()
+                num_peers, = reader.unpack(_U16)
+                snapshot.path_mapping[(prefix, nexthop)] = set(
+                    reader.addr() for _ in range(num_peers))
+        return snapshot
@@ -0,0 +1,178 @@
+"""Hierarchical timer wheel driving all fbgp timers from one greenthread.
+
+Time is counted in ticks. The wheel has LEVELS levels of SLOTS slots each, a
+timer is put in the level covering its distance to the current tick, at the
+slot of its expiry tick, so schedule and cancel are O(1). When level 0 wraps
+the next slot of level 1 is cascaded down into level 0, and so on up the
+levels. Timers further than the wheel's range are capped into the top level
+and rescheduled when they get cascaded.
+
+The wheel only sleeps one tick at a time while timers are pending and waits
+for the first schedule otherwise.
+"""
+import time
+import logging
+
+SLOT_BITS = 8
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+LEVELS = 4
+
+
+class Timer:
+    """A scheduled callback, cancel() removes it from the wheel."""
+
+    __slots__ = ('expires', 'interval', 'callback', 'args', '_wheel', '_slot')
+
+    def __init__(self, wheel, interval, callback, args):
+        self.expires = 0
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self._wheel = wheel
+        self._slot = None
+
+    def pending(self):
+        return self._slot is not None
+
+    def cancel(self):
+        """Cancel the timer, and the next runs of a periodic timer."""
+        self.interval = None
+        self._wheel._remove(self)
+
+
+class TimerWheel:
+    """Schedule callbacks to run after a delay, or periodically."""
+
+    def __init__(self, tick=0.1, clock=time.monotonic):
+        self.logger = logging.getLogger('fbgp.timer')
+        self.tick = tick
+        self.clock = clock
+        self.count = 0
+        self.fired_total = 0
+        self._start = clock()
+        self._current = 0
+        self._levels = [[{} for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self._running = False
+        self._wakeup = None
+
+    def _now_tick(self):
+        return int((self.clock() - self._start) / self.tick)
+
+    def _ticks(self, delay):
+        return max(1, int(-(-delay // self.tick)))
+
+    def _add(self, timer):
+        distance = timer.expires - self._current
+        for level in range(LEVELS):
+            if distance < 1 << (SLOT_BITS * (level + 1)):
+                break
+        else:
+            # beyond the range of the wheel: park it in the top level, it is
+            # put back at its expiry when cascaded
+            distance = (1 << (SLOT_BITS * LEVELS)) - 1
+        expires = self._current + distance
+        slot = self._levels[level][(expires >> (SLOT_BITS * level)) & SLOT_MASK]
+        slot[timer] = None
+        timer._slot = slot
+        self.count += 1
+
+    def _remove(self, timer):
+        if timer._slot is not None:
+            del timer._slot[timer]
+            timer._slot = None
+            self.count -= 1
+
+    def schedule(self, delay, callback, *args):
+        """Run callback(*args) after delay seconds. Returns the Timer."""
+        timer = Timer(self, None, callback, args)
+        self._schedule(timer, delay)
+        return timer
+
+    def every(self, interval, callback, *args):
+        """Run callback(*args) every interval seconds. Returns the Timer."""
+        timer = Timer(self, interval, callback, args)
+        self._schedule(timer, interval)
+        return timer
+
+    def _schedule(self, timer, delay):
+        if not self.count:
+            # nothing was pending, the wheel may not have moved for a while
+            self._current = max(self._current, self._now_tick())
+        timer.expires = self._current + self._ticks(delay)
+        self._add(timer)
+        if self._wakeup is not None and not self._wakeup.ready():
+            self._wakeup.send()
+
+    def _cascade(self, level):
+        """Move the timers of the current slot of a level down the wheel."""
+        idx = (self._current >> (SLOT_BITS * level)) & SLOT_MASK
+        slot = self._levels[level][idx]
+        self._levels[level][idx] = {}
+        for timer in slot:
+            timer._slot = None
+            self.count -= 1
+            self._add(timer)
+        return idx
+
+    def advance(self):
+        """Run the timers expired by now. Returns the number of timers run."""
+        target = self._now_tick()
+        fired = 0
+        while self._current < target:
+            if not self.count:
+                self._current = target
+                break
+            self._current += 1
+            level = 1
+            while level < LEVELS and not self._current & ((1 << (SLOT_BITS * level)) - 1):
+                self._cascade(level)
+                level += 1
+            idx = self._current & SLOT_MASK
+            slot = self._levels[0][idx]
+            self._levels[0][idx] = {}
+            for timer in slot:
+                timer._slot = None
+                self.count -= 1
+                if timer.expires > self._current:
+                    # was capped at the range of the wheel
+                    self._add(timer)
+                    continue
+                if timer.interval is not None:
+                    timer.expires = self._current + self._ticks(timer.interval)
+                    self._add(timer)
+                fired += 1
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    self.logger.error('Error %s in timer %s' % (e, timer.callback))
+        self.fired_total += fired
+        return fired
+
+    def _run(self):
+        import eventlet
+        from eventlet import event
+        while self._running:
+            if self.count:
+                eventlet.sleep(self.tick)
+            else:
+                self._wakeup = event.Event()
+                self._wakeup.wait()
+                self._wakeup = None
+            self.advance()
+
+    def start(self):
+        """Drive the wheel from a greenthread."""
+        import eventlet
+        if self._running:
+            return None
+        self._running = True
+        return eventlet.spawn(self._run)
+
+    def stop(self):
+        self._running = False
+        if self._wakeup is not None and not self._wakeup.ready():
+            self._wakeup.send()
+
+    def stats(self):
+        return {'timers_pending': self.count, 'timers_fired_total': self.fired_total}
@@ -0,0 +1,69 @@
+"""Simulate a peer dumping a full table while another peer sends a trickle of
+updates, and compare the wait of the trickle through one FIFO queue and
+through the per-peer fair queues.
+
+The handler is simulated: serving a line takes cost_us microseconds per KB of
+the line, the clock is virtual.
+
+Usage: python tests/benchmarks/bench_fair_queue.py [dump_lines] [cost_us]
+"""
+import sys
+import collections
+
+from fbgp.fair_queue import FairQueue
+
+DUMP_LINE = 4096 # bytes of an update of the dump
+TRICKLE_LINE = 300
+TRICKLE_INTERVAL = 0.01 # seconds between two updates of the trickle
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def run(fair, dump_lines, cost_us):
+    clock = Clock()
+    queue = FairQueue(clock=clock) if fair else collections.deque()
+    for i in range(dump_lines):
+        if fair:
+            queue.put('dump', ('dump', 0.0), DUMP_LINE)
+        else:
+            queue.append(('dump', 0.0, DUMP_LINE))
+    next_trickle = 0.0
+    waits = []
+    while len(queue):
+        while next_trickle <= clock.now:
+            if fair:
+                queue.put('trickle', ('trickle', next_trickle), TRICKLE_LINE)
+            else:
+                queue.append(('trickle', next_trickle, TRICKLE_LINE))
+            next_trickle += TRICKLE_INTERVAL
+        if fair:
+            peer, enqueued = queue.pop()
+            cost = DUMP_LINE if peer == 'dump' else TRICKLE_LINE
+        else:
+            peer, enqueued, cost = queue.popleft()
+        clock.now += cost / 1024 * cost_us / 1e6
+        if peer == 'trickle':
+            waits.append(clock.now - enqueued)
+    return clock.now, waits
+
+
+def main():
+    dump_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    cost_us = float(sys.argv[2]) if len(sys.argv) > 2 else 50
+    for fair in (False, True):
+        total, waits = run(fair, dump_lines, cost_us)
+        waits.sort()
+        print('%s: dump handled in %.2fs, trickle wait avg %.4fs p99 %.4fs max %.4fs' % (
+            'fair queues' if fair else 'single FIFO', total, sum(waits) / len(waits),
+            waits[int(len(waits) * 0.99)], waits[-1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Replay a full table through the FIB compression and report the number of
+dataplane entries and flow ops it saves.
+
+The synthetic table has num_prefixes IPv4 prefixes (mostly /24s, some /16-/23
+covering them) over num_nexthops nexthops, the prefixes of a /16 go to the
+same nexthop with probability locality, as a table learned from a few
+upstreams does.
+
+Usage: python tests/benchmarks/bench_fib.py [num_prefixes] [num_nexthops] [locality]
+"""
+import sys
+import time
+import random
+import ipaddress
+
+from fbgp.fib import FibCompressor
+
+
+def build_table(num_prefixes, num_nexthops, locality):
+    rand = random.Random(1)
+    nexthops = [ipaddress.ip_address('10.0.0.%d' % (i + 1)) for i in range(num_nexthops)]
+    table = {}
+    block = 0x01000000
+    while len(table) < num_prefixes:
+        preferred = rand.choice(nexthops)
+        for i in range(256):
+            if rand.random() < 0.7:
+                nexthop = preferred if rand.random() < locality else rand.choice(nexthops)
+                table[ipaddress.ip_network((block + (i << 8), 24))] = nexthop
+        if rand.random() < 0.2:
+            length = rand.randint(16, 23)
+            table[ipaddress.ip_network((block, length))] = preferred
+        block += 1 << 16
+    return list(table.items())[:num_prefixes]
+
+
+def main():
+    num_prefixes = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    num_nexthops = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    locality = float(sys.argv[3]) if len(sys.argv) > 3 else 0.9
+    table = build_table(num_prefixes, num_nexthops, locality)
+
+    fib = FibCompressor()
+    start = time.time()
+    for prefix, nexthop in table:
+        fib.set(prefix, nexthop)
+    adds, dels = fib.flush()
+    replay_time = time.time() - start
+    stats = fib.stats()
+
+    rand = random.Random(2)
+    changes = rand.sample(table, min(10000, len(table)))
+    start = time.time()
+    ops = 0
+    route_ops = fib.route_ops_total
+    for prefix, _ in changes:
+        fib.set(prefix, rand.choice(table)[1])
+        added, deleted = fib.flush()
+        ops += len(added) + len(deleted)
+    change_time = time.time() - start
+    route_ops = fib.route_ops_total - route_ops
+
+    print('full table replay: %d routes -> %d entries (ratio %.3f), %d flow ops instead of %d, %.3fs' % (
+        len(table), stats['fib_entries'], stats['fib_compression_ratio'],
+        len(adds) + len(dels), len(table), replay_time))
+    print('%d single route changes: %d flow ops instead of %d, %.1f us per change, %d entries after' % (
+        len(changes), ops, route_ops, change_time / len(changes) * 1e6, fib.stats()['fib_entries']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""Measure the cold start import time of a fbgp module with python -X importtime
+and show the slowest imports.
+
+Usage: python tests/benchmarks/bench_import.py [module] [top]
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'units'))
+
+from test_startup import import_times
+
+
+def main():
+    module = sys.argv[1] if len(sys.argv) > 1 else 'fbgp.fbgp'
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    times = import_times(module)
+    print('%s: %.1f ms cumulative, %s modules' % (module, times.get(module, 0) / 1000, len(times)))
+    # only top level packages, a package's cumulative time includes its submodules
+    packages = dict((name, cumulative) for name, cumulative in times.items() if '.' not in name)
+    for name, cumulative in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print('  %8.1f ms  %s' % (cumulative / 1000, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Compare the IPv4 and IPv6 update pipeline: parse ExaBGP updates, run them
+through a peer's import policy and the BGP selection, and export the best routes.
+
+Usage: python tests/benchmarks/bench_ipv6.py [num_prefixes]
+"""
+import sys
+import json
+import time
+import ipaddress
+
+from unittest.mock import Mock
+
+from fbgp import exabgp_parser
+from fbgp.bgp import BgpRouter, BgpPeer
+from fbgp.policy import Policy
+
+BATCH = 100 # prefixes per update message
+
+
+def updates(version, num_prefixes):
+    if version == 4:
+        peer, nexthop, family = '10.0.0.1', '10.0.0.1', 'ipv4 unicast'
+        # 16.0.0.0/4 holds 2^20 /24s
+        prefixes = [ipaddress.ip_network((0x10000000 + (i << 8), 24)) for i in range(num_prefixes)]
+    else:
+        peer, nexthop, family = '2001:db8::1', '2001:db8::1', 'ipv6 unicast'
+        prefixes = [ipaddress.ip_network(((0x2a00 << 112) + (i << 80), 48)) for i in range(num_prefixes)]
+    lines = []
+    for i in range(0, num_prefixes, BATCH):
+        lines.append(json.dumps({
+            'exabgp': '4.0.1', 'type': 'update',
+            'neighbor': {'address': {'local': peer, 'peer': peer}, 'direction': 'receive',
+                         'message': {'update': {
+                             'attribute': {'origin': 'igp', 'as-path': [1, 2]},
+                             'announce': {family: {nexthop: [
+                                 {'nlri': str(prefix)} for prefix in prefixes[i:i + BATCH]]}}}}}}))
+    return peer, lines
+
+
+def run(version, num_prefixes):
+    peer_ip, lines = updates(version, num_prefixes)
+    peer_ip = ipaddress.ip_address(peer_ip)
+    out_ip = ipaddress.ip_address('10.0.0.2' if version == 4 else '2001:db8::2')
+    gateway = ipaddress.ip_address('10.0.0.254' if version == 4 else '2001:db8::fe')
+    peer = BgpPeer(1, peer_ip, 65000)
+    peer.import_policy = Policy.parse('{16.0.0.0/4^+, 2a00::/16^+}')
+    out_peer = BgpPeer(2, out_ip, 65000)
+    peers = {peer_ip: peer, out_ip: out_peer}
+    for bgp_peer in peers.values():
+        bgp_peer.bgp_session_up()
+    bgp = BgpRouter({}, peers, Mock())
+
+    start = time.time()
+    msgs = [exabgp_parser.parse(line) for line in lines]
+    parse_time = time.time() - start
+
+    start = time.time()
+    changes = []
+    for _, _, (origin, as_path, med, local_pref, community), announce, _ in msgs:
+        for nexthop, prefixes in announce:
+            nexthop = exabgp_parser.to_address(nexthop)
+            for prefix in prefixes:
+                route = peer.rcv_announce(
+                    exabgp_parser.to_network(prefix), nexthop, list(as_path), origin,
+                    med=med, local_pref=local_pref, community=community)
+                if route:
+                    changes.append((route, False))
+    results = bgp.apply_changes(changes)
+    rib_time = time.time() - start
+
+    start = time.time()
+    exported = 0
+    for new_best, _ in results:
+        exported += len(bgp.announce(out_peer, new_best, gateway))
+    export_time = time.time() - start
+    assert exported == num_prefixes
+    return parse_time, rib_time, export_time
+
+
+def main():
+    num_prefixes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for version in (4, 6):
+        parse_time, rib_time, export_time = run(version, num_prefixes)
+        total = parse_time + rib_time + export_time
+        print('IPv%d: %d prefixes, parse %.3fs, import+select %.3fs, export %.3fs, '
+              '%.0f prefixes/s' % (version, num_prefixes, parse_time, rib_time,
+                                   export_time, num_prefixes / total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Render the ExaBGP announces of a table dump to a number of peers, with the
+attributes rendered once per attribute set, and with them rendered for every
+line as they were before.
+
+The table has num_prefixes IPv4 prefixes sharing num_prefixes / 10 attribute
+sets, the peers are eBGP peers of different ASes.
+
+Usage: python tests/benchmarks/bench_render.py [num_prefixes] [num_peers]
+"""
+import sys
+import time
+import random
+import ipaddress
+
+from fbgp import bgp
+from fbgp.bgp import BgpPeer
+
+
+def render_uncached(route, peer, gateway):
+    """Route.to_exabgp before the attribute fragments were cached."""
+    line = peer.neighbor
+    line += ' announce route %s next-hop %s' % (route.prefix, gateway)
+    line += ' as-path %s' % route.as_path
+    for name, attr in [
+            ('origin', 'origin'), ('med', 'med'), ('local_pref', 'local-preference'),
+            ('community', 'community')]:
+        value = getattr(route, name)
+        if value is not None:
+            if name == 'community':
+                value = '[%s]' % ' '.join('%s:%s' % tuple(community) for community in value)
+            line += ' %s %s' % (attr, value)
+    return line
+
+
+def build(num_prefixes, num_peers):
+    rand = random.Random(1)
+    source = BgpPeer(1, ipaddress.ip_address('10.0.0.1'), 65000)
+    source.bgp_session_up()
+    attribute_sets = [([1] + [rand.randrange(2, 65000) for _ in range(rand.randint(1, 5))],
+                       rand.choice(['igp', 'incomplete']), rand.choice([0, 10]),
+                       [(1, rand.randrange(100))] if rand.random() < 0.3 else None)
+                      for _ in range(max(1, num_prefixes // 10))]
+    routes = []
+    for i in range(num_prefixes):
+        as_path, origin, med, community = rand.choice(attribute_sets)
+        routes.append(source.rcv_announce(
+            ipaddress.ip_network((0x01000000 + (i << 8), 24)), source.peer_ip,
+            list(as_path), origin, med=med, community=community))
+    peers = []
+    for i in range(num_peers):
+        peer = BgpPeer(100 + i, ipaddress.ip_address('10.0.1.%d' % (i + 1)), 65000)
+        peer.bgp_session_up()
+        peers.append(peer)
+    return routes, peers
+
+
+def main():
+    num_prefixes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    num_peers = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    routes, peers = build(num_prefixes, num_peers)
+    gateway = ipaddress.ip_address('10.0.0.254')
+    outs = [[peer.export_route(route) for route in routes] for peer in peers]
+    lines = num_prefixes * num_peers
+
+    start = time.time()
+    buffers = ['\n'.join(render_uncached(out, peer, gateway) for out in peer_outs)
+               for peer, peer_outs in zip(peers, outs)]
+    uncached_time = time.time() - start
+
+    bgp._fragments.clear()
+    start = time.time()
+    cached = ['\n'.join(out.to_exabgp(peer, gw=gateway) for out in peer_outs)
+              for peer, peer_outs in zip(peers, outs)]
+    cached_time = time.time() - start
+    assert cached == buffers
+
+    print('%d lines (%d prefixes x %d peers), %d attribute sets cached' % (
+        lines, num_prefixes, num_peers, len(bgp._fragments)))
+    print('rendered for every line: %.3fs, %.0f lines/s' % (uncached_time, lines / uncached_time))
+    print('cached fragments:        %.3fs, %.0f lines/s' % (cached_time, lines / cached_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Measure the memory of the Adj-RIBs-Out of a number of peers announced a table,
+holding the interned attributes sent to each peer, against holding a copy of the
+route per peer as they did before.
+
+The table has num_prefixes IPv4 prefixes sharing num_prefixes / 10 attribute
+sets, the peers are eBGP peers of different ASes.
+
+Usage: python tests/benchmarks/bench_rib_out.py [num_prefixes] [num_peers]
+"""
+import sys
+import time
+import random
+import tracemalloc
+import ipaddress
+
+from fbgp.bgp import BgpPeer
+
+
+def build(num_prefixes, num_peers):
+    rand = random.Random(1)
+    source = BgpPeer(1, ipaddress.ip_address('10.0.0.1'), 65000)
+    source.bgp_session_up()
+    attribute_sets = [([1] + [rand.randrange(2, 65000) for _ in range(rand.randint(1, 5))],
+                       rand.choice(['igp', 'incomplete']), rand.choice([0, 10]))
+                      for _ in range(max(1, num_prefixes // 10))]
+    routes = []
+    for i in range(num_prefixes):
+        as_path, origin, med = rand.choice(attribute_sets)
+        routes.append(source.rcv_announce(
+            ipaddress.ip_network((0x01000000 + (i << 8), 24)), source.peer_ip,
+            list(as_path), origin, med=med))
+    peers = []
+    for i in range(num_peers):
+        peer = BgpPeer(100 + i, ipaddress.ip_address('10.0.1.%d' % (i + 1)), 65000)
+        peer.bgp_session_up()
+        peers.append(peer)
+    return routes, peers
+
+
+def copy_per_peer(peer, route):
+    """The route stored in the Adj-RIB-Out before: a modified copy per peer."""
+    out = route.copy()
+    out.as_path = [peer.local_as] + out.as_path
+    out.local_pref = None
+    return out
+
+
+def measure(func):
+    tracemalloc.start()
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def main():
+    num_prefixes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    num_peers = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    routes, peers = build(num_prefixes, num_peers)
+
+    copies, copies_size, copies_time = measure(lambda: [
+        dict((route.prefix, copy_per_peer(peer, route)) for route in routes) for peer in peers])
+    del copies
+
+    def announce():
+        for peer in peers:
+            for route in routes:
+                peer.announce(route)
+    _, views_size, views_time = measure(announce)
+
+    print('%d prefixes x %d peers' % (num_prefixes, num_peers))
+    print('route copy per peer:  %.1f MB, %.0f bytes per entry, %.2fs' % (
+        copies_size / 1e6, copies_size / (num_prefixes * num_peers), copies_time))
+    print('interned attributes:  %.1f MB, %.0f bytes per entry, %.2fs' % (
+        views_size / 1e6, views_size / (num_prefixes * num_peers), views_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Scaling of the best path selection with the number of shard workers.
+
+Replays a table announced by several peers, then withdrawn by all but one,
+through BgpRouter (single process) and ShardedBgpRouter with 1, 2, 4 and 8
+workers, checking that every mode ends with the same best routes.
+
+Usage: python tests/benchmarks/bench_shard.py [num_prefixes] [num_peers] [batch_size]
+"""
+import sys
+import time
+import ipaddress
+
+from unittest.mock import Mock
+
+from fbgp.bgp import BgpRouter, BgpPeer
+from fbgp.shard import ShardedBgpRouter
+
+
+def build_changes(num_prefixes, num_peers):
+    peers = {}
+    for i in range(num_peers):
+        peer_ip = ipaddress.ip_address('10.0.0.%d' % (i + 1))
+        peers[peer_ip] = BgpPeer(i + 1, peer_ip, 65000)
+        peers[peer_ip].bgp_session_up()
+    changes = []
+    for i in range(num_prefixes):
+        prefix = ipaddress.ip_network((0x01000000 + (i << 8), 24))
+        for n, peer in enumerate(peers.values()):
+            as_path = [peer.peer_as] * (1 + (i + n) % num_peers)
+            changes.append((peer.rcv_announce(prefix, peer.peer_ip, as_path, 'igp'), False))
+    for peer in list(peers.values())[1:]:
+        for prefix in list(peer._rib_in):
+            changes.append((peer.rcv_withdraw(prefix), True))
+    return peers, changes
+
+
+def run(bgp, changes, batch_size):
+    start = time.time()
+    for i in range(0, len(changes), batch_size):
+        bgp.apply_changes(changes[i:i + batch_size])
+    return time.time() - start
+
+
+def main():
+    num_prefixes = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    num_peers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    peers, changes = build_changes(num_prefixes, num_peers)
+    print('%d changes (%d prefixes x %d peers), batches of %d' % (
+        len(changes), num_prefixes, num_peers, batch_size))
+
+    bgp = BgpRouter({}, peers, Mock())
+    elapsed = run(bgp, changes, batch_size)
+    expected = bgp.best_routes
+    print('single process: %.3fs (%.0f changes/s)' % (elapsed, len(changes) / elapsed))
+    for num_workers in [1, 2, 4, 8]:
+        bgp = ShardedBgpRouter({}, peers, Mock(), num_workers)
+        try:
+            elapsed = run(bgp, changes, batch_size)
+            same = (set(bgp.best_routes) == set(expected) and
+                    all(bgp.best_routes[prefix] is route for prefix, route in expected.items()))
+        finally:
+            bgp.stop()
+        print('%d workers: %.3fs (%.0f changes/s), same results: %s' % (
+            num_workers, elapsed, len(changes) / elapsed, same))
+
+
+if __name__ == '__main__':
+    main()
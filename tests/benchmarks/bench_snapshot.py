@@ -0,0 +1,66 @@
+"""Measure warm restart from a RIB snapshot: the time to reload a full table and
+get it back into loc_rib/best_routes, i.e. the time before FIB programming can start.
+
+Usage: python tests/benchmarks/bench_snapshot.py [num_prefixes] [num_peers]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import ipaddress
+
+from unittest.mock import Mock
+
+from fbgp.bgp import BgpRouter, BgpPeer
+from fbgp.snapshot import RibSnapshot, ROUTE_ACCEPTED, ROUTE_BEST
+
+
+def build_rib(num_prefixes, num_peers):
+    peers = {}
+    for i in range(num_peers):
+        peer_ip = ipaddress.ip_address('10.0.0.%d' % (i + 1))
+        peers[peer_ip] = BgpPeer(i + 1, peer_ip, 65000)
+        peers[peer_ip].bgp_session_up()
+    bgp = BgpRouter({}, peers, Mock())
+    for i in range(num_prefixes):
+        prefix = ipaddress.ip_network((0x01000000 + (i << 8), 24))
+        for n, peer in enumerate(peers.values()):
+            route = peer.rcv_announce(prefix, peer.peer_ip, [peer.peer_as] * (n + 1), 'igp')
+            bgp.add_route(route)
+    return peers, bgp
+
+
+def main():
+    num_prefixes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    num_peers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    peers, bgp = build_rib(num_prefixes, num_peers)
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'rib.snap')
+    try:
+        start = time.time()
+        snapshot = RibSnapshot()
+        for peer in peers.values():
+            snapshot.add_peer(peer, bgp.best_routes, bgp.loc_rib)
+        snapshot.save(path)
+        save_time = time.time() - start
+        size = os.path.getsize(path)
+
+        start = time.time()
+        loaded = RibSnapshot.load(path, peers)
+        best_routes = {}
+        for routes in loaded.routes.values():
+            for route, flags in routes:
+                if flags & ROUTE_ACCEPTED and flags & ROUTE_BEST:
+                    best_routes[route.prefix] = route
+        restore_time = time.time() - start
+    finally:
+        shutil.rmtree(tempdir)
+    print('%d routes (%d prefixes x %d peers), snapshot size %.1f MB' % (
+        loaded.num_routes(), num_prefixes, num_peers, size / 1e6))
+    print('save: %.3fs, restore to forwarding state: %.3fs (%d best routes)' % (
+        save_time, restore_time, len(best_routes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Time the import of fbgp modules, each run in a fresh interpreter so that
+nothing is already loaded. The time is measured around the import statement
+only, the interpreter start is left out.
+
+A module argument can list several modules separated by commas, they are
+imported by one statement, e.g. to time the modules fbgp.fbgp loads lazily.
+
+Usage: python tests/benchmarks/bench_startup.py [runs] [module ...]
+"""
+import os
+import sys
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+CODE = 'import time; start = time.perf_counter(); import %s; print(time.perf_counter() - start)'
+
+
+def time_import(modules, runs):
+    """Return the sorted import times (s) of modules, or the error if they do not import."""
+    path = [ROOT] + ([os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else [])
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path))
+    times = []
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, '-c', CODE % ', '.join(modules.split(','))],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        if proc.returncode:
+            return None, proc.stderr.decode('utf-8').strip().splitlines()[-1]
+        times.append(float(proc.stdout))
+    return sorted(times), None
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    modules = sys.argv[2:] or ['fbgp.fbgp']
+    for module in modules:
+        times, error = time_import(module, runs)
+        if error:
+            print('%s: not importable: %s' % (module, error))
+            continue
+        print('%s: median %.1f ms, min %.1f ms over %d runs' % (
+            module, times[len(times) // 2] * 1000, times[0] * 1000, runs))
+
+
+if __name__ == '__main__':
+    main()
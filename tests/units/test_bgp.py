@@ -7,7 +7,8 @@ import logging
 from unittest.mock import Mock
 
 from fbgp.bgp import BgpRouter, BgpPeer
-from fbgp.bgp import Route
+from fbgp.bgp import Route, RibBudget, prefix_key
+from fbgp.policy import Policy
 
 
 
@@ -90,6 +91,60 @@ class TestBGP(unittest.TestCase):
         route = peer.rcv_announce(self.prefix, peer.peer_ip, [1], origin=2)
         self.assertTrue(route is None)
 
+    def test_duplicate_received(self):
+        peer = self.external_peers[0]
+        key = prefix_key(self.prefix)
+        nexthop = (4, int(peer.peer_ip))
+        attributes = (2, (1,), None, None, None)
+        self.assertFalse(peer.has_prefix(key))
+        peer.rcv_announce(self.prefix, peer.peer_ip, [1], 2, (nexthop, attributes))
+        self.assertTrue(peer.has_prefix(key))
+        self.assertTrue(peer.is_duplicate(key, nexthop, attributes))
+        # attributes are compared by identity, they are interned by the parser
+        self.assertFalse(peer.is_duplicate(key, nexthop, (2, (1,), 0, None, None)))
+        self.assertFalse(peer.is_duplicate(key, (4, 1), attributes))
+        peer.rcv_withdraw(self.prefix)
+        self.assertFalse(peer.has_prefix(key))
+        # routes kept over a session reset are known but never duplicates
+        peer.rcv_announce(self.prefix, peer.peer_ip, [1], 2, (nexthop, attributes))
+        peer.mark_stale()
+        peer.bgp_session_up()
+        self.assertTrue(peer.has_prefix(key))
+        self.assertFalse(peer.is_duplicate(key, nexthop, attributes))
+
+    def test_max_prefix_and_budget(self):
+        budget = RibBudget(3)
+        peer = BgpPeer(1, ipaddress.ip_address('10.0.0.1'), 65000, max_prefix=2, budget=budget)
+        other = BgpPeer(2, ipaddress.ip_address('10.0.0.2'), 65000, budget=budget)
+        peer.bgp_session_up()
+        other.bgp_session_up()
+        prefixes = [ipaddress.ip_network('1.0.%d.0/24' % i) for i in range(3)]
+        for prefix in prefixes[:2]:
+            self.assertIsNone(peer.limit_action())
+            peer.rcv_announce(prefix, peer.peer_ip, [1], 1)
+        # replacing a route does not count twice
+        peer.rcv_announce(prefixes[0], peer.peer_ip, [1, 2], 1)
+        self.assertEqual(budget.used, 2)
+        self.assertEqual(peer.limit_action(), 'teardown')
+        other.rcv_announce(prefixes[0], other.peer_ip, [2], 1)
+        self.assertEqual(other.limit_action(), 'drop')
+        peer.rcv_withdraw(prefixes[0])
+        self.assertIsNone(peer.limit_action())
+        self.assertIsNone(other.limit_action())
+        peer.bgp_session_down()
+        self.assertEqual(budget.used, 1)
+
+    def test_budget_before_warn(self):
+        budget = RibBudget(2)
+        peer = BgpPeer(1, ipaddress.ip_address('10.0.0.1'), 65000, max_prefix=1,
+                       max_prefix_action='warn', budget=budget)
+        peer.bgp_session_up()
+        peer.rcv_announce(ipaddress.ip_network('1.0.0.0/24'), peer.peer_ip, [1], 1)
+        self.assertEqual(peer.limit_action(), 'warn')
+        peer.rcv_announce(ipaddress.ip_network('1.0.1.0/24'), peer.peer_ip, [1], 1)
+        # over its max-prefix, the peer is still held to the global budget
+        self.assertEqual(peer.limit_action(), 'drop')
+
     def test_bgp_best_path_no_change(self):
         peer = self.external_peers[0]
         route = peer.rcv_announce(self.prefix, peer.peer_ip, [1], 1)
@@ -111,3 +166,167 @@ class TestBGP(unittest.TestCase):
             self.assertTrue(new_best)
             self.assertTrue(new_best.local_pref == pref)
             pref += 1
+
+    def test_stale_routes(self):
+        peer = self.external_peers[0]
+        other_prefix = ipaddress.ip_network('2.0.0.0/24')
+        for prefix in [self.prefix, other_prefix]:
+            peer.rcv_announce(prefix, peer.peer_ip, [1], origin=2)
+        peer.mark_stale()
+        peer.bgp_session_up()
+        self.assertEqual(len(peer._rib_in), 2)
+        # refresh one of the stale routes
+        peer.rcv_announce(self.prefix, peer.peer_ip, [1], origin=2)
+        routes = peer.sweep_stale()
+        self.assertEqual([route.prefix for route in routes], [other_prefix])
+        self.assertEqual(list(peer._rib_in), [self.prefix])
+
+    def test_implicit_withdraw(self):
+        peer1, peer2 = self.external_peers[:2]
+        route = peer1.rcv_announce(self.prefix, peer1.peer_ip, [1], 1)
+        self.bgp.add_route(route)
+        route = peer2.rcv_announce(self.prefix, peer2.peer_ip, [2, 2], 1)
+        self.bgp.add_route(route)
+        # peer1 replaces its best route with a worse one
+        route = peer1.rcv_announce(self.prefix, peer1.peer_ip, [1, 1, 1], 1)
+        new_best, cur_best = self.bgp.add_route(route)
+        self.assertEqual(len(self.bgp.loc_rib[self.prefix]), 2)
+        self.assertEqual(new_best.from_peer, peer2.peer_ip)
+        self.assertEqual(cur_best.as_path, [1])
+
+    def test_mrai(self):
+        peer1, peer2 = self.external_peers[:2]
+        peer2.mrai = 5
+        peer2.pending_handler = Mock()
+        gateway = ipaddress.ip_address('10.0.0.254')
+        for as_path in [[1], [1, 1]]:
+            route = peer1.rcv_announce(self.prefix, peer1.peer_ip, as_path, 1)
+            self.assertEqual(self.bgp.announce(peer2, route, gateway), [])
+        peer2.pending_handler.assert_called_once_with(peer2)
+        msgs = self.bgp.flush_updates(peer2)
+        self.assertEqual(len(msgs), 1)
+        self.assertIn('as-path [65000, 1, 1]', msgs[0])
+        # an announce withdrawn before the MRAI expires is not sent at all
+        other_prefix = ipaddress.ip_network('2.0.0.0/24')
+        route = peer1.rcv_announce(other_prefix, peer1.peer_ip, [1], 1)
+        self.bgp.announce(peer2, route, gateway)
+        self.bgp.withdraw(peer2, route)
+        self.assertEqual(self.bgp.flush_updates(peer2), [])
+        self.assertEqual(list(peer2._rib_out), [self.prefix])
+
+    def test_reevaluate_import(self):
+        peer = self.external_peers[0]
+        route = peer.rcv_announce(self.prefix, peer.peer_ip, [1], 1)
+        self.assertIs(peer.accepted(self.prefix), route)
+        peer.import_policy = Policy.parse('{2.0.0.0/8^+}')
+        self.assertEqual(peer.reevaluate_import(self.prefix), (route, None))
+        self.assertIsNone(peer.accepted(self.prefix))
+        self.assertIn(self.prefix, peer._rib_in)
+        peer.import_policy = Policy.parse('{1.0.0.0/8^+}')
+        self.assertEqual(peer.reevaluate_import(self.prefix), (None, route))
+        # unchanged result
+        old, new = peer.reevaluate_import(self.prefix)
+        self.assertIs(old, new)
+
+    def test_export_ipv6(self):
+        peer1, peer2 = self.external_peers[:2]
+        peer6 = BgpPeer(6, ipaddress.ip_address('2001:db8::6'), 65000)
+        peer6.bgp_session_up()
+        gateway = ipaddress.ip_address('2001:db8::fe')
+        prefix6 = ipaddress.ip_network('2001:db8:1::/48')
+        route = peer1.rcv_announce(prefix6, ipaddress.ip_address('2001:db8::1'), [1], 'igp')
+        self.assertIsNone(peer2.export_route(route))
+        msgs = self.bgp.announce(peer6, route, gateway)
+        self.assertEqual(msgs, ['neighbor 2001:db8::6 announce route 2001:db8:1::/48 '
+                                'next-hop 2001:db8::fe as-path [65000, 1] origin igp med 0'])
+        route = peer1.rcv_announce(self.prefix, peer1.peer_ip, [1], 'igp')
+        self.assertEqual(self.bgp.announce(peer6, route, gateway), [])
+
+    def test_select_paths(self):
+        for peer, as_path in zip(self.external_peers, [[1, 2], [2], [3, 4, 5]]):
+            self.bgp.add_route(peer.rcv_announce(self.prefix, peer.peer_ip, as_path, 'igp'))
+        paths = self.bgp.select_paths(self.prefix, 2)
+        self.assertEqual([route.from_peer for route in paths],
+                         [self.external_peers[1].peer_ip, self.external_peers[0].peer_ip])
+        paths = self.bgp.select_paths(self.prefix, 3, self.external_peers[1].peer_ip)
+        self.assertEqual([route.from_peer for route in paths],
+                         [self.external_peers[0].peer_ip, self.external_peers[2].peer_ip])
+
+    def test_export_context(self):
+        peer = self.external_peers[1]
+        self.assertEqual((peer.neighbor, peer.as_prepend, peer.gateway), ('neighbor 10.0.0.2', (65000,), None))
+        internal = self.internal_peers[0]
+        routerid = ipaddress.ip_address('10.0.0.254')
+        internal.set_export_context(routerid)
+        self.assertEqual((internal.as_prepend, internal.gateway), ((), routerid))
+        route = self.external_peers[0].rcv_announce(self.prefix, self.external_peers[0].peer_ip, [1], 'igp')
+        self.assertEqual(peer.export_route(route).as_path, [65000, 1])
+        self.assertIsNone(self.external_peers[0].export_route(route))
+        self.assertIn('next-hop 10.0.0.254 as-path [1]', internal.export_route(route).to_exabgp(internal))
+
+    def test_fragments(self):
+        peer = self.external_peers[0]
+        route1 = peer.rcv_announce(self.prefix, peer.peer_ip, [1, 2], 'igp', community=[[1, 2]])
+        route2 = peer.rcv_announce(ipaddress.ip_network('2.0.0.0/24'), peer.peer_ip, [1, 2], 'igp',
+                                   community=((1, 2),))
+        # rendered once for the attribute set
+        self.assertIs(route1.fragments(), route2.fragments())
+        self.assertEqual(route1.fragments(), (' as-path [1, 2] origin igp med 0 local-preference 100 '
+                                              'community [1:2]',
+                                              ' origin igp med 0 local-preference 100 community [1:2]'))
+        self.assertEqual(route1.copy().to_exabgp(peer, gw=ipaddress.ip_address('10.0.0.254')),
+                         'neighbor 10.0.0.1 announce route 1.0.0.0/24 next-hop 10.0.0.254 as-path [1, 2] '
+                         'origin igp med 0 local-preference 100 community [1:2]')
+
+    def test_rib_out_shares_attributes(self):
+        peer1, peer2, peer3 = self.external_peers
+        route = peer1.rcv_announce(self.prefix, peer1.peer_ip, [1], 'igp', local_pref=200)
+        out = peer2.announce(route)
+        peer3.announce(route)
+        self.assertIs(out.route, route)
+        self.assertEqual((out.as_path, out.local_pref, out.nexthop), ([65000, 1], None, peer1.peer_ip))
+        self.assertIs(peer2._rib_out[self.prefix], peer3._rib_out[self.prefix])
+        self.assertEqual(route.as_path, [1])
+        withdrawn = peer2.withdraw(route)
+        self.assertEqual(withdrawn.to_exabgp(peer2, is_withdraw=True),
+                         'neighbor 10.0.0.2 withdraw route 1.0.0.0/24 origin igp med 0')
+        self.assertNotIn(self.prefix, peer2._rib_out)
+
+    def test_announce_group(self):
+        peer1 = self.external_peers[0]
+        group = self.internal_peers
+        gateway = ipaddress.ip_address('10.0.0.254')
+        route = peer1.rcv_announce(self.prefix, peer1.peer_ip, [1], 'igp')
+        msgs = self.bgp.announce_group(group, route, gateway)
+        self.assertEqual(msgs, ['neighbor 10.0.10.1, neighbor 10.0.10.2 announce route 1.0.0.0/24 '
+                                'next-hop 10.0.0.254 as-path [1] origin igp med 0 local-preference 100'])
+        for peer in group:
+            self.assertEqual(peer._rib_out[self.prefix].as_path, (1,))
+        # a route not exported to the group withdraws the prefix
+        route = group[0].rcv_announce(self.prefix, group[0].peer_ip, [2], 'igp')
+        msgs = self.bgp.announce_group(group[1:], route, gateway)
+        self.assertEqual(msgs, ['neighbor 10.0.10.2 withdraw route 1.0.0.0/24 origin igp med 0 '
+                                'local-preference 100'])
+        self.assertEqual(self.bgp.withdraw_group(group, route),
+                         ['neighbor 10.0.10.1 withdraw route 1.0.0.0/24 origin igp med 0 '
+                          'local-preference 100'])
+        self.assertEqual(self.bgp.withdraw_group(group, route), [])
+
+    def test_announce_paths(self):
+        peer1, peer2, peer3 = self.external_peers
+        peer3.add_path = 2
+        gateway = ipaddress.ip_address('10.0.0.254')
+        route1 = peer1.rcv_announce(self.prefix, peer1.peer_ip, [1], 'igp')
+        route2 = peer2.rcv_announce(self.prefix, peer2.peer_ip, [2, 2], 'igp')
+        msgs = self.bgp.announce_paths(peer3, self.prefix, [(1, route1, gateway), (2, route2, gateway)])
+        self.assertEqual(len(msgs), 2)
+        self.assertIn('next-hop 10.0.0.254 path-information 2 as-path [65000, 2, 2]', msgs[1])
+        self.assertEqual(peer3._rib_out[self.prefix].as_path, (65000, 1))
+        # only the paths that changed are sent
+        msgs = self.bgp.announce_paths(peer3, self.prefix, [(2, route2, gateway)])
+        self.assertEqual(msgs, ['neighbor 10.0.0.3 withdraw route 1.0.0.0/24 path-information 1 '
+                                'origin igp med 0'])
+        self.assertEqual(peer3._rib_out[self.prefix].as_path, (65000, 2, 2))
+        self.assertEqual(self.bgp.announce_paths(peer3, self.prefix, []),
+                         [msgs[0].replace('information 1', 'information 2')])
+        self.assertNotIn(self.prefix, peer3._rib_out)
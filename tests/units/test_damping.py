@@ -0,0 +1,91 @@
+import unittest
+import ipaddress
+
+from fbgp.damping import Damping
+from fbgp.timer import TimerWheel
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestDamping(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.reused = []
+        self.timers = TimerWheel(tick=1, clock=self.clock)
+        self.damping = Damping(lambda *key: self.reused.append(key), self.timers,
+                               half_life=60, reuse=750, suppress=2000, max_suppress_time=300)
+        self.peer_ip = ipaddress.ip_address('10.0.0.1')
+        self.prefix = ipaddress.ip_network('1.0.0.0/24')
+
+    def flap(self):
+        self.damping.withdraw(self.peer_ip, self.prefix)
+        return self.damping.announce(self.peer_ip, self.prefix)
+
+    def test_suppress_and_reuse(self):
+        self.assertTrue(self.flap())
+        self.assertTrue(self.flap())
+        self.assertFalse(self.flap())
+        self.assertTrue(self.damping.is_suppressed(self.peer_ip, self.prefix))
+        self.assertEqual(self.damping.stats()['damping_suppressed'], 1)
+        # 3000 decays under 750 after two half-lives
+        self.clock.now = 100
+        self.timers.advance()
+        self.assertEqual(self.reused, [])
+        self.clock.now = 125
+        self.timers.advance()
+        self.assertEqual(self.reused, [(self.peer_ip, self.prefix)])
+        self.assertFalse(self.damping.is_suppressed(self.peer_ip, self.prefix))
+        self.assertEqual(self.damping.stats()['damping_reused_total'], 1)
+
+    def test_penalty_decays(self):
+        self.flap()
+        self.clock.now = 60
+        self.flap()
+        self.clock.now = 120
+        # 1000 / 4 + 1000 / 2 + 1000 stays under the suppress limit
+        self.assertTrue(self.flap())
+
+    def test_attribute_change(self):
+        for _ in range(4):
+            self.assertTrue(self.damping.announce(self.peer_ip, self.prefix, changed=True))
+        self.assertFalse(self.damping.announce(self.peer_ip, self.prefix, changed=True))
+
+    def test_max_suppress_time(self):
+        for _ in range(50):
+            self.flap()
+        self.clock.now = 305
+        self.timers.advance()
+        self.assertEqual(self.reused, [(self.peer_ip, self.prefix)])
+
+    def test_peer_down(self):
+        for _ in range(3):
+            self.flap()
+        self.assertEqual(self.timers.stats()['timers_pending'], 2) # gc and reuse
+        self.damping.peer_down(self.peer_ip)
+        self.assertFalse(self.damping.is_suppressed(self.peer_ip, self.prefix))
+        self.assertEqual(self.damping.stats()['damping_suppressed'], 0)
+        self.assertEqual(self.timers.stats()['timers_pending'], 1)
+
+    def test_stop(self):
+        for _ in range(3):
+            self.flap()
+        self.damping.stop()
+        self.assertEqual(self.timers.stats()['timers_pending'], 0)
+        self.assertEqual(self.damping.suppressed_routes(), [(self.peer_ip, self.prefix)])
+        self.clock.now = 400
+        self.timers.advance()
+        self.assertEqual(self.reused, [])
+
+    def test_forget_decayed_entries(self):
+        self.flap()
+        self.clock.now = 200
+        self.timers.advance()
+        self.assertEqual(self.damping.stats()['damping_entries'], 0)
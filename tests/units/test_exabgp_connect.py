@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+import importlib.util
+
+from unittest.mock import Mock
+from unittest.mock import patch
+
+
+@unittest.skipIf(importlib.util.find_spec('eventlet') is None, 'eventlet not installed')
+class TestExaBgpStart(unittest.TestCase):
+    """Start ExaBGP with the subprocess, the listener and the hook stubbed."""
+
+    def setUp(self):
+        from fbgp.exabgp_connect import ExaBgpConnect
+        self.tempdir = tempfile.mkdtemp()
+        env = {'FBGP_EXABGP_CONFIG': os.path.join(self.tempdir, 'exabgp.conf'),
+               'FBGP_EXABGP_SOCK': os.path.join(self.tempdir, 'exabgp_hook.sock'),
+               'FBGP_EXABGP_HOOK_LOG': os.path.join(self.tempdir, 'exabgp_hook.log')}
+        self.exabgp = Mock()
+        self.exabgp.poll.return_value = 1
+        self.connect = ExaBgpConnect(Mock(), {}, '10.1.1.1')
+        self.connect.START_TIMEOUT = 0.1
+        self.popen = Mock(return_value=self.exabgp)
+        self.which = Mock(return_value='/usr/local/bin/fbgp_exabgp_hook')
+        self.patches = [
+            patch.dict(os.environ, env),
+            patch('fbgp.exabgp_connect.subprocess.Popen', self.popen),
+            patch('fbgp.exabgp_connect.shutil.which', self.which),
+            patch.object(self.connect, '_run', lambda: self.connect.listening.send()),
+            patch.object(self.connect, '_process_msg', Mock()),
+            patch.object(self.connect, '_send', Mock()),
+            patch.object(self.connect, '_wait_exabgp', Mock())]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+        shutil.rmtree(self.tempdir)
+
+    def test_ready(self):
+        self.popen.side_effect = lambda *args, **kwargs: (
+            self.connect.started.send(True), self.exabgp)[1]
+        self.assertIs(self.connect.start(), self.exabgp)
+        self.assertEqual([phase for phase, _ in self.connect.startup_phases],
+                         ['listener', 'config', 'spawn'])
+        with open(os.environ['FBGP_EXABGP_CONFIG']) as f:
+            self.assertIn('/usr/local/bin/fbgp_exabgp_hook', f.read())
+
+    def test_hook_missing(self):
+        self.which.return_value = None
+        self.assertIsNone(self.connect.start())
+        self.popen.assert_not_called()
+
+    def test_listener_timeout(self):
+        with patch.object(self.connect, '_run', Mock()):
+            self.assertIsNone(self.connect.start())
+        self.which.assert_not_called()
+        self.popen.assert_not_called()
+
+    def test_start_timeout(self):
+        # ExaBGP runs but its api process never connects
+        self.assertIsNone(self.connect.start())
+        self.popen.assert_called_once()
+
+    def test_exited(self):
+        self.popen.side_effect = lambda *args, **kwargs: (
+            self.connect.started.send(False), self.exabgp)[1]
+        self.assertIsNone(self.connect.start())
@@ -0,0 +1,74 @@
+import unittest
+import ipaddress
+
+from fbgp import exabgp_parser
+from fbgp.exabgp_parser import ParserPool, MSG_UPDATE, MSG_STATE, MSG_EOR, MSG_ERROR
+
+
+class TestExaBgpParser(unittest.TestCase):
+
+    UPDATE = """{ "exabgp": "4.0.1", "time": 1, "type": "update",
+        "neighbor": { "address": { "local": "10.0.0.253", "peer": "%s" },
+            "asn": { "local": 65000, "peer": 1 }, "direction": "receive",
+            "message": { "update": {
+                "attribute": { "origin": "igp", "as-path": [1, 2], "med": 10 },
+                "announce": { "ipv4 unicast": { "%s": [ { "nlri": "1.0.0.0/24" }, { "nlri": "2.0.0.0/16" } ] } },
+                "withdraw": { "ipv4 unicast": [ { "nlri": "3.0.0.0/8" } ] } } } } }"""
+
+    STATE = """{ "exabgp": "4.0.1", "time": 1, "type": "state",
+        "neighbor": { "address": { "local": "10.0.0.253", "peer": "10.0.0.1" },
+            "asn": { "local": 65000, "peer": 1 }, "state": "%s" } }"""
+
+    EOR = """{ "exabgp": "4.0.1", "time": 1, "type": "update",
+        "neighbor": { "address": { "local": "10.0.0.253", "peer": "10.0.0.1" },
+            "asn": { "local": 65000, "peer": 1 }, "direction": "receive",
+            "message": { "eor": { "afi": "ipv4", "safi": "unicast" } } } }"""
+
+    def test_parse_update(self):
+        msg = exabgp_parser.parse(self.UPDATE % ('10.0.0.1', '10.0.0.1'))
+        msg_type, peer, attributes, announce, withdraw = msg
+        self.assertEqual(msg_type, MSG_UPDATE)
+        self.assertEqual(exabgp_parser.to_address(peer), ipaddress.ip_address('10.0.0.1'))
+        self.assertEqual(attributes, ('igp', (1, 2), 10, None, None))
+        nexthop, prefixes = announce[0]
+        self.assertEqual(exabgp_parser.to_address(nexthop), ipaddress.ip_address('10.0.0.1'))
+        self.assertEqual([exabgp_parser.to_network(prefix) for prefix in prefixes],
+                         [ipaddress.ip_network('1.0.0.0/24'), ipaddress.ip_network('2.0.0.0/16')])
+        self.assertEqual([exabgp_parser.to_network(prefix) for prefix in withdraw],
+                         [ipaddress.ip_network('3.0.0.0/8')])
+        # the same attributes are shared between messages
+        other = exabgp_parser.parse(self.UPDATE % ('10.0.0.2', '10.0.0.2'))
+        self.assertTrue(other[2] is attributes)
+
+    def test_parse_update_ipv6(self):
+        line = (self.UPDATE % ('2001:db8::1', '2001:db8::1')).replace('ipv4 unicast', 'ipv6 unicast')
+        line = line.replace('1.0.0.0/24', '2001:db8:1::/48').replace('2.0.0.0/16', '2001:db8:2::/48')
+        line = line.replace('3.0.0.0/8', '2001:db8:3::/48')
+        _, peer, _, announce, withdraw = exabgp_parser.parse(line)
+        self.assertEqual(exabgp_parser.to_address(peer), ipaddress.ip_address('2001:db8::1'))
+        nexthop, prefixes = announce[0]
+        self.assertEqual(exabgp_parser.to_address(nexthop), ipaddress.ip_address('2001:db8::1'))
+        self.assertEqual([exabgp_parser.to_network(prefix) for prefix in prefixes],
+                         [ipaddress.ip_network('2001:db8:1::/48'), ipaddress.ip_network('2001:db8:2::/48')])
+        self.assertEqual([exabgp_parser.to_network(prefix) for prefix in withdraw],
+                         [ipaddress.ip_network('2001:db8:3::/48')])
+
+    def test_parse_others(self):
+        self.assertEqual(exabgp_parser.parse(self.STATE % 'up')[::2], (MSG_STATE, 'up'))
+        self.assertEqual(exabgp_parser.parse(self.STATE % 'connected')[2], 'down')
+        self.assertEqual(exabgp_parser.parse(self.EOR)[0], MSG_EOR)
+        self.assertEqual(exabgp_parser.parse('not json')[0], MSG_ERROR)
+        for line in ['', 'done', 'error']:
+            self.assertTrue(exabgp_parser.parse(line) is None)
+
+    def test_parser_pool_keeps_order(self):
+        lines = []
+        for i in range(200):
+            lines.append(self.UPDATE % ('10.0.0.%d' % (i % 5 + 1), '10.0.0.1'))
+            lines.append(self.STATE % 'up')
+        pool = ParserPool(2, chunksize=8)
+        try:
+            msgs = pool.parse_batch(lines)
+        finally:
+            pool.stop()
+        self.assertEqual(msgs, [exabgp_parser.parse(line) for line in lines])
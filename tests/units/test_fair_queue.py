@@ -0,0 +1,65 @@
+import unittest
+
+from fbgp.fair_queue import FairQueue
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestFairQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.queue = FairQueue(quantum=100, clock=self.clock)
+
+    def drain(self):
+        items = []
+        while True:
+            item = self.queue.pop()
+            if item is None:
+                return items
+            items.append(item)
+
+    def test_round_robin(self):
+        for i in range(10):
+            self.queue.put('a', 'a%d' % i, 50)
+        self.queue.put('b', 'b0', 50)
+        self.queue.put('b', 'b1', 50)
+        # a gets its quantum (two messages) then b is served
+        self.assertEqual(self.drain()[:5], ['a0', 'a1', 'b0', 'b1', 'a2'])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_large_messages(self):
+        self.queue.put('a', 'a0', 250)
+        self.queue.put('a', 'a1', 10)
+        for i in range(4):
+            self.queue.put('b', 'b%d' % i, 100)
+        # a is served once its deficit reaches the cost of its message
+        self.assertEqual(self.drain(), ['b0', 'b1', 'a0', 'a1', 'b2', 'b3'])
+
+    def test_rate_cap(self):
+        self.queue.set_rate('a', 2)
+        for i in range(5):
+            self.queue.put('a', 'a%d' % i)
+        self.queue.put('b', 'b0')
+        self.assertEqual(self.drain(), ['a0', 'a1', 'b0'])
+        self.assertEqual(self.queue.next_ready(), 0.5)
+        self.clock.now = 1.0
+        self.assertEqual(self.drain(), ['a2', 'a3'])
+        self.queue.set_rate('a', 0)
+        self.assertEqual(self.drain(), ['a4'])
+        self.assertIsNone(self.queue.next_ready())
+
+    def test_stats(self):
+        self.queue.put('a', 'a0')
+        self.queue.put('a', 'a1')
+        self.clock.now = 2.0
+        self.queue.pop()
+        stats = self.queue.stats()['a']
+        self.assertEqual((stats['depth'], stats['served_total'], stats['wait_max']), (1, 1, 2.0))
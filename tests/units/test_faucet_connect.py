@@ -0,0 +1,69 @@
+import os
+import json
+import unittest
+
+from unittest.mock import Mock
+from unittest.mock import patch
+
+from fbgp.faucet_connect import FaucetConnect
+
+
+def event(**kwargs):
+    return json.dumps(dict(version=1, dp_id=1, **kwargs)).encode('utf-8') + b'\n'
+
+
+class TestFaucetConnect(unittest.TestCase):
+
+    LEARN = {'L2_LEARN': {'l3_src_ip': '10.0.10.1', 'vid': 10, 'port_no': 1}}
+
+    def setUp(self):
+        self.handler = Mock()
+        with patch.dict(os.environ, {}, clear=True):
+            self.connect = FaucetConnect(self.handler)
+
+    def test_partial_events(self):
+        data = event(**self.LEARN) + event(L2_EXPIRE={'vid': 10})
+        self.connect._feed(data[:10])
+        self.connect._feed(data[10:-5])
+        self.assertEqual(self.handler.call_count, 1)
+        self.assertEqual(self.handler.call_args[0][0]['L2_LEARN'], self.LEARN['L2_LEARN'])
+        self.connect._feed(data[-5:])
+        self.assertEqual(self.handler.call_count, 2)
+        self.assertEqual(len(self.connect._buf), 0)
+
+    def test_irrelevant_events(self):
+        with patch.object(self.connect, '_process_faucet_event',
+                          wraps=self.connect._process_faucet_event) as process:
+            self.connect._feed(event(PORT_CHANGE={'port_no': 1}) + event(**self.LEARN) +
+                               event(CONFIG_CHANGE={'success': True}))
+        # only the L2_LEARN is decoded
+        self.assertEqual(process.call_count, 1)
+        self.assertEqual(self.handler.call_count, 1)
+
+    def test_repeated_learn(self):
+        learn = {'L2_LEARN': dict(self.LEARN['L2_LEARN'], eth_src='0e:00:00:00:00:01')}
+        moved = {'L2_LEARN': dict(learn['L2_LEARN'], port_no=2)}
+        expire = {'L2_EXPIRE': {'eth_src': '0e:00:00:00:00:01', 'vid': 10, 'port_no': 2}}
+        with patch.object(self.connect, '_process_faucet_event',
+                          wraps=self.connect._process_faucet_event) as process:
+            self.connect._feed(event(**learn) + event(**learn))
+            # the repeat is dropped before it is decoded
+            self.assertEqual(process.call_count, 1)
+            self.connect._feed(event(**moved) + event(**moved))
+            self.assertEqual(process.call_count, 2)
+            self.connect._feed(event(**expire) + event(**moved))
+            self.assertEqual(process.call_count, 4)
+            self.connect.reset()
+            self.connect._feed(event(**moved))
+            self.assertEqual(process.call_count, 5)
+        self.assertEqual(self.handler.call_count, 5)
+
+    def test_other_versions(self):
+        self.connect._feed(json.dumps(dict(version=2, dp_id=1, **self.LEARN)).encode('utf-8') + b'\n')
+        self.handler.assert_not_called()
+
+    def test_handler_error(self):
+        self.handler.side_effect = KeyError('dp_id')
+        self.connect._feed(event(**self.LEARN) + event(**self.LEARN))
+        # an event failing in the handler does not stop the next ones
+        self.assertEqual(self.handler.call_count, 2)
@@ -16,6 +16,8 @@ from faucet.faucet import Faucet
 from faucet.faucet_experimental_api import FaucetExperimentalAPI
 
 from fbgp.fbgp import FlowBasedBGP
+from fbgp.fair_queue import FairQueue
+from fbgp.fib import FibCompressor
 
 
 class MockFaucetApi(Mock):
@@ -142,6 +144,7 @@ dps:
                 patch('fbgp.fbgp.ServerConnect', MockServerConnect()) as server_connect:
 
             self.fbgp.initialize()
+        self.fbgp.exabgp_connect.recv_queue = FairQueue()
 
         self.peers = list(self.fbgp.peers.values())
         for peer in self.peers:
@@ -220,6 +223,8 @@ dps:
     def verify_prefix_in_rib_out(self, peer, prefix, **kwargs):
         prefix = ipaddress.ip_network(prefix)
         self.assertTrue(prefix in peer._rib_out)
+        if 'as_path' in kwargs:
+            kwargs['as_path'] = tuple(kwargs['as_path'])
         self.verify_route_attributes(peer._rib_out[prefix], **kwargs)
 
     def verify_best_route(self, prefix, **kwargs):
@@ -293,3 +298,245 @@ dps:
             else:
                 as_path = [65000, 2]
             self.verify_prefix_in_rib_out(peer, prefix, as_path=as_path)
+
+    def test_reload_config(self):
+        """Test reloading a config that changes a policy, removes a peer and adds one."""
+        prefix = '1.0.0.0/24'
+        self.announce_and_verify(prefix)
+        peers = self.fbgp.peers
+        config = self.FBGP_CONFIG.replace(
+            "- peer_ip: 10.0.30.1\n  peer_as: 2\n  local_as: 65000\n",
+            "- peer_ip: 10.0.30.1\n  peer_as: 2\n  local_as: 65000\n"
+            "  export_policy: '{2.0.0.0/8^+}'\n").replace(
+            "- peer_ip: 10.0.20.2\n  peer_as: 2\n",
+            "- peer_ip: 10.0.20.3\n  peer_as: 2\n")
+        try:
+            with open(os.environ['FBGP_CONFIG'], 'w') as f:
+                f.write(config)
+            self.fbgp.reload_config()
+        finally:
+            with open(os.environ['FBGP_CONFIG'], 'w') as f:
+                f.write(self.FBGP_CONFIG)
+        self.assertIs(self.fbgp.peers, peers)
+        self.assertNotIn(ipaddress.ip_address('10.0.20.2'), peers)
+        self.assertIn(ipaddress.ip_address('10.0.20.3'), peers)
+        self.assertNotIn(ipaddress.ip_network(prefix), peers[ipaddress.ip_address('10.0.30.1')]._rib_out)
+        self.verify_prefix_in_rib_out(peers[ipaddress.ip_address('10.0.100.253')], prefix)
+        self.verify_best_route(prefix)
+        self.fbgp.exabgp_connect.reload.assert_called_once_with()
+
+    def test_reload_invalid_config(self):
+        """Test a reloaded config with a policy that does not parse changes nothing."""
+        prefix = '1.0.0.0/24'
+        self.announce_and_verify(prefix)
+        peers = dict(self.fbgp.peers)
+        config = self.FBGP_CONFIG.replace(
+            "- peer_ip: 10.0.30.1\n  peer_as: 2\n  local_as: 65000\n",
+            "- peer_ip: 10.0.30.1\n  peer_as: 2\n  local_as: 65000\n"
+            "  export_policy: '{300.0.0.0/8^+}'\n").replace(
+            "- peer_ip: 10.0.20.2\n  peer_as: 2\n",
+            "- peer_ip: 10.0.20.3\n  peer_as: 2\n")
+        try:
+            with open(os.environ['FBGP_CONFIG'], 'w') as f:
+                f.write(config)
+            self.fbgp.reload_config()
+        finally:
+            with open(os.environ['FBGP_CONFIG'], 'w') as f:
+                f.write(self.FBGP_CONFIG)
+        self.assertEqual(self.fbgp.peers, peers)
+        self.assertNotIn('export_policy', self.fbgp.peer_confs[ipaddress.ip_address('10.0.30.1')])
+        self.verify_prefix_in_rib_out(peers[ipaddress.ip_address('10.0.30.1')], prefix)
+        self.fbgp.exabgp_connect.reload.assert_not_called()
+
+    def test_remove_restored_peer(self):
+        """Test removing a peer whose routes were restored from a snapshot but never came up
+        releases its routes from the RIB budget."""
+        prefix = ipaddress.ip_network('1.0.0.0/24')
+        peer = self.peers[1]
+        self.peer_announce(peer, str(prefix))
+        route = peer._rib_in[prefix]
+        self.peer_down(peer)
+        used = self.fbgp.rib_budget.used
+        peer.load_route(route)
+        _, route = peer.reevaluate_import(prefix)
+        self.fbgp.bgp.load_routes([(route, True)])
+        self.assertEqual(self.fbgp.rib_budget.used, used + 1)
+        self.fbgp._remove_peer(peer)
+        self.assertEqual(self.fbgp.rib_budget.used, used)
+        self.assertNotIn(prefix, self.fbgp.bgp.best_routes)
+
+    def test_bulk_mapping(self):
+        """Test a bulk mapping command is applied as one transaction with a single ack."""
+        prefixes = ['1.0.%s.0/24' % i for i in range(3)]
+        for prefix in prefixes:
+            self.peer_announce(self.peers[0], prefix)
+            self.peer_announce(self.peers[1], prefix, as_path=[2, 2])
+        nexthop = str(self.peers[1].peer_ip)
+        command = {'command': 'bulk_mapping', 'seq': 1, 'mappings': [
+            {'command': 'add_mapping', 'for_peer': False, 'nexthop': nexthop,
+             'prefixes': prefixes[:1], 'prefix_ranges': ['1.0.0.0/16^24']},
+            {'command': 'add_mapping', 'routerid': '10.9.9.9', 'nexthop': nexthop}]}
+        self.reset_mocker()
+        self.fbgp._process_server_msg({'msg_type': 'server_command', 'msg': command})
+        ack = self.fbgp.server_connect.send.call_args[0][0]
+        self.assertEqual((ack['msg_type'], ack['seq'], ack['status']), ('nack', 1, 'error'))
+        self.fbgp.exabgp_connect.send.assert_not_called()
+        for prefix in prefixes:
+            self.verify_best_route(prefix, as_path=[1])
+
+        command['mappings'].pop()
+        command['seq'] = 2
+        fib_generation = self.fbgp.fib_generation
+        self.fbgp._process_server_msg({'msg_type': 'server_command', 'msg': command})
+        ack = self.fbgp.server_connect.send.call_args[0][0]
+        self.assertEqual((ack['msg_type'], ack['seq'], ack['mappings'], ack['prefixes']), ('ack', 2, 1, 3))
+        self.assertEqual(ack['fib_generation'], fib_generation + 3)
+        for prefix in prefixes:
+            self.verify_best_route(prefix, as_path=[2, 2])
+        self.fbgp.exabgp_connect.send.assert_called_once()
+
+    def test_bulk_mapping_without_seq(self):
+        """Test a bulk mapping without a seq is acked, the ack has no seq."""
+        prefixes = ['1.0.%s.0/24' % i for i in range(2)]
+        for prefix in prefixes:
+            self.peer_announce(self.peers[0], prefix)
+            self.peer_announce(self.peers[1], prefix, as_path=[2, 2])
+        command = {'command': 'bulk_mapping', 'mappings': [
+            {'command': 'add_mapping', 'for_peer': False,
+             'nexthop': str(self.peers[1].peer_ip), 'prefixes': prefixes}]}
+        self.reset_mocker()
+        self.fbgp._process_server_msg({'msg_type': 'server_command', 'msg': command})
+        ack = self.fbgp.server_connect.send.call_args[0][0]
+        self.assertEqual((ack['msg_type'], ack['command'], ack['mappings']), ('ack', 'bulk_mapping', 1))
+        self.assertNotIn('seq', ack)
+
+    def test_ack_flushes_fib(self):
+        """Test the compressed FIB changes of a command are programmed before its ack."""
+        prefixes = ['1.0.%s.0/24' % i for i in range(3)]
+        self.fbgp.fib = FibCompressor(self.fbgp._fib_changed)
+        try:
+            for prefix in prefixes:
+                self.peer_announce(self.peers[0], prefix)
+                self.peer_announce(self.peers[1], prefix, as_path=[2, 2])
+            self.fbgp._flush_fib()
+            fib_generation = self.fbgp.fib_generation
+            command = {'command': 'bulk_mapping', 'seq': 1, 'mappings': [
+                {'command': 'add_mapping', 'for_peer': False,
+                 'nexthop': str(self.peers[1].peer_ip), 'prefixes': prefixes}]}
+            self.fbgp._process_server_msg({'msg_type': 'server_command', 'msg': command})
+            ack = self.fbgp.server_connect.send.call_args[0][0]
+            # 1.0.0.0/23 and 1.0.2.0/24 replaced
+            self.assertEqual(ack['fib_generation'], fib_generation + 2)
+            self.assertEqual(self.fbgp.fib.flush(), ([], []))
+        finally:
+            self.fbgp.fib = None
+
+    def test_bulk_mapping_atomic(self):
+        """Test a bulk mapping with an entry failing its checks changes nothing."""
+        prefixes = ['1.0.%s.0/24' % i for i in range(3)]
+        for prefix in prefixes:
+            self.peer_announce(self.peers[0], prefix)
+            self.peer_announce(self.peers[1], prefix, as_path=[2, 2])
+        nexthop = str(self.peers[1].peer_ip)
+        vip_assignment = dict(self.fbgp.vip_assignment)
+        command = {'command': 'bulk_mapping', 'seq': 1, 'mappings': [
+            {'command': 'add_mapping', 'for_peer': False, 'nexthop': nexthop,
+             'prefixes': prefixes},
+            {'command': 'add_mapping', 'routerid': str(self.peers[2].peer_ip),
+             'nexthop': nexthop, 'prefixes': prefixes, 'pathid': 1000}]}
+        self.reset_mocker()
+        self.fbgp._process_server_msg({'msg_type': 'server_command', 'msg': command})
+        ack = self.fbgp.server_connect.send.call_args[0][0]
+        self.assertEqual((ack['msg_type'], [failed['index'] for failed in ack['failed']]),
+                         ('nack', [1]))
+        self.fbgp.exabgp_connect.send.assert_not_called()
+        self.assertEqual(self.fbgp.vip_assignment, vip_assignment)
+        self.assertFalse(any(self.fbgp.path_mapping.values()))
+        for prefix in prefixes:
+            self.verify_best_route(prefix, as_path=[1])
+
+    def test_export_paths_programs_changes(self):
+        """Test the paths sent to an ADD-PATH peer are programmed only when they change."""
+        prefix = ipaddress.ip_network('1.0.0.0/24')
+        self.peer_announce(self.peers[0], str(prefix))
+        self.peer_announce(self.peers[1], str(prefix), as_path=[2, 2])
+        peer = self.peers[3]
+        vip = ipaddress.ip_interface('10.0.100.100/24')
+        with patch.object(peer, 'add_path', 2), \
+                patch.object(self.fbgp, '_get_vip', Mock(return_value=vip)), \
+                patch.object(self.fbgp, '_update_mapping') as update_mapping:
+            peer._rib_out_paths.pop(prefix, None)
+            msgs = self.fbgp._export_paths(peer, prefix)
+            self.assertEqual(len(msgs), 2)
+            self.assertEqual(update_mapping.call_count, 1)
+            self.assertEqual(self.fbgp._export_paths(peer, prefix), [])
+            self.assertEqual(update_mapping.call_count, 1)
+
+    def test_duplicate_l2_learn(self):
+        """Test a L2_LEARN of a peer already connected is ignored."""
+        peer = self.peers[0]
+        msg = {'version': 1, 'dp_id': 1, 'L2_LEARN': {
+            'l3_src_ip': str(peer.peer_ip), 'vid': 10, 'port_no': 2}}
+        self.reset_mocker()
+        with patch.object(peer, 'is_connected', False):
+            self.fbgp._process_faucet_msg(msg)
+            self.fbgp._process_faucet_msg(msg)
+        sent = [call[0][0] for call in self.fbgp.server_connect.send.call_args_list]
+        self.assertEqual([msg['msg_type'] for msg in sent], ['nexthop_up'])
+
+    def test_ack_queued(self):
+        """Test an ack reports the ExaBGP messages waiting to be processed."""
+        for i in range(3):
+            self.fbgp.exabgp_connect.recv_queue.put(self.peers[0].peer_ip, 'update %s' % i)
+        self.reset_mocker()
+        self.fbgp._ack_command({'seq': 1, 'command': 'add_mapping'}, {'status': 'ok'})
+        ack = self.fbgp.server_connect.send.call_args[0][0]
+        self.assertEqual((ack['msg_type'], ack['queued']), ('ack', 3))
+
+    def test_max_prefix_teardown(self):
+        """Test a peer going over its max-prefix limit is torn down and its routes withdrawn."""
+        peer = self.peers[0]
+        peer.max_prefix = 1
+        self.announce_and_verify('1.0.0.0/24')
+        self.reset_mocker()
+        self.peer_announce(peer, '1.0.1.0/24')
+        sent = [call[0][0] for call in self.fbgp.exabgp_connect.send.call_args_list]
+        self.assertIn('neighbor %s teardown 1' % peer.peer_ip, sent)
+        self.assertEqual(self.fbgp.max_prefix_teardowns, 1)
+        self.assertEqual(len(peer._rib_in), 0)
+        self.assertNotIn(ipaddress.ip_network('1.0.0.0/24'), self.fbgp.bgp.best_routes)
+        self.assertNotIn(ipaddress.ip_network('1.0.1.0/24'), self.fbgp.bgp.best_routes)
+
+    def test_update_groups_policy_dict(self):
+        """Test the peers with an export policy with actions (a dict) are grouped."""
+        policy = {'filter': '{1.0.0.0/8^+}', 'actions': 'med = 100'}
+        peer_confs = {peer_ip: dict(conf, export_policy=dict(policy))
+                      for peer_ip, conf in self.fbgp.peer_confs.items()}
+        with patch.dict(self.fbgp.peer_confs, peer_confs):
+            groups = self.fbgp._update_groups(self.peers[0])
+        self.assertEqual(sum(len(members) for _, members in groups), len(self.peers) - 1)
+
+    def test_peer_down_batches(self):
+        """Test the routes of a peer gone down leave the selection at once and are
+        withdrawn from the other peers a batch per timer tick."""
+        prefixes = ['1.0.%s.0/24' % i for i in range(5)]
+        first_peer = self.peers[0]
+        for prefix in prefixes:
+            self.peer_announce(first_peer, prefix)
+        self.fbgp.PEER_DOWN_BATCH = 2
+        try:
+            self.reset_mocker()
+            self.peer_down(first_peer)
+            self.assertEqual(len(self.fbgp.bgp.best_routes), 0)
+            for routes in self.fbgp.bgp.loc_rib.values():
+                self.assertFalse([route for route in routes
+                                  if route.from_peer == first_peer.peer_ip])
+            # the last batches are not exported yet
+            self.assertTrue(any(len(peer._rib_out) for peer in self.peers[1:]))
+            # the session coming back up completes the withdrawal first
+            self.peer_up(first_peer)
+            self.assertEqual(len(self.fbgp.bgp.best_routes), 0)
+            for peer in self.peers[1:]:
+                self.assertEqual(len(peer._rib_out), 0)
+        finally:
+            del self.fbgp.PEER_DOWN_BATCH
@@ -0,0 +1,116 @@
+import unittest
+import random
+import ipaddress
+
+from fbgp.fib import FibCompressor
+
+
+def lookup(table, addr):
+    """Longest prefix match of addr in a {prefix: target} table."""
+    best = None
+    for prefix, target in table.items():
+        if addr in prefix and (best is None or prefix.prefixlen > best[0].prefixlen):
+            best = (prefix, target)
+    return best[1] if best else None
+
+
+class TestFibCompressor(unittest.TestCase):
+
+    def setUp(self):
+        self.fib = FibCompressor()
+        self.installed = {}
+
+    def apply(self):
+        adds, dels = self.fib.flush()
+        for prefix, target in dels:
+            self.assertEqual(self.installed.pop(prefix), target)
+        for prefix, target in adds:
+            self.installed[prefix] = target
+        return adds, dels
+
+    def set(self, prefix, target):
+        self.fib.set(ipaddress.ip_network(prefix), target)
+
+    def test_sibling_aggregation(self):
+        for i in range(4):
+            self.set('1.0.%d.0/24' % i, 'a')
+        self.set('1.0.4.0/24', 'b')
+        self.apply()
+        self.assertEqual(self.installed, {ipaddress.ip_network('1.0.0.0/22'): 'a',
+                                          ipaddress.ip_network('1.0.4.0/24'): 'b'})
+        # a more specific with the same target as its covering route is not installed
+        self.set('1.0.0.0/16', 'b')
+        self.set('1.0.5.0/24', 'b')
+        self.apply()
+        self.assertEqual(self.installed, {ipaddress.ip_network('1.0.0.0/16'): 'b',
+                                          ipaddress.ip_network('1.0.0.0/22'): 'a'})
+        self.assertEqual(self.fib.stats()['fib_routes'], 7)
+        # the aggregate stays while its range is covered, the changed route is installed under it
+        self.set('1.0.0.0/16', None)
+        self.set('1.0.2.0/24', 'c')
+        adds, dels = self.apply()
+        self.assertEqual(self.installed, {ipaddress.ip_network('1.0.0.0/22'): 'a',
+                                          ipaddress.ip_network('1.0.2.0/24'): 'c',
+                                          ipaddress.ip_network('1.0.4.0/23'): 'b'})
+        self.assertIn((ipaddress.ip_network('1.0.0.0/16'), 'b'), dels)
+
+    def test_ops_counters(self):
+        for i in range(2):
+            self.set('1.0.%d.0/24' % i, 'a')
+        self.apply()
+        # same target, nothing to recompute
+        self.set('1.0.0.0/24', 'a')
+        self.set('1.0.9.0/24', None)
+        self.assertEqual(self.apply(), ([], []))
+        # the aggregate stays, the change costs one op
+        self.set('1.0.1.0/24', 'b')
+        self.assertEqual(self.apply(), ([(ipaddress.ip_network('1.0.1.0/24'), 'b')], []))
+        stats = self.fib.stats()
+        self.assertEqual((stats['fib_route_ops_total'], stats['fib_ops_total']), (3, 2))
+        # and back
+        self.set('1.0.1.0/24', 'a')
+        self.assertEqual(self.apply(), ([], [(ipaddress.ip_network('1.0.1.0/24'), 'b')]))
+
+    def test_delete_in_aggregate(self):
+        for i in range(4):
+            self.set('1.0.%d.0/24' % i, 'a')
+        self.apply()
+        # the aggregate would cover the removed route, it is split
+        self.set('1.0.3.0/24', None)
+        self.apply()
+        self.assertEqual(self.installed, {ipaddress.ip_network('1.0.0.0/23'): 'a',
+                                          ipaddress.ip_network('1.0.2.0/24'): 'a'})
+        # unless a covering route forwards the same way
+        self.set('1.0.0.0/20', 'a')
+        self.set('1.0.2.0/24', None)
+        self.apply()
+        self.assertEqual(self.installed, {ipaddress.ip_network('1.0.0.0/20'): 'a'})
+
+    def test_same_forwarding(self):
+        rand = random.Random(1)
+        table = {}
+        blocks = [0x0a000000, 0x0a010000, 0x0b000000]
+        for _ in range(20):
+            for _ in range(30):
+                length = rand.choice([8, 15, 16, 17, 20, 22, 23, 24, 24, 24, 32])
+                network = (rand.choice(blocks) + rand.randrange(1 << 17)) & ~((1 << (32 - length)) - 1)
+                prefix = ipaddress.ip_network((network & 0xffffffff, length))
+                target = None if rand.random() < 0.25 else rand.choice('ab')
+                if target is None:
+                    table.pop(prefix, None)
+                else:
+                    table[prefix] = target
+                self.fib.set(prefix, target)
+            self.apply()
+            self.assertEqual(len(self.installed), self.fib.stats()['fib_entries'])
+            for _ in range(500):
+                addr = ipaddress.ip_address(rand.choice(blocks + [0x0c000000]) + rand.randrange(1 << 18))
+                self.assertEqual(lookup(table, addr), lookup(self.installed, addr))
+
+    def test_ipv6(self):
+        for i in range(2):
+            self.set('2001:db8:%d::/48' % i, 'a')
+        self.set('2001:db8:2::/48', 'b')
+        self.apply()
+        self.assertEqual(self.installed, {ipaddress.ip_network('2001:db8::/47'): 'a',
+                                          ipaddress.ip_network('2001:db8:2::/48'): 'b'})
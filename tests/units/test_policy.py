@@ -0,0 +1,72 @@
+import unittest
+import ipaddress
+
+from fbgp.bgp import Route
+from fbgp.policy import Action, Policy, PrefixRange, compile_actions
+
+
+class TestPolicy(unittest.TestCase):
+
+    def route(self, prefix, as_path):
+        return Route(ipaddress.ip_network(prefix), ipaddress.ip_address('10.0.0.1'), as_path, 0)
+
+    def test_parse_default(self):
+        policy = Policy.parse(None)
+        self.assertTrue(policy.evaluate(self.route('1.0.0.0/24', [1])))
+
+    def test_parse_filter(self):
+        policy = Policy.parse('{1.0.0.0/8^+}')
+        self.assertTrue(policy.evaluate(self.route('1.2.0.0/16', [1])))
+        self.assertIsNone(policy.evaluate(self.route('2.0.0.0/16', [1])))
+        policy = Policy.parse({'filter': 'AS1'})
+        self.assertTrue(policy.evaluate(self.route('2.0.0.0/16', [1])))
+        self.assertIsNone(policy.evaluate(self.route('2.0.0.0/16', [2])))
+
+    def test_parse_filter_ipv6(self):
+        policy = Policy.parse('{2001:db8::/32^48-64, 1.0.0.0/8^+}')
+        self.assertTrue(policy.evaluate(self.route('2001:db8:1::/48', [1])))
+        self.assertTrue(policy.evaluate(self.route('1.2.0.0/16', [1])))
+        self.assertIsNone(policy.evaluate(self.route('2001:db8::/32', [1])))
+        self.assertIsNone(policy.evaluate(self.route('2001:db9::/48', [1])))
+        self.assertIsNone(policy.evaluate(self.route('2001:db8::/96', [1])))
+
+    def test_prefix_range_contains(self):
+        prefix_range = PrefixRange.parse('10.1.0.0/16^20-24')
+        net = ipaddress.ip_network
+        self.assertTrue(prefix_range.contains(net('10.1.16.0/20')))
+        self.assertTrue(prefix_range.contains(net('10.1.255.0/24')))
+        self.assertFalse(prefix_range.contains(net('10.1.0.0/16')))
+        self.assertFalse(prefix_range.contains(net('10.1.0.0/25')))
+        self.assertFalse(prefix_range.contains(net('10.2.0.0/24')))
+        self.assertFalse(prefix_range.contains(net('10.0.0.0/8')))
+        self.assertFalse(prefix_range.contains(net('2001:db8::/48')))
+
+    def test_actions(self):
+        policy = Policy.parse({'filter': 'any',
+                               'actions': 'pref=200; med=10; aspath.prepend(AS65000,AS65000); '
+                                          'community .= {65000:1}'})
+        routes = [self.route('1.0.%d.0/24' % i, [1]) for i in range(3)]
+        results = [policy.evaluate(route) for route in routes]
+        for route, result in zip(routes, results):
+            self.assertIsNot(route, result)
+            self.assertEqual(route.as_path, [1])
+            self.assertEqual(result.prefix, route.prefix)
+            self.assertEqual(result.as_path, [65000, 65000, 1])
+            self.assertEqual(result.local_pref, 200)
+            self.assertEqual(result.med, 10)
+            self.assertEqual(result.community, ((65000, 1),))
+        # the rewritten attributes are shared
+        self.assertIs(results[0].as_path, results[2].as_path)
+        self.assertIn('community [65000:1]', results[0].to_exabgp(gw='10.0.0.254'))
+
+    def test_actions_no_change(self):
+        policy = Policy.parse({'filter': 'any', 'actions': 'med=0'})
+        route = self.route('1.0.0.0/24', [1])
+        self.assertIs(policy.evaluate(route), route)
+
+    def test_action_generic_compile(self):
+        apply = compile_actions([Action('med', 50)])
+        route = self.route('1.0.0.0/24', [1])
+        result = apply(route)
+        self.assertEqual((result.med, route.med), (50, 0))
+        self.assertIsNone(compile_actions(Action.parse('')))
@@ -0,0 +1,98 @@
+import unittest
+import tempfile
+import shutil
+import os
+import ipaddress
+
+from unittest.mock import Mock
+
+from fbgp.bgp import BgpRouter, BgpPeer
+from fbgp.rib_export import RibExporter, RibExportReader
+
+
+class TestRibExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'rib.export')
+        self.peers = {}
+        for peerip, peeras in [('10.0.0.1', 1), ('10.0.0.2', 2)]:
+            peerip = ipaddress.ip_address(peerip)
+            self.peers[peerip] = BgpPeer(peeras, peerip, 65000)
+            self.peers[peerip].bgp_session_up()
+        self.bgp = BgpRouter({}, self.peers, Mock())
+        self.prefix = ipaddress.ip_network('1.0.0.0/24')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def announce(self, exporter, peer, prefix, as_path):
+        route = peer.rcv_announce(prefix, peer.peer_ip, as_path, 'igp')
+        self.bgp.add_route(route)
+        exporter.rib_in_changed(peer.peer_ip, prefix)
+        exporter.best_changed(prefix)
+
+    def withdraw(self, exporter, peer, prefix):
+        route = peer.rcv_withdraw(prefix)
+        self.bgp.del_route(route)
+        exporter.rib_in_changed(peer.peer_ip, prefix)
+        exporter.best_changed(prefix)
+
+    def test_export_changes(self):
+        peer1, peer2 = self.peers.values()
+        exporter = RibExporter(self.path, self.bgp, self.peers, capacity=4096)
+        reader = RibExportReader(self.path)
+        version = reader.refresh()
+        self.assertEqual(reader.best_routes, {})
+
+        self.announce(exporter, peer1, self.prefix, [1, 1])
+        self.announce(exporter, peer2, self.prefix, [2])
+        exporter.flush()
+        self.assertTrue(reader.refresh() > version)
+        self.assertEqual(reader.best_routes[self.prefix].peer_ip, peer2.peer_ip)
+        self.assertEqual(reader.best_routes[self.prefix].as_path, [2])
+        self.assertEqual(len(reader.rib_in[peer1.peer_ip]), 1)
+
+        self.withdraw(exporter, peer2, self.prefix)
+        exporter.flush()
+        reader.refresh()
+        self.assertEqual(reader.best_routes[self.prefix].peer_ip, peer1.peer_ip)
+        self.assertEqual(reader.rib_in[peer2.peer_ip], {})
+
+        self.withdraw(exporter, peer1, self.prefix)
+        exporter.peer_cleared(peer1.peer_ip)
+        exporter.flush()
+        reader.refresh()
+        self.assertEqual(reader.best_routes, {})
+        self.assertFalse(peer1.peer_ip in reader.rib_in)
+        exporter.close()
+        reader.close()
+
+    def test_compaction(self):
+        peer = self.peers[ipaddress.ip_address('10.0.0.1')]
+        exporter = RibExporter(self.path, self.bgp, self.peers, capacity=1024)
+        reader = RibExportReader(self.path)
+        reader.refresh()
+        for i in range(100):
+            self.announce(exporter, peer, ipaddress.ip_network('1.0.%d.0/24' % i), [1])
+            exporter.flush()
+        self.assertTrue(exporter.generation > 1)
+        reader.refresh()
+        self.assertEqual(reader.generation, exporter.generation)
+        self.assertEqual(len(reader.best_routes), 100)
+        self.assertEqual(len(reader.rib_in[peer.peer_ip]), 100)
+        exporter.close()
+        reader.close()
+
+    def test_long_attributes(self):
+        peer = self.peers[ipaddress.ip_address('10.0.0.1')]
+        exporter = RibExporter(self.path, self.bgp, self.peers, capacity=4096)
+        reader = RibExportReader(self.path)
+        # the attributes encode to more than 64 KiB
+        as_path = [65000 + i % 500 for i in range(20000)]
+        self.announce(exporter, peer, self.prefix, as_path)
+        exporter.flush()
+        reader.refresh()
+        self.assertEqual(reader.best_routes[self.prefix].as_path, as_path)
+        exporter.close()
+        reader.close()
@@ -0,0 +1,68 @@
+import unittest
+import random
+import ipaddress
+
+from unittest.mock import Mock
+
+from fbgp.bgp import BgpRouter, BgpPeer
+from fbgp.shard import ShardedBgpRouter
+
+
+class TestShardedBgpRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.peers = {}
+        for peerip, peeras in [('10.0.0.1', 1), ('10.0.0.2', 2), ('10.0.0.3', 3),
+                               ('10.0.10.1', 65000)]:
+            peerip = ipaddress.ip_address(peerip)
+            self.peers[peerip] = BgpPeer(peeras, peerip, 65000)
+            self.peers[peerip].bgp_session_up()
+        self.bgp = BgpRouter({}, self.peers, Mock())
+        self.sharded = ShardedBgpRouter({}, self.peers, Mock(), 2)
+
+    def tearDown(self):
+        self.sharded.stop()
+
+    def test_same_results_as_single_process(self):
+        rnd = random.Random(1)
+        prefixes = [ipaddress.ip_network('1.0.%d.0/24' % i) for i in range(20)]
+        peers = list(self.peers.values())
+        changes = []
+        for _ in range(500):
+            peer = rnd.choice(peers)
+            prefix = rnd.choice(prefixes)
+            if prefix in peer._rib_in and rnd.random() < 0.5:
+                changes.append((peer.rcv_withdraw(prefix), True))
+            else:
+                as_path = [peer.peer_as] * rnd.randint(1, 3)
+                route = peer.rcv_announce(prefix, peer.peer_ip, as_path, 'igp',
+                                          med=rnd.randint(0, 2), local_pref=rnd.choice([100, 200]))
+                if route:
+                    changes.append((route, False))
+        for batch in [changes[i:i + 37] for i in range(0, len(changes), 37)]:
+            expected = self.bgp.apply_changes(batch)
+            results = self.sharded.apply_changes(batch)
+            for (new_best, cur_best), (exp_new_best, exp_cur_best) in zip(results, expected):
+                self.assertTrue(new_best is exp_new_best)
+                self.assertTrue(cur_best is exp_cur_best)
+        self.assertEqual(self.sharded.loc_rib, self.bgp.loc_rib)
+        self.assertEqual(set(self.sharded.best_routes), set(self.bgp.best_routes))
+        for prefix, route in self.bgp.best_routes.items():
+            self.assertTrue(self.sharded.best_routes[prefix] is route)
+
+    def test_queued_ops(self):
+        """set_best_route and load_routes are sent with the next batch."""
+        prefix = ipaddress.ip_network('1.0.0.0/24')
+        peers = list(self.peers.values())
+        routes = [peer.rcv_announce(prefix, peer.peer_ip, [peer.peer_as] * (n + 1), 'igp')
+                  for n, peer in enumerate(peers[:3])]
+        for bgp in (self.bgp, self.sharded):
+            bgp.load_routes([(routes[0], True), (routes[1], False)])
+            bgp.set_best_route(routes[1])
+        self.assertTrue(any(self.sharded._queued))
+        expected = self.bgp.apply_changes([(routes[2], False), (routes[1], True)])
+        results = self.sharded.apply_changes([(routes[2], False), (routes[1], True)])
+        self.assertFalse(any(self.sharded._queued))
+        for (new_best, cur_best), (exp_new_best, exp_cur_best) in zip(results, expected):
+            self.assertTrue(new_best is exp_new_best)
+            self.assertTrue(cur_best is exp_cur_best)
@@ -0,0 +1,82 @@
+import unittest
+import tempfile
+import shutil
+import os
+import ipaddress
+
+from unittest.mock import Mock
+
+from fbgp.bgp import BgpRouter, BgpPeer
+from fbgp.snapshot import RibSnapshot, ROUTE_ACCEPTED, ROUTE_BEST
+
+
+class TestRibSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'rib.snap')
+        self.peers = {}
+        for peerip, peeras in [('10.0.0.1', 1), ('10.0.0.2', 2), ('2001:db8::1', 3)]:
+            peerip = ipaddress.ip_address(peerip)
+            self.peers[peerip] = BgpPeer(peeras, peerip, 65000)
+            self.peers[peerip].bgp_session_up()
+        self.bgp = BgpRouter({}, self.peers, Mock())
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def announce(self, peer_ip, prefix, as_path, **kwargs):
+        peer = self.peers[ipaddress.ip_address(peer_ip)]
+        route = peer.rcv_announce(
+            ipaddress.ip_network(prefix), peer.peer_ip, as_path, 'igp', **kwargs)
+        self.bgp.add_route(route)
+        return route
+
+    def test_save_and_load(self):
+        self.announce('10.0.0.1', '1.0.0.0/24', [1], med=10, community=[[1, 2]])
+        self.announce('10.0.0.2', '1.0.0.0/24', [2, 2])
+        self.announce('10.0.0.2', '2.0.0.0/16', [2, 2])
+        self.announce('2001:db8::1', '2001:db8:1::/48', [3])
+
+        snapshot = RibSnapshot()
+        snapshot.current_pathid = 2
+        snapshot.nexthop_to_pathid = {ipaddress.ip_address('10.0.0.1'): 1,
+                                      ipaddress.ip_address('10.0.0.2'): 2}
+        snapshot.vip_assignment = {(ipaddress.ip_address('10.0.0.1'), 20): '10.0.20.250'}
+        snapshot.path_mapping = {
+            (ipaddress.ip_network('1.0.0.0/24'), ipaddress.ip_address('10.0.0.2')):
+                set([ipaddress.ip_address('10.0.0.1')])}
+        for peer in self.peers.values():
+            snapshot.add_peer(peer, self.bgp.best_routes, self.bgp.loc_rib)
+        snapshot.save(self.path)
+
+        loaded = RibSnapshot.load(self.path, self.peers)
+        self.assertEqual(loaded.num_routes(), 4)
+        self.assertEqual(loaded.current_pathid, 2)
+        self.assertEqual(loaded.nexthop_to_pathid, snapshot.nexthop_to_pathid)
+        self.assertEqual(loaded.vip_assignment, snapshot.vip_assignment)
+        self.assertEqual(loaded.path_mapping, snapshot.path_mapping)
+        for peer_ip, routes in loaded.routes.items():
+            peer = self.peers[peer_ip]
+            self.assertEqual(len(routes), len(peer._rib_in))
+            for route, flags in routes:
+                self.assertEqual(route, peer._rib_in[route.prefix])
+                self.assertTrue(flags & ROUTE_ACCEPTED)
+                is_best = self.bgp.best_routes[route.prefix] is peer._rib_in[route.prefix]
+                self.assertEqual(bool(flags & ROUTE_BEST), is_best)
+
+    def test_load_skips_unknown_peers(self):
+        self.announce('10.0.0.1', '1.0.0.0/24', [1])
+        snapshot = RibSnapshot()
+        for peer in self.peers.values():
+            snapshot.add_peer(peer, self.bgp.best_routes, self.bgp.loc_rib)
+        snapshot.save(self.path)
+        del self.peers[ipaddress.ip_address('10.0.0.1')]
+        loaded = RibSnapshot.load(self.path, self.peers)
+        self.assertEqual(loaded.num_routes(), 0)
+
+    def test_load_bad_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\x00' * 64)
+        with self.assertRaises(ValueError):
+            RibSnapshot.load(self.path, self.peers)
@@ -0,0 +1,46 @@
+import os
+import sys
+import unittest
+import importlib.util
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def import_times(module):
+    """Import module in a fresh interpreter, return {module: cumulative import time (us)}."""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        stderr=subprocess.PIPE, env=env, check=True)
+    times = {}
+    for line in proc.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+class TestStartup(unittest.TestCase):
+
+    HEAVY = ('eventlet', 'twisted', 'yaml', 'ryu', 'oslo_config')
+
+    def assertNotImported(self, times, names):
+        for name in names:
+            self.assertNotIn(name, times, '%s imported at startup' % name)
+
+    def test_core_modules(self):
+        for module in ['fbgp.bgp', 'fbgp.timer', 'fbgp.damping', 'fbgp.exabgp_parser',
+                       'fbgp.snapshot', 'fbgp.rib_export', 'fbgp.shard']:
+            self.assertNotImported(import_times(module), self.HEAVY)
+
+    @unittest.skipIf(importlib.util.find_spec('ryu') is None or
+                     importlib.util.find_spec('faucet') is None, 'ryu or faucet not installed')
+    def test_app(self):
+        times = import_times('fbgp.fbgp')
+        self.assertNotImported(times, [
+            'twisted', 'yaml', 'oslo_config', 'fbgp.server_connect', 'fbgp.exabgp_connect',
+            'fbgp.faucet_connect', 'fbgp.snapshot', 'fbgp.rib_export', 'fbgp.shard',
+            'fbgp.damping'])
@@ -0,0 +1,63 @@
+import unittest
+
+from fbgp.timer import TimerWheel, SLOTS
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.timers = TimerWheel(tick=1, clock=self.clock)
+        self.fired = []
+
+    def advance_to(self, now):
+        self.clock.now = now
+        return self.timers.advance()
+
+    def test_schedule(self):
+        for delay in [3, 1, 2, SLOTS + 10, SLOTS * SLOTS + 5]:
+            self.timers.schedule(delay, self.fired.append, delay)
+        self.advance_to(2)
+        self.assertEqual(self.fired, [1, 2])
+        self.advance_to(SLOTS + 9)
+        self.assertEqual(self.fired, [1, 2, 3])
+        self.advance_to(SLOTS + 10)
+        self.assertEqual(self.fired, [1, 2, 3, SLOTS + 10])
+        self.advance_to(SLOTS * SLOTS + 4)
+        self.assertEqual(len(self.fired), 4)
+        self.advance_to(SLOTS * SLOTS + 5)
+        self.assertEqual(self.fired[-1], SLOTS * SLOTS + 5)
+        self.assertEqual(self.timers.count, 0)
+
+    def test_cancel(self):
+        timer = self.timers.schedule(5, self.fired.append, 5)
+        self.timers.schedule(6, self.fired.append, 6)
+        timer.cancel()
+        self.assertFalse(timer.pending())
+        self.advance_to(10)
+        self.assertEqual(self.fired, [6])
+
+    def test_every(self):
+        timer = self.timers.every(2, self.fired.append, 'tick')
+        self.advance_to(7)
+        self.assertEqual(len(self.fired), 3)
+        timer.cancel()
+        self.advance_to(20)
+        self.assertEqual(len(self.fired), 3)
+
+    def test_schedule_after_idle(self):
+        self.advance_to(1000)
+        self.timers.schedule(5, self.fired.append, 5)
+        self.advance_to(1004)
+        self.assertEqual(self.fired, [])
+        self.advance_to(1005)
+        self.assertEqual(self.fired, [5])